@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+alert_scheduler.py
+蜂鳴器警報排程器：每個 Buzzer 只有一個常駐線程負責開關，警報以宣告式的蜂鳴模式表示。
+
+  - 偵測迴圈只把請求放入 queue.SimpleQueue (O(1)、不建立線程、不等待)
+  - 高優先權的模式可立即中斷正在播放的低優先權模式 (Critical 中斷 Warning)
+  - 相同或較低優先權的請求在目前模式 (含結尾靜音) 結束前忽略，與原本的 last_alert_level 行為相同
+  - 每一步的時間點由模式開始時間累加計算，不受 time.sleep 誤差累積影響
+  - 排程器只以弱參照持有 buzzer：buzzer 被回收 (例如離線重播每次建立的 NullBuzzer) 時線程隨之結束
+"""
+import queue
+import threading
+import time
+import weakref
+from collections import namedtuple
+
+from metrics import Counter
+
+PATTERN_REQUESTS = Counter('buzzer_pattern_requests_total', "蜂鳴模式請求 (played / preempted / ignored)", ['pattern', 'result'])
+
+# steps: ((響鈴秒數, 靜音秒數), ...)；最後一步的靜音即為冷卻時間
+BeepPattern = namedtuple('BeepPattern', 'name priority steps')
+
+WARNING_PATTERN = BeepPattern('warning', 1, ((0.3, 0.8), (0.3, 1.0))) # 輕微、慢速蜂鳴
+CRITICAL_PATTERN = BeepPattern('critical', 2, ((0.1, 0.1), (0.1, 0.1), (0.1, 2.0))) # 快速、連續強烈蜂鳴
+
+_CANCEL = object()
+_STOP = object()
+
+
+def _count(pattern, result):
+    PATTERN_REQUESTS.labels(pattern.name, result).inc()
+
+
+class AlertScheduler:
+    """擁有 buzzer 的常駐線程；request() / cancel() 可由任何線程呼叫"""
+    def __init__(self, buzzer):
+        self._requests = queue.SimpleQueue()
+        try:
+            # 弱參照：排程器不延長 buzzer 的生命週期，buzzer 被回收時通知線程結束
+            self._buzzer = weakref.ref(buzzer)
+            weakref.finalize(buzzer, self._requests.put, _STOP)
+        except TypeError:
+            self._buzzer = lambda: buzzer # 不支援弱參照的物件 (例如 __slots__ 類別) 只能一直持有
+        self._thread = threading.Thread(target=self._run, name="alert-scheduler", daemon=True)
+        self.current = None # 目前播放中的 BeepPattern (僅由排程線程寫入)
+        self._thread.start()
+
+    @property
+    def buzzer(self):
+        """目前的 buzzer (已被回收時為 None)"""
+        return self._buzzer()
+
+    def request(self, pattern):
+        """要求播放一個蜂鳴模式 (立即返回)"""
+        self._requests.put(pattern)
+
+    def cancel(self):
+        """停止目前的模式並關閉蜂鳴器"""
+        self._requests.put(_CANCEL)
+
+    @property
+    def active_priority(self):
+        current = self.current
+        return current.priority if current is not None else 0
+
+    def close(self, timeout=1.0):
+        self._requests.put(_STOP)
+        self._thread.join(timeout)
+
+    # --- 排程線程 ---
+
+    def _timeline(self, pattern, start):
+        """將模式展開為 [(時間點, 蜂鳴器開/關), ...]，最後一項 None 表示模式結束"""
+        events = []
+        t = start
+        for on_sec, off_sec in pattern.steps:
+            events.append((t, True))
+            t += on_sec
+            events.append((t, False))
+            t += off_sec
+        events.append((t, None))
+        return events
+
+    def _run(self):
+        events = []
+        while True:
+            timeout = None
+            if events:
+                timeout = max(0.0, events[0][0] - time.monotonic())
+            try:
+                item = self._requests.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            buzzer = self.buzzer
+            if item is _STOP or buzzer is None:
+                if buzzer is not None:
+                    buzzer.off()
+                self.current = None
+                return
+            if item is _CANCEL:
+                buzzer.off()
+                self.current = None
+                events = []
+            elif item is not None:
+                if self.current is None:
+                    _count(item, 'played')
+                elif item.priority > self.current.priority:
+                    _count(self.current, 'preempted')
+                    _count(item, 'played')
+                    buzzer.off()
+                else:
+                    _count(item, 'ignored')
+                    item = None
+                if item is not None:
+                    self.current = item
+                    events = self._timeline(item, time.monotonic())
+
+            # 執行所有已到時間點的步驟
+            now = time.monotonic()
+            while events and events[0][0] <= now:
+                _, state = events.pop(0)
+                if state is None:
+                    self.current = None
+                elif state:
+                    buzzer.on()
+                else:
+                    buzzer.off()
+            buzzer = None # 等待下一個請求時不持有 buzzer，讓它可以被回收
+
+
+_schedulers = weakref.WeakKeyDictionary() # buzzer → 排程器，buzzer 被回收時自動移除
+_pinned_schedulers = {} # 不支援弱參照的 buzzer：id → 排程器 (排程器持有 buzzer，id 不會被重複使用)
+_schedulers_lock = threading.Lock()
+
+
+def get_scheduler(buzzer):
+    """取得 (必要時建立) 此 buzzer 專屬的排程器"""
+    try:
+        weakref.ref(buzzer)
+        registry, key = _schedulers, buzzer
+    except TypeError:
+        registry, key = _pinned_schedulers, id(buzzer)
+    with _schedulers_lock:
+        scheduler = registry.get(key)
+        if scheduler is None:
+            scheduler = registry[key] = AlertScheduler(buzzer)
+    return scheduler
+
+
+def close_schedulers():
+    """程式結束前停止所有排程器並關閉蜂鳴器"""
+    with _schedulers_lock:
+        schedulers = list(_schedulers.values()) + list(_pinned_schedulers.values())
+        _schedulers.clear()
+        _pinned_schedulers.clear()
+    for scheduler in schedulers:
+        scheduler.close()
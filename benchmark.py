@@ -0,0 +1,482 @@
+# -*- coding: utf-8 -*-
+"""
+benchmark.py
+離線重播與基準測試工具：不需要 PiCamera、蜂鳴器或顯示視窗，可在一般 Linux CI 上抓出效能回歸。
+
+  python benchmark.py frames <影片檔或圖片資料夾> [--max-frames N] [--save-trace trace.csv] [--json out.json]
+  python benchmark.py replay <trace.csv 或 trace.npz> [--fps 30]
+  python benchmark.py pose [--frames 2000] [--landmarks landmarks.npz] [--frame-ms 33.3]
+  python benchmark.py parallel <影片檔或圖片資料夾> [--workers 1,2,3] [--max-frames 300]
+  python benchmark.py backends <影片檔或圖片資料夾> [--detectors dlib_hog,haar] [--landmarkers dlib68,dlib_reduced]
+"""
+import argparse
+import csv
+import json
+import resource
+import sys
+import time
+
+import numpy as np
+
+from fatigue_utils import FatigueState, compute_face_metrics_batch, scoring_params
+from frame_pipeline import StageTimings, percentile
+
+FRAME_STAGES = ('gray', 'detect', 'predict', 'metrics', 'pose', 'score')
+
+
+class NullBuzzer:
+    """不發聲的蜂鳴器，避免重播時觸發硬體"""
+    def on(self): pass
+    def off(self): pass
+    def is_active(self): return False
+
+
+class AlertRecorder:
+    """取代 FatigueState.alert_logger，只記錄警報而不寫入雲端"""
+    def __init__(self):
+        self.alerts = []
+
+    def __call__(self, alert_type, score, details="", rider_id=None):
+        self.alerts.append({'alert_type': alert_type, 'score': score, 'details': details, 'rider_id': rider_id})
+
+    def counts(self):
+        result = {}
+        for alert in self.alerts:
+            result[alert['alert_type']] = result.get(alert['alert_type'], 0) + 1
+        return result
+
+
+def peak_rss_mb():
+    """目前程序的最大常駐記憶體 (MB，Linux 的 ru_maxrss 單位為 KB)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def summarize_ms(values):
+    ordered = sorted(values)
+    return {
+        'mean_ms': sum(ordered) / len(ordered) if ordered else 0.0,
+        'p50_ms': percentile(ordered, 50),
+        'p95_ms': percentile(ordered, 95),
+        'p99_ms': percentile(ordered, 99),
+    }
+
+
+# --- 1. 影像管線基準測試 ---
+
+def benchmark_frames(source_spec, max_frames=0, trace_path=None):
+    """依序 (不丟幀) 對每一幀執行完整分析，回傳各階段延遲、FPS 百分位數與記憶體"""
+    import fatigue_detection_system as fds
+    from frame_sources import open_frame_source
+
+    load_start = time.perf_counter()
+    fds.initialize_dlib()
+    load_ms = (time.perf_counter() - load_start) * 1000.0
+
+    state = FatigueState()
+    recorder = AlertRecorder()
+    state.alert_logger = recorder
+    timings = StageTimings(keep_samples=True)
+    frame_ms = []
+    faces = 0
+    trace_rows = []
+
+    with open_frame_source(source_spec, fds.RESOLUTION, fds.FRAME_RATE) as source:
+        fps = float(getattr(source, 'fps', fds.FRAME_RATE))
+        for capture_time, image in source.frames():
+            t0 = time.perf_counter()
+            result = fds.analyze_frame(image, state, capture_time, fps, timings)
+            frame_ms.append((time.perf_counter() - t0) * 1000.0)
+
+            has_face = result['landmarks'] is not None
+            faces += has_face
+            if trace_path:
+                trace_rows.append((capture_time, result['ear'], result['mar'], int(has_face)))
+            if max_frames and len(frame_ms) >= max_frames:
+                break
+
+    if trace_path:
+        save_trace(trace_path, trace_rows)
+
+    frame_summary = summarize_ms(frame_ms)
+    fps_values = sorted(1000.0 / ms for ms in frame_ms if ms > 0)
+    return {
+        'frames': len(frame_ms),
+        'face_rate': faces / float(len(frame_ms)) if frame_ms else 0.0,
+        'model_load_ms': load_ms,
+        'stages': {stage: dict(timings.percentiles(stage)) for stage in FRAME_STAGES},
+        'frame': frame_summary,
+        # FPS 的低百分位代表最慢的幀
+        'fps': {'p5': percentile(fps_values, 5), 'p50': percentile(fps_values, 50), 'p95': percentile(fps_values, 95)},
+        'detect_calls': fds.localizer.detections,
+        'tracked_frames': fds.localizer.tracked_frames,
+        'alerts': recorder.counts(),
+        'final_score': state.current_score,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+# --- 2. EAR/MAR 軌跡重播 ---
+
+def save_trace(path, rows):
+    """將 (timestamp, ear, mar, face) 寫入 CSV 軌跡檔"""
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['timestamp', 'ear', 'mar', 'face'])
+        for timestamp, ear, mar, face in rows:
+            writer.writerow([f"{timestamp:.4f}", f"{ear:.5f}", f"{mar:.5f}", face])
+
+
+def load_trace(path):
+    """
+    讀取軌跡檔，回傳 (timestamps, ear, mar) 三個陣列 (只包含有人臉的幀)。
+    CSV: timestamp, ear, mar[, face]
+    NPZ: timestamps + (ear, mar) 或 landmarks (N, 68, 2)
+    """
+    if path.endswith('.npz'):
+        data = np.load(path)
+        timestamps = np.asarray(data['timestamps'], dtype=np.float64)
+        if 'landmarks' in data:
+            _, _, ear, mar = compute_face_metrics_batch(data['landmarks'])
+        else:
+            ear = np.asarray(data['ear'], dtype=np.float64)
+            mar = np.asarray(data['mar'], dtype=np.float64)
+        face = np.asarray(data['face'], dtype=bool) if 'face' in data else np.ones(len(timestamps), dtype=bool)
+        return timestamps[face], ear[face], mar[face]
+
+    timestamps, ears, mars = [], [], []
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            if row.get('face', '1') in ('0', ''):
+                continue
+            timestamps.append(float(row['timestamp']))
+            ears.append(float(row['ear']))
+            mars.append(float(row['mar']))
+    return np.array(timestamps), np.array(ears), np.array(mars)
+
+
+def replay_trace(timestamps, ears, mars, fps=None, state=None):
+    """將 EAR/MAR 軌跡直接餵入 FatigueState，回傳計分結果與 update_score_and_alert 的延遲"""
+    if fps is None:
+        steps = np.diff(timestamps)
+        fps = 1.0 / float(np.median(steps)) if len(steps) and np.median(steps) > 0 else 30.0
+
+    state = state or FatigueState()
+    recorder = AlertRecorder()
+    state.alert_logger = recorder
+    buzzer = NullBuzzer()
+    call_ms = []
+    min_score = state.current_score
+
+    for t, ear, mar in zip(timestamps.tolist(), ears.tolist(), mars.tolist()):
+        t0 = time.perf_counter()
+        score = state.update_score_and_alert(ear, mar, t, fps, buzzer)
+        call_ms.append((time.perf_counter() - t0) * 1000.0)
+        min_score = min(min_score, score)
+
+    return {
+        'frames': len(call_ms),
+        'fps': fps,
+        'update_score_and_alert': summarize_ms(call_ms),
+        'alerts': recorder.counts(),
+        'final_score': state.current_score,
+        'min_score': min_score,
+        'perclos': state.eye_stats.perclos(),
+        'blinks_per_minute': state.eye_stats.blink_rate(),
+        'blink_duration_s': state.eye_stats.mean_blink_duration(),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+# --- 3. 頭部姿態基準測試 ---
+
+def benchmark_pose(frames=2000, landmarks=None, frame_ms=1000.0 / 30, seed=0):
+    """
+    量測 HeadPoseEstimator.estimate 的耗時 (占單幀預算的比例)。
+    未提供 landmarks 時以合成的連續頭部角度軌跡 (加入 1 像素雜訊) 同時量測角度誤差
+    """
+    from head_pose import HeadPoseEstimator, synthetic_landmarks
+
+    truth = None
+    if landmarks is None:
+        rng = np.random.default_rng(seed)
+        # 平滑的隨機角度軌跡：pitch ±25、yaw ±30、roll ±10 度
+        steps = rng.normal(0, 1.0, size=(frames, 3)).cumsum(axis=0)
+        truth = np.clip(steps * [0.5, 0.6, 0.2], [-25, -30, -10], [25, 30, 10])
+        landmarks = [synthetic_landmarks(*angles) + rng.normal(0, 1.0, size=(68, 2)) for angles in truth]
+
+    estimator = HeadPoseEstimator()
+    call_ms = []
+    estimates = []
+    for points in landmarks:
+        t0 = time.perf_counter()
+        pose = estimator.estimate(points, (480, 640))
+        call_ms.append((time.perf_counter() - t0) * 1000.0)
+        estimates.append(pose if pose is not None else (np.nan, np.nan, np.nan))
+
+    summary = summarize_ms(call_ms)
+    report = {
+        'frames': len(call_ms),
+        'estimate': summary,
+        'frame_budget_pct_p50': summary['p50_ms'] / frame_ms * 100.0,
+        'frame_budget_pct_p95': summary['p95_ms'] / frame_ms * 100.0,
+    }
+    if truth is not None:
+        error = np.abs(np.array(estimates) - truth)
+        report['mean_abs_error_deg'] = dict(zip(('pitch', 'yaw', 'roll'), np.nanmean(error, axis=0).round(2).tolist()))
+    return report
+
+
+# --- 4. 多程序推論的擴展性 ---
+
+def benchmark_parallel(source_spec, workers_list=(1, 2, 3), max_frames=300):
+    """
+    以相同影像比較單線程與多程序推論：不丟幀、儘快送入，量測吞吐量 (FPS) 與每幀延遲 (送入 → 依序計分)，
+    並確認結果依送入順序交給 FatigueState
+    """
+    import fatigue_detection_system as fds
+    from frame_sources import open_frame_source
+
+    frames = []
+    with open_frame_source(source_spec, fds.RESOLUTION, fds.FRAME_RATE) as source:
+        for capture_time, image in source.frames():
+            frames.append((capture_time, image))
+            if max_frames and len(frames) >= max_frames:
+                break
+
+    report = {'frames': len(frames), 'runs': {}}
+    fds.initialize_dlib()
+    state = FatigueState()
+    state.alert_logger = AlertRecorder()
+    timings = StageTimings()
+    latency_ms = []
+    start = time.perf_counter()
+    for capture_time, image in frames:
+        t0 = time.perf_counter()
+        fds.analyze_frame(image, state, capture_time, fds.FRAME_RATE, timings)
+        latency_ms.append((time.perf_counter() - t0) * 1000.0)
+    elapsed = time.perf_counter() - start
+    report['runs']['sequential'] = {'fps': len(frames) / elapsed, 'latency': summarize_ms(latency_ms),
+                                    'alerts': state.alert_logger.counts()}
+
+    for workers in workers_list:
+        fds.initialize_dlib() # 重設追蹤狀態，再 fork 子程序
+        analyzer = fds.start_parallel_analyzer(workers)
+        state = FatigueState()
+        state.alert_logger = AlertRecorder()
+        latency_ms = []
+        emitted = []
+
+        def consume():
+            seq, (capture_time, submit_time), measurement, stages = analyzer.get()
+            fds.score_frame(measurement, state, capture_time, fds.FRAME_RATE, timings)
+            latency_ms.append((time.perf_counter() - submit_time) * 1000.0)
+            emitted.append(seq)
+
+        try:
+            start = time.perf_counter()
+            for capture_time, image in frames:
+                slot = analyzer.acquire_slot(timeout=0)
+                while slot is None:
+                    consume()
+                    slot = analyzer.acquire_slot(timeout=0)
+                analyzer.submit(slot, image, (capture_time, time.perf_counter()))
+            while analyzer.in_flight:
+                consume()
+            elapsed = time.perf_counter() - start
+        finally:
+            analyzer.close()
+        report['runs'][f"workers_{workers}"] = {
+            'fps': len(frames) / elapsed,
+            'speedup': (len(frames) / elapsed) / report['runs']['sequential']['fps'],
+            'latency': summarize_ms(latency_ms),
+            'in_order': emitted == sorted(emitted) and len(emitted) == len(frames),
+            'errors': analyzer.errors,
+            'alerts': state.alert_logger.counts(),
+        }
+    return report
+
+
+# --- 5. 偵測 / 地標後端比較 ---
+
+def current_rss_mb():
+    """目前常駐記憶體 (MB)；讀取 /proc/self/statm，非 Linux 時以最大常駐記憶體代替"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 1e6
+    except (OSError, IndexError, ValueError):
+        return peak_rss_mb()
+
+
+def run_backend(detector, landmarker, grays, detect_scale):
+    """每幀都執行完整偵測 (不追蹤)，回傳各幀的 (EAR, MAR) 或 None 與耗時"""
+    from face_localizer import FaceLocalizer
+    from fatigue_utils import compute_face_metrics
+
+    localizer = FaceLocalizer(detector, detect_scale=detect_scale, tracking=False)
+    metrics, detect_ms, landmark_ms = [], [], []
+    for gray in grays:
+        t0 = time.perf_counter()
+        rect = localizer.locate(gray)
+        t1 = time.perf_counter()
+        detect_ms.append((t1 - t0) * 1000.0)
+        if rect is None:
+            metrics.append(None)
+            continue
+        landmarks = landmarker.landmarks(gray, rect)
+        landmark_ms.append((time.perf_counter() - t1) * 1000.0)
+        _, _, ear, mar = compute_face_metrics(landmarks)
+        metrics.append((ear, mar))
+    return metrics, detect_ms, landmark_ms
+
+
+def benchmark_backends(source_spec, detectors=('dlib_hog', 'haar', 'opencv_dnn'), landmarkers=('dlib68', 'dlib_reduced'),
+                       max_frames=300, reference=('dlib_hog', 'dlib68')):
+    """
+    以同一批影像比較各後端組合：模型載入時間、常駐記憶體增量、偵測 / 地標耗時、人臉偵測率，
+    以及相對參考組合 (dlib_hog + dlib68，即目前的 EAR 計算方式) 的 EAR/MAR 平均絕對誤差與閉眼判斷一致率。
+    模型檔不存在的組合會列出錯誤並略過
+    """
+    import cv2
+    import fatigue_detection_system as fds
+    from face_backends import create_detector, create_landmarker
+    from frame_sources import open_frame_source
+
+    grays = []
+    with open_frame_source(source_spec, fds.RESOLUTION, fds.FRAME_RATE) as source:
+        for _, image in source.frames():
+            grays.append(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY))
+            if max_frames and len(grays) >= max_frames:
+                break
+
+    combos = [reference] + [(d, l) for d in detectors for l in landmarkers if (d, l) != reference]
+    closed_threshold = scoring_params()['CLOSED_EAR_THRESHOLD']
+    results = {}
+    reference_metrics = None
+    for detector_name, landmarker_name in combos:
+        name = f"{detector_name}+{landmarker_name}"
+        rss_before = current_rss_mb()
+        load_start = time.perf_counter()
+        try:
+            detector = create_detector(detector_name)
+            landmarker = create_landmarker(landmarker_name)
+        except Exception as e:
+            results[name] = {'error': str(e)}
+            continue
+        load_ms = (time.perf_counter() - load_start) * 1000.0
+        rss_delta = current_rss_mb() - rss_before
+
+        try:
+            metrics, detect_ms, landmark_ms = run_backend(detector, landmarker, grays, fds.DETECT_SCALE)
+        except Exception as e:
+            results[name] = {'error': str(e)}
+            continue
+        report = {
+            'model_load_ms': load_ms,
+            'rss_delta_mb': rss_delta,
+            'face_rate': sum(m is not None for m in metrics) / float(len(metrics)) if metrics else 0.0,
+            'detect': summarize_ms(detect_ms),
+            'landmarks': summarize_ms(landmark_ms) if landmark_ms else None,
+        }
+        if reference_metrics is None:
+            reference_metrics = metrics
+        else:
+            pairs = [(m, r) for m, r in zip(metrics, reference_metrics) if m is not None and r is not None]
+            if pairs:
+                values = np.array([m + r for m, r in pairs]) # ear, mar, ref_ear, ref_mar
+                report['ear_mae'] = float(np.abs(values[:, 0] - values[:, 2]).mean())
+                report['mar_mae'] = float(np.abs(values[:, 1] - values[:, 3]).mean())
+                report['closed_agreement'] = float(((values[:, 0] < closed_threshold) == (values[:, 2] < closed_threshold)).mean())
+            report['compared_frames'] = len(pairs)
+        results[name] = report
+        del detector, landmarker
+    return {'frames': len(grays), 'reference': '+'.join(reference), 'backends': results}
+
+
+def print_backends_report(report):
+    print(f"[BENCH] frames: {report['frames']}  reference: {report['reference']}")
+    print(f"[BENCH] {'backend':<24}{'load ms':>9}{'RSS MB':>8}{'detect p50':>12}{'lmk p50':>9}{'faces':>7}{'EAR MAE':>9}{'MAR MAE':>9}{'closed':>8}")
+    for name, r in report['backends'].items():
+        if 'error' in r:
+            print(f"[BENCH] {name:<24} 無法載入: {r['error']}")
+            continue
+        lmk = f"{r['landmarks']['p50_ms']:.2f}" if r['landmarks'] else '--'
+        ear = f"{r['ear_mae']:.4f}" if 'ear_mae' in r else '--'
+        mar = f"{r['mar_mae']:.4f}" if 'mar_mae' in r else '--'
+        closed = f"{r['closed_agreement'] * 100:.1f}%" if 'closed_agreement' in r else '--'
+        print(f"[BENCH] {name:<24}{r['model_load_ms']:9.0f}{r['rss_delta_mb']:8.1f}{r['detect']['p50_ms']:12.2f}"
+              f"{lmk:>9}{r['face_rate'] * 100:6.1f}%{ear:>9}{mar:>9}{closed:>8}")
+
+
+def print_report(report):
+    stages = report.get('stages', {})
+    for stage in FRAME_STAGES:
+        if stage in stages:
+            p = stages[stage]
+            print(f"[BENCH] {stage:<8} p50 {p[50]:7.2f}ms  p95 {p[95]:7.2f}ms  p99 {p[99]:7.2f}ms")
+    for key, value in report.items():
+        if key != 'stages':
+            print(f"[BENCH] {key}: {value}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="疲勞偵測管線的離線重播與基準測試")
+    parser.add_argument('--json', help="將結果寫入 JSON 檔 (供 CI 比較)")
+    sub = parser.add_subparsers(dest='command')
+
+    frames_parser = sub.add_parser('frames', help="以影片檔或圖片資料夾量測完整管線")
+    frames_parser.add_argument('source')
+    frames_parser.add_argument('--max-frames', type=int, default=0)
+    frames_parser.add_argument('--save-trace', help="同時輸出 EAR/MAR 軌跡 CSV")
+    frames_parser.add_argument('--budget-ms', type=float, default=0, help="單幀 p95 超過此值時以非零狀態結束")
+
+    replay_parser = sub.add_parser('replay', help="將 EAR/MAR 或地標軌跡重播進 FatigueState")
+    replay_parser.add_argument('trace')
+    replay_parser.add_argument('--fps', type=float, default=None)
+
+    pose_parser = sub.add_parser('pose', help="量測頭部姿態估計的耗時與角度誤差")
+    pose_parser.add_argument('--frames', type=int, default=2000, help="合成地標的幀數")
+    pose_parser.add_argument('--landmarks', help="改用實際地標 (含 landmarks (N, 68, 2) 的 NPZ 檔)")
+    pose_parser.add_argument('--frame-ms', type=float, default=1000.0 / 30, help="單幀預算 (預設 30 FPS)")
+
+    parallel_parser = sub.add_parser('parallel', help="比較單線程與多程序推論的吞吐量、延遲與計分順序")
+    parallel_parser.add_argument('source')
+    parallel_parser.add_argument('--workers', default='1,2,3', help="逗號分隔的子程序數")
+    parallel_parser.add_argument('--max-frames', type=int, default=300)
+
+    backends_parser = sub.add_parser('backends', help="比較人臉偵測 / 地標後端的速度、記憶體與 EAR 準確度")
+    backends_parser.add_argument('source')
+    backends_parser.add_argument('--max-frames', type=int, default=300)
+    backends_parser.add_argument('--detectors', default='dlib_hog,haar,opencv_dnn')
+    backends_parser.add_argument('--landmarkers', default='dlib68,dlib_reduced')
+
+    args = parser.parse_args()
+    if args.command == 'frames':
+        report = benchmark_frames(args.source, args.max_frames, args.save_trace)
+    elif args.command == 'replay':
+        report = replay_trace(*load_trace(args.trace), fps=args.fps)
+    elif args.command == 'pose':
+        landmarks = np.load(args.landmarks)['landmarks'].astype(np.float64) if args.landmarks else None
+        report = benchmark_pose(args.frames, landmarks, args.frame_ms)
+    elif args.command == 'parallel':
+        report = benchmark_parallel(args.source, [int(n) for n in args.workers.split(',')], args.max_frames)
+    elif args.command == 'backends':
+        report = benchmark_backends(args.source, args.detectors.split(','), args.landmarkers.split(','), args.max_frames)
+    else:
+        parser.print_help()
+        sys.exit(2)
+
+    if args.command == 'backends':
+        print_backends_report(report)
+    elif args.command == 'parallel':
+        for name, run in report['runs'].items():
+            print(f"[BENCH] {name:<12} {run['fps']:7.1f} FPS  latency p50 {run['latency']['p50_ms']:6.1f}ms  "
+                  f"p95 {run['latency']['p95_ms']:6.1f}ms  speedup {run.get('speedup', 1.0):.2f}x  in order: {run.get('in_order', True)}")
+    else:
+        print_report(report)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=4)
+
+    if args.command == 'frames' and args.budget_ms and report['frame']['p95_ms'] > args.budget_ms:
+        print(f"[BENCH] 單幀 p95 {report['frame']['p95_ms']:.1f}ms 超過預算 {args.budget_ms}ms")
+        sys.exit(1)
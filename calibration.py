@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+calibration.py
+每位騎士的 EAR/MAR 閾值校準：騎乘開始的前幾分鐘收集有人臉的樣本，
+以固定分格的串流直方圖估計睜眼 EAR 與閉嘴 MAR 的基準值 (中位數)，換算成閉眼 / 哈欠閾值；
+之後以 EWMA 緩慢追蹤基準值變化 (光線、配戴位置)，並依騎士 ID 保存，下次啟動直接載入。
+
+  python calibration.py show                     # 列出已保存的閾值
+  python calibration.py reset <騎士 ID>          # 刪除某位騎士的閾值，下次騎乘重新校準
+  python calibration.py trace <trace.csv> [--rider ID] [--save]   # 以 EAR/MAR 軌跡離線校準
+"""
+import argparse
+import json
+import threading
+import time
+
+import numpy as np
+
+from risk_channel import write_json_atomic
+
+THRESHOLDS_PATH = 'rider_thresholds.json' # 每位騎士的校準結果
+CALIBRATION_SEC = 120.0 # 校準階段長度 (有人臉的秒數)
+CALIBRATION_MIN_SAMPLES = 600 # 校準階段至少需要的樣本數
+EAR_CLOSED_RATIO = 0.73 # 閉眼閾值 = 睜眼 EAR 基準 x 0.73 (預設 0.22 ≈ 0.30 x 0.73)
+YAWN_MAR_MARGIN = 0.10 # 哈欠閾值 = 閉嘴 MAR 基準 + 0.10
+EAR_THRESHOLD_RANGE = (0.12, 0.32) # 閾值的合理範圍，避免異常資料造成常態誤報或漏報
+MAR_THRESHOLD_RANGE = (0.08, 0.50)
+BASELINE_HALF_LIFE_SEC = 600.0 # 校準後 EWMA 基準值的半衰期 (10 分鐘)
+BASELINE_MAX_DRIFT = 0.2 # 基準值最多偏離校準值 ±20%
+SAVE_INTERVAL_SEC = 300.0 # 校準後每 5 分鐘保存一次
+
+
+class StreamingHistogram:
+    """固定分格的串流直方圖：記憶體固定，可估計任意百分位數 (誤差不超過一格寬度)"""
+    __slots__ = ('lo', 'hi', 'bins', 'counts', 'count')
+
+    def __init__(self, lo, hi, bins):
+        self.lo = lo
+        self.hi = hi
+        self.bins = bins
+        self.counts = np.zeros(bins, dtype=np.int64)
+        self.count = 0
+
+    def add(self, value):
+        index = int((value - self.lo) / (self.hi - self.lo) * self.bins)
+        self.counts[min(max(index, 0), self.bins - 1)] += 1
+        self.count += 1
+
+    def quantile(self, q):
+        """q 介於 0~1；沒有樣本時回傳 None"""
+        if not self.count:
+            return None
+        cumulative = np.cumsum(self.counts)
+        index = int(np.searchsorted(cumulative, q * self.count))
+        return self.lo + (index + 0.5) * (self.hi - self.lo) / self.bins
+
+
+def thresholds_from_baseline(ear_baseline, mar_baseline):
+    """由睜眼 EAR 與閉嘴 MAR 基準值換算閾值 (限制在合理範圍內)"""
+    ear_threshold = min(max(ear_baseline * EAR_CLOSED_RATIO, EAR_THRESHOLD_RANGE[0]), EAR_THRESHOLD_RANGE[1])
+    mar_threshold = min(max(mar_baseline + YAWN_MAR_MARGIN, MAR_THRESHOLD_RANGE[0]), MAR_THRESHOLD_RANGE[1])
+    return ear_threshold, mar_threshold
+
+
+def load_thresholds(path=THRESHOLDS_PATH):
+    """讀取所有騎士的校準結果 {rider_id: {...}}；檔案不存在或損毀時回傳空 dict"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+_save_lock = threading.Lock()
+
+
+def save_thresholds(rider_id, record, path=THRESHOLDS_PATH):
+    """更新單一騎士的校準結果 (讀取 → 合併 → 原子寫入)"""
+    with _save_lock:
+        data = load_thresholds(path)
+        data[rider_id] = record
+        write_json_atomic(path, data)
+
+
+class ThresholdCalibrator:
+    """
+    掛在 FatigueState 上，每幀以 observe() 更新；
+    校準完成或基準值改變時直接修改 state 的 CLOSED_EAR_THRESHOLD / YAWN_MAR_THRESHOLD
+    """
+    def __init__(self, rider_id, path=THRESHOLDS_PATH, persist=True):
+        self.rider_id = rider_id
+        self.path = path
+        self.persist = persist
+        self.ear_hist = StreamingHistogram(0.0, 0.6, 600)
+        self.mar_hist = StreamingHistogram(0.0, 1.0, 500)
+        self.calibrated_seconds = 0.0
+        self.last_time = None
+        self.last_save = None
+        self.record = load_thresholds(path).get(rider_id) if persist else None
+        self.calibrated = self.record is not None
+        self._applied = False
+
+    def apply(self, state):
+        """將已保存 / 已校準的閾值套用到 FatigueState"""
+        if self.record is not None:
+            state.CLOSED_EAR_THRESHOLD = self.record['ear_threshold']
+            state.YAWN_MAR_THRESHOLD = self.record['mar_threshold']
+
+    def observe(self, state, ear, mar, current_time):
+        if not self._applied:
+            self.apply(state)
+            self._applied = True
+            if self.calibrated:
+                print(f"\n[CALIB] 載入 {self.rider_id} 的閾值: EAR < {state.CLOSED_EAR_THRESHOLD:.3f}, MAR > {state.YAWN_MAR_THRESHOLD:.3f}\n", end="")
+
+        dt = 0.0
+        if self.last_time is not None:
+            dt = current_time - self.last_time
+            if dt > 1.0 or dt < 0:
+                dt = 0.0 # 人臉遺失的空白不列入
+        self.last_time = current_time
+
+        if not self.calibrated:
+            self.ear_hist.add(ear)
+            self.mar_hist.add(mar)
+            self.calibrated_seconds += dt
+            if self.calibrated_seconds >= CALIBRATION_SEC and self.ear_hist.count >= CALIBRATION_MIN_SAMPLES:
+                self._finish_calibration(state, current_time)
+            return
+
+        # 校準後：只以睜眼 / 閉嘴的樣本緩慢追蹤基準值
+        record = self.record
+        alpha = 1.0 - 0.5 ** (dt / BASELINE_HALF_LIFE_SEC) if dt else 0.0
+        if alpha:
+            if ear >= state.CLOSED_EAR_THRESHOLD:
+                record['ear_baseline'] = self._drift(record['ear_baseline'] + alpha * (ear - record['ear_baseline']),
+                                                     record['ear_calibrated'])
+            if mar <= state.YAWN_MAR_THRESHOLD:
+                record['mar_baseline'] = self._drift(record['mar_baseline'] + alpha * (mar - record['mar_baseline']),
+                                                     record['mar_calibrated'])
+            record['ear_threshold'], record['mar_threshold'] = thresholds_from_baseline(record['ear_baseline'], record['mar_baseline'])
+            state.CLOSED_EAR_THRESHOLD = record['ear_threshold']
+            state.YAWN_MAR_THRESHOLD = record['mar_threshold']
+
+        if self.last_save is None:
+            self.last_save = current_time
+        if self.persist and current_time - self.last_save >= SAVE_INTERVAL_SEC:
+            self._save(current_time)
+
+    @staticmethod
+    def _drift(value, calibrated):
+        return min(max(value, calibrated * (1 - BASELINE_MAX_DRIFT)), calibrated * (1 + BASELINE_MAX_DRIFT))
+
+    def _finish_calibration(self, state, current_time):
+        ear_baseline = self.ear_hist.quantile(0.5)
+        mar_baseline = self.mar_hist.quantile(0.5)
+        ear_threshold, mar_threshold = thresholds_from_baseline(ear_baseline, mar_baseline)
+        self.record = {
+            'ear_baseline': ear_baseline, 'ear_calibrated': ear_baseline, 'ear_threshold': ear_threshold,
+            'mar_baseline': mar_baseline, 'mar_calibrated': mar_baseline, 'mar_threshold': mar_threshold,
+            'samples': self.ear_hist.count,
+        }
+        self.calibrated = True
+        self.apply(state)
+        print(f"\n[CALIB] {self.rider_id} 校準完成: 睜眼 EAR {ear_baseline:.3f} → 閉眼閾值 {ear_threshold:.3f}，"
+              f"閉嘴 MAR {mar_baseline:.3f} → 哈欠閾值 {mar_threshold:.3f}\n", end="")
+        if self.persist:
+            self._save(current_time)
+
+    def _save(self, current_time):
+        self.last_save = current_time
+        record = dict(self.record, updated=time.strftime('%Y-%m-%d %H:%M:%S'))
+
+        def save():
+            try:
+                save_thresholds(self.rider_id, record, self.path)
+            except Exception as e:
+                print(f"\n[CALIB ERROR] 閾值保存失敗: {e}\n", end="")
+        # 在背景寫檔，不阻塞推論線程
+        threading.Thread(target=save, daemon=True).start()
+
+
+def calibrate_trace(ears, mars):
+    """離線校準：以整段 EAR/MAR 軌跡估計基準值與閾值"""
+    ear_baseline = float(np.median(ears))
+    mar_baseline = float(np.median(mars))
+    ear_threshold, mar_threshold = thresholds_from_baseline(ear_baseline, mar_baseline)
+    return {'ear_baseline': ear_baseline, 'ear_calibrated': ear_baseline, 'ear_threshold': ear_threshold,
+            'mar_baseline': mar_baseline, 'mar_calibrated': mar_baseline, 'mar_threshold': mar_threshold,
+            'samples': len(ears)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="騎士 EAR/MAR 閾值校準")
+    parser.add_argument('--path', default=THRESHOLDS_PATH)
+    sub = parser.add_subparsers(dest='command')
+    sub.add_parser('show', help="列出已保存的閾值")
+    reset_parser = sub.add_parser('reset', help="刪除某位騎士的閾值")
+    reset_parser.add_argument('rider')
+    trace_parser = sub.add_parser('trace', help="以 EAR/MAR 軌跡 (benchmark.py --save-trace) 離線校準")
+    trace_parser.add_argument('trace')
+    trace_parser.add_argument('--rider', default=None)
+    trace_parser.add_argument('--save', action='store_true', help="保存結果 (需指定 --rider)")
+    args = parser.parse_args()
+
+    if args.command == 'show':
+        for rider_id, record in sorted(load_thresholds(args.path).items()):
+            print(f"{rider_id}: EAR < {record['ear_threshold']:.3f} (基準 {record['ear_baseline']:.3f}), "
+                  f"MAR > {record['mar_threshold']:.3f} (基準 {record['mar_baseline']:.3f}), 更新於 {record.get('updated', '--')}")
+    elif args.command == 'reset':
+        data = load_thresholds(args.path)
+        if data.pop(args.rider, None) is None:
+            print(f"[CALIB] 找不到 {args.rider} 的閾值。")
+        else:
+            write_json_atomic(args.path, data)
+            print(f"[CALIB] 已刪除 {args.rider} 的閾值，下次騎乘會重新校準。")
+    elif args.command == 'trace':
+        from benchmark import load_trace
+        _, ears, mars = load_trace(args.trace)
+        record = calibrate_trace(ears, mars)
+        print(json.dumps(record, indent=4))
+        if args.save:
+            if not args.rider:
+                parser.error("--save 需要指定 --rider")
+            save_thresholds(args.rider, dict(record, updated=time.strftime('%Y-%m-%d %H:%M:%S')), args.path)
+    else:
+        parser.print_help()
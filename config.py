@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+config.py
+統一設定：各模組的常數 (與 FatigueState 的閾值) 保留為預設值，啟動時以設定檔與環境變數覆寫，
+型別以預設值為準 (int / float / bool / str / list / dict)，型別不符的設定會被忽略並輸出錯誤。
+
+  設定檔 (JSON，路徑為環境變數 FATIGUE_CONFIG，預設 fatigue_config.json)，依段落分組：
+    {"scoring": {"CLOSED_EAR_THRESHOLD": 0.20}, "detector": {"BUZZER_PIN": 19}, "web": {"REFRESH_INTERVAL_SEC": 30}}
+  環境變數 (優先於設定檔)：FATIGUE_<段落>__<名稱>，值以 JSON 解析 (失敗時視為字串)
+    FATIGUE_SCORING__CLOSED_EAR_THRESHOLD=0.20  FATIGUE_LOGGING__FIELD_IDS='{"RIDER_ID": "entry.123"}'
+
+段落：detector (fatigue_detection_system)、scoring (FatigueState)、logging (firestore_logging)、
+tts (tts_service)、web (web_server)。
+start_config_watcher() 每 CONFIG_POLL_SEC 秒檢查設定檔，修改後重新載入：
+register_config() 時列為 hot 的項目 (計分閾值、間隔、端點) 立即生效，其餘項目需重新啟動。
+"""
+import json
+import os
+import threading
+import time
+
+CONFIG_PATH = os.environ.get('FATIGUE_CONFIG', 'fatigue_config.json')
+ENV_PREFIX = 'FATIGUE_'
+CONFIG_POLL_SEC = 5.0 # 設定檔 mtime 檢查間隔
+
+_MISSING = object()
+_lock = threading.RLock()
+_config = None # 目前生效的 {段落: {名稱: 值}}
+_defaults = {} # {段落: {名稱: 原始預設值}}，設定項被刪除時還原
+_targets = [] # register_config() 登記的 (段落, 目標, hot)
+_resolved = {} # config_overrides() 的快取 {段落: {名稱: 已轉換的值}}，重新載入時清除
+_watcher = None
+
+
+def _parse_env_value(raw):
+    try:
+        return json.loads(raw)
+    except ValueError:
+        return raw
+
+
+def load_config(path=CONFIG_PATH, environ=None):
+    """讀取設定檔並套用環境變數覆寫，回傳 {段落: {名稱: 值}}；設定檔不存在時只有環境變數"""
+    config = {}
+    if path and os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if not isinstance(data, dict):
+            raise ValueError(f"{path} 的最上層必須是 {{段落: {{名稱: 值}}}}")
+        for section, values in data.items():
+            if not isinstance(values, dict):
+                raise ValueError(f"{path} 的段落 {section} 必須是物件")
+            config[section.lower()] = dict(values)
+
+    environ = os.environ if environ is None else environ
+    for key, raw in environ.items():
+        if not key.startswith(ENV_PREFIX) or '__' not in key:
+            continue
+        section, _, name = key[len(ENV_PREFIX):].partition('__')
+        if section and name:
+            config.setdefault(section.lower(), {})[name.upper()] = _parse_env_value(raw)
+    return config
+
+
+def current_config():
+    """目前生效的設定 (第一次呼叫時載入)"""
+    global _config
+    with _lock:
+        if _config is None:
+            try:
+                _config = load_config()
+            except (OSError, ValueError) as e:
+                print(f"[CONFIG] 無法讀取設定檔 {CONFIG_PATH}，使用預設值: {e}")
+                _config = load_config(None)
+            if os.path.exists(CONFIG_PATH):
+                print(f"[CONFIG] 已載入 {CONFIG_PATH}")
+        return _config
+
+
+def coerce(value, default):
+    """依預設值的型別轉換設定值，型別不符時拋出 ValueError"""
+    if default is None or value is None:
+        return value
+    kind = type(default)
+    if kind is bool:
+        if isinstance(value, str) and value.strip().lower() in ('1', 'true', 'yes', 'on', '0', 'false', 'no', 'off'):
+            return value.strip().lower() in ('1', 'true', 'yes', 'on')
+        if isinstance(value, (bool, int)):
+            return bool(value)
+    elif kind in (int, float):
+        if isinstance(value, (int, float)) and not isinstance(value, bool) and (kind is float or value == int(value)):
+            return kind(value)
+    elif kind in (list, tuple):
+        if isinstance(value, (list, tuple)):
+            return kind(value)
+    elif kind is dict:
+        # 只需列出要修改的鍵 (例如 FIELD_IDS 中的單一欄位)
+        if isinstance(value, dict):
+            return dict(default, **value)
+    elif isinstance(value, kind):
+        return value
+    raise ValueError(f"需要 {kind.__name__}，實際為 {value!r}")
+
+
+def _has(target, name):
+    return name in target if isinstance(target, dict) else hasattr(target, name)
+
+
+def _get(target, name):
+    return target[name] if isinstance(target, dict) else getattr(target, name)
+
+
+def _set(target, name, value):
+    if isinstance(target, dict):
+        target[name] = value
+    else:
+        setattr(target, name, value)
+
+
+def apply_config(target, section, names=None, hot=None, config=None):
+    """
+    將設定的 section 段落套用到 target (模組的 globals() 或物件)，回傳 [(名稱, 舊值, 新值)]
+    names: 只套用這些名稱 (重新載入時為有變動的項目)；None 為段落中的所有項目
+    hot: None 表示啟動時全部套用；否則只套用其中的名稱，其他項目提示需重新啟動
+    """
+    values = (config if config is not None else current_config()).get(section, {})
+    changed = []
+    with _lock:
+        defaults = _defaults.setdefault(section, {})
+        for name in (values if names is None else names):
+            if not _has(target, name):
+                print(f"[CONFIG] 未知的設定項目 {section}.{name}，已忽略")
+                continue
+            default = defaults.setdefault(name, _get(target, name))
+            try:
+                value = coerce(values.get(name, default), default)
+            except ValueError as e:
+                print(f"[CONFIG] {section}.{name} 設定值無效 ({e})，維持原值")
+                continue
+            old = _get(target, name)
+            if value == old:
+                continue
+            if hot is not None and name not in hot:
+                print(f"[CONFIG] {section}.{name} 需重新啟動才會生效")
+                continue
+            _set(target, name, value)
+            changed.append((name, old, value))
+    return changed
+
+
+def config_overrides(section, template):
+    """
+    段落中已驗證並轉換型別的覆寫值 {名稱: 值}，每次載入設定只解析一次 (未知 / 無效項目只提示一次)；
+    template 為提供預設值與型別的物件或 dict (例如 fatigue_utils.SCORING_DEFAULTS)。供大量建立的物件使用，避免每次都重新套用
+    """
+    with _lock:
+        cached = _resolved.get(section)
+        if cached is not None:
+            return cached
+        values = current_config().get(section, {})
+        defaults = _defaults.setdefault(section, {})
+        cached = {}
+        for name, value in values.items():
+            if not _has(template, name):
+                print(f"[CONFIG] 未知的設定項目 {section}.{name}，已忽略")
+                continue
+            default = defaults.setdefault(name, _get(template, name))
+            try:
+                cached[name] = coerce(value, default)
+            except ValueError as e:
+                print(f"[CONFIG] {section}.{name} 設定值無效 ({e})，使用預設值")
+        _resolved[section] = cached
+        return cached
+
+
+def register_config(section, target, hot=(), apply=True):
+    """
+    登記 target，之後重新載入時 hot 中的項目直接更新
+    apply: 是否立即套用目前設定 (target 已套用過時傳 False，例如 FatigueState 在建立時已套用)
+    """
+    if apply:
+        apply_config(target, section)
+    with _lock:
+        _targets.append((section, target, frozenset(hot)))
+    return target
+
+
+def reload_config(path=None):
+    """重新讀取設定檔，將有變動的項目套用到所有登記的目標，回傳變動項目數"""
+    global _config
+    try:
+        new = load_config(path or CONFIG_PATH)
+    except (OSError, ValueError) as e:
+        print(f"[CONFIG] 重新載入失敗，維持目前設定: {e}")
+        return 0
+    count = 0
+    with _lock:
+        old = current_config()
+        _config = new
+        _resolved.clear()
+        for section, target, hot in list(_targets):
+            before, after = old.get(section, {}), new.get(section, {})
+            names = sorted(name for name in set(before) | set(after)
+                           if before.get(name, _MISSING) != after.get(name, _MISSING))
+            for name, old_value, value in apply_config(target, section, names, hot, new):
+                print(f"[CONFIG] {section}.{name}: {old_value!r} → {value!r}")
+                count += 1
+    return count
+
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+def start_config_watcher(path=None, poll_sec=CONFIG_POLL_SEC):
+    """背景檢查設定檔 mtime，變動時 reload_config()；重複呼叫只會啟動一個線程"""
+    global _watcher
+    path = path or CONFIG_PATH
+    with _lock:
+        if _watcher is not None:
+            return _watcher
+        current_config()
+
+        def watch():
+            last = _mtime(path)
+            while True:
+                time.sleep(poll_sec)
+                mtime = _mtime(path)
+                if mtime != last:
+                    last = mtime
+                    reload_config(path)
+
+        _watcher = threading.Thread(target=watch, name='config-watcher', daemon=True)
+        _watcher.start()
+    return _watcher
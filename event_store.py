@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+event_store.py
+本地警報事件庫 (SQLite)：原始事件依騎士與時間建立索引，
+並在寫入時同步維護每小時 / 每日彙總，風險分析與儀表板直接讀取彙總桶，不需重新掃描原始紀錄。
+"""
+import json
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+
+EVENT_DB_PATH = 'fatigue_events.db'
+EVENT_RETENTION_DAYS = 60 # 原始事件保留天數 (彙總資料永久保留)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    rider_id TEXT NOT NULL,
+    ts TEXT NOT NULL,
+    alert_type TEXT NOT NULL,
+    score INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_events_rider_ts ON events (rider_id, ts);
+CREATE INDEX IF NOT EXISTS idx_events_ts ON events (ts);
+
+CREATE TABLE IF NOT EXISTS hourly (
+    rider_id TEXT NOT NULL,
+    bucket TEXT NOT NULL,
+    day TEXT NOT NULL,
+    hour INTEGER NOT NULL,
+    weekday INTEGER NOT NULL,
+    events INTEGER NOT NULL DEFAULT 0,
+    alerts INTEGER NOT NULL DEFAULT 0,
+    sleep INTEGER NOT NULL DEFAULT 0,
+    yawn INTEGER NOT NULL DEFAULT 0,
+    min_score INTEGER NOT NULL DEFAULT 100,
+    PRIMARY KEY (rider_id, bucket)
+);
+CREATE INDEX IF NOT EXISTS idx_hourly_rider_hour ON hourly (rider_id, hour, day);
+
+CREATE TABLE IF NOT EXISTS daily (
+    rider_id TEXT NOT NULL,
+    day TEXT NOT NULL,
+    weekday INTEGER NOT NULL,
+    events INTEGER NOT NULL DEFAULT 0,
+    alerts INTEGER NOT NULL DEFAULT 0,
+    sleep INTEGER NOT NULL DEFAULT 0,
+    yawn INTEGER NOT NULL DEFAULT 0,
+    min_score INTEGER NOT NULL DEFAULT 100,
+    PRIMARY KEY (rider_id, day)
+);
+
+CREATE TABLE IF NOT EXISTS riders (
+    rider_id TEXT PRIMARY KEY,
+    last_ts TEXT NOT NULL,
+    latest_score INTEGER NOT NULL,
+    total_alerts INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+TS_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def _alert_flags(alert_type):
+    """返回: (是否為警報, 是否為閉眼, 是否為哈欠)"""
+    is_alert = alert_type != 'SAFE'
+    return int(is_alert), int(is_alert and 'SLEEP' in alert_type), int(is_alert and 'YAWN' in alert_type)
+
+
+class EventStore:
+    """執行緒安全的事件庫；所有寫入在單一交易內完成 (事件 + 彙總 + meta)"""
+    def __init__(self, path=EVENT_DB_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+
+    # --- 寫入 ---
+
+    def add_events(self, events, meta=None, reset=False):
+        """
+        寫入事件並更新彙總。reset=True 時先清空舊資料 (整份重建)，與寫入在同一交易內完成。
+        events: 可迭代的 (datetime, record)，record 含 Timestamp / Alert Type / Safety Score / Rider_ID
+        meta: 同一交易內一併寫入的 {key: value} (例如 CSV 讀取位置)
+        """
+        with self._lock, self._db:
+            if reset:
+                self._clear()
+            for dt, rec in events:
+                rider_id = rec['Rider_ID']
+                alert_type = rec['Alert Type']
+                score = rec['Safety Score']
+                ts = dt.strftime(TS_FORMAT)
+                day = ts[:10]
+                is_alert, is_sleep, is_yawn = _alert_flags(alert_type)
+
+                self._db.execute("INSERT INTO events (rider_id, ts, alert_type, score) VALUES (?, ?, ?, ?)",
+                                 (rider_id, ts, alert_type, score))
+                self._db.execute(
+                    "INSERT INTO hourly (rider_id, bucket, day, hour, weekday, events, alerts, sleep, yawn, min_score) "
+                    "VALUES (?, ?, ?, ?, ?, 1, ?, ?, ?, ?) "
+                    "ON CONFLICT (rider_id, bucket) DO UPDATE SET events = events + 1, "
+                    "alerts = alerts + excluded.alerts, sleep = sleep + excluded.sleep, yawn = yawn + excluded.yawn, "
+                    "min_score = MIN(min_score, excluded.min_score)",
+                    (rider_id, ts[:13], day, dt.hour, dt.weekday(), is_alert, is_sleep, is_yawn, score))
+                self._db.execute(
+                    "INSERT INTO daily (rider_id, day, weekday, events, alerts, sleep, yawn, min_score) "
+                    "VALUES (?, ?, ?, 1, ?, ?, ?, ?) "
+                    "ON CONFLICT (rider_id, day) DO UPDATE SET events = events + 1, "
+                    "alerts = alerts + excluded.alerts, sleep = sleep + excluded.sleep, yawn = yawn + excluded.yawn, "
+                    "min_score = MIN(min_score, excluded.min_score)",
+                    (rider_id, day, dt.weekday(), is_alert, is_sleep, is_yawn, score))
+                # 最新分數以時間較晚者為準 (紀錄可能不依序到達)
+                self._db.execute(
+                    "INSERT INTO riders (rider_id, last_ts, latest_score, total_alerts) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (rider_id) DO UPDATE SET total_alerts = total_alerts + excluded.total_alerts, "
+                    "latest_score = CASE WHEN excluded.last_ts >= last_ts THEN excluded.latest_score ELSE latest_score END, "
+                    "last_ts = MAX(last_ts, excluded.last_ts)",
+                    (rider_id, ts, score, is_alert))
+
+            for key, value in (meta or {}).items():
+                self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                                 (key, json.dumps(value, ensure_ascii=False)))
+
+    def clear(self):
+        """清空所有事件與彙總 (來源試算表被改寫、需要整份重建時)"""
+        with self._lock, self._db:
+            self._clear()
+
+    def _clear(self):
+        for table in ('events', 'hourly', 'daily', 'riders'):
+            self._db.execute(f"DELETE FROM {table}")
+
+    def prune(self, now=None):
+        """刪除超過保留期限的原始事件，彙總資料不受影響"""
+        cutoff = ((now or datetime.now()) - timedelta(days=EVENT_RETENTION_DAYS)).strftime(TS_FORMAT)
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM events WHERE ts < ?", (cutoff,))
+
+    def get_meta(self, key, default=None):
+        with self._lock:
+            row = self._db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row['value']) if row else default
+
+    # --- 查詢 ---
+
+    def hour_bucket(self, rider_id, day, hour):
+        """單一騎士某天某小時的彙總；沒有紀錄時回傳全 0"""
+        with self._lock:
+            row = self._db.execute("SELECT events, alerts, sleep, yawn FROM hourly WHERE rider_id = ? AND bucket = ?",
+                                   (rider_id, f"{day} {hour:02d}")).fetchone()
+        return dict(row) if row else {'events': 0, 'alerts': 0, 'sleep': 0, 'yawn': 0}
+
+    def same_hour_history(self, rider_id, hour, start_day, end_day, weekday=None):
+        """某騎士在 [start_day, end_day] 之間每天同一小時的彙總 (可限定星期幾)"""
+        sql = ("SELECT day, weekday, events, alerts, sleep, yawn FROM hourly "
+               "WHERE rider_id = ? AND hour = ? AND day >= ? AND day <= ?")
+        params = [rider_id, hour, start_day, end_day]
+        if weekday is not None:
+            sql += " AND weekday = ?"
+            params.append(weekday)
+        with self._lock:
+            return [dict(row) for row in self._db.execute(sql + " ORDER BY day", params)]
+
+    def daily_totals(self, rider_id, start_day):
+        with self._lock:
+            rows = self._db.execute("SELECT * FROM daily WHERE rider_id = ? AND day >= ? ORDER BY day",
+                                    (rider_id, start_day))
+            return [dict(row) for row in rows]
+
+    def rider_ids(self):
+        with self._lock:
+            return [row['rider_id'] for row in self._db.execute("SELECT rider_id FROM riders ORDER BY rider_id")]
+
+    def rider_summary(self, since):
+        """每位騎士的最新分數與 since 之後的警報總數 (由每小時彙總加總)"""
+        bucket = since.strftime('%Y-%m-%d %H')
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT r.rider_id, r.latest_score, r.last_ts, "
+                "COALESCE((SELECT SUM(h.alerts) FROM hourly h WHERE h.rider_id = r.rider_id AND h.bucket >= ?), 0) AS window_alerts "
+                "FROM riders r ORDER BY r.rider_id", (bucket,))
+            return [dict(row) for row in rows]
+
+    @staticmethod
+    def _event_filter(since, until, rider_id):
+        """since / until 可為 datetime 或 TS_FORMAT 字串 (皆含端點)，回傳 (WHERE 子句, 參數)"""
+        clauses, params = [], []
+        for op, bound in (('>=', since), ('<=', until)):
+            if bound is not None:
+                clauses.append(f"ts {op} ?")
+                params.append(bound if isinstance(bound, str) else bound.strftime(TS_FORMAT))
+        if rider_id is not None:
+            clauses.append("rider_id = ?")
+            params.append(rider_id)
+        return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+    def count_events(self, since=None, rider_id=None, until=None):
+        where, params = self._event_filter(since, until, rider_id)
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM events" + where, params).fetchone()[0]
+
+    def recent_events(self, since, rider_id=None, limit=None, until=None, offset=0):
+        """
+        since ~ until 之間的原始事件 (依時間排序；有 limit 時取最新的 limit 筆，offset 為略過的最新筆數)，
+        格式與儀表板紀錄相同；since / until 為 None 時不限
+        """
+        where, params = self._event_filter(since, until, rider_id)
+        sql = "SELECT id, rider_id, ts, alert_type, score FROM events" + where + " ORDER BY ts DESC, id DESC"
+        if limit:
+            sql += " LIMIT ? OFFSET ?"
+            params += [limit, offset]
+        with self._lock:
+            rows = self._db.execute(sql, params).fetchall()
+        rows.reverse()
+        return [{'Timestamp': row['ts'], 'Alert Type': row['alert_type'],
+                 'Safety Score': row['score'], 'Rider_ID': row['rider_id']} for row in rows]
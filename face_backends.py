@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+face_backends.py
+可替換的人臉偵測與地標預測後端。
+
+人臉偵測後端與 dlib 的 frontal_face_detector 介面相同 (detector(gray, upsample) → [dlib.rectangle])，
+可直接交給 FaceLocalizer；地標後端提供 landmarks(gray, rect) → (68, 2) 陣列，
+只預測部分地標的模型會把結果放回 68 點的對應索引，其餘計算 (EAR/MAR、頭部姿態、追蹤) 不需修改。
+
+  dlib_hog      dlib HOG 偵測 (預設)
+  haar          OpenCV Haar cascade (opencv 內建模型，最快但誤判較多)
+  opencv_dnn    OpenCV DNN (res10 SSD，需另外下載模型檔)
+  dlib68        dlib 68 點地標 (~100 MB 模型)
+  dlib_reduced  只訓練眼睛、嘴巴與姿態點的 dlib 地標模型 (以 `python face_backends.py train-reduced` 產生)
+"""
+import argparse
+import os
+import xml.etree.ElementTree as ET
+
+import cv2
+import dlib
+import numpy as np
+
+from fatigue_utils import landmarks_to_np
+
+DLIB_MODEL_PATH = "shape_predictor_68_face_landmarks.dat"
+REDUCED_MODEL_PATH = "shape_predictor_eyes_mouth.dat"
+DNN_PROTOTXT_PATH = "deploy.prototxt"
+DNN_MODEL_PATH = "res10_300x300_ssd_iter_140000.caffemodel"
+
+# 精簡模型保留的地標：下巴 (8)、鼻尖 (30)、雙眼 (36-47)、嘴巴 (48-67)，共 34 點
+REDUCED_LANDMARKS = [8, 30] + list(range(36, 68))
+
+
+# --- 1. 人臉偵測後端 ---
+
+class HaarFaceDetector:
+    """OpenCV Haar cascade；回傳依面積由大到小排序的 dlib.rectangle"""
+    def __init__(self, cascade_path=None, scale_factor=1.1, min_neighbors=5, min_size=40):
+        cascade_path = cascade_path or os.path.join(cv2.data.haarcascades, 'haarcascade_frontalface_default.xml')
+        self.cascade = cv2.CascadeClassifier(cascade_path)
+        if self.cascade.empty():
+            raise IOError(f"無法載入 Haar 模型: {cascade_path}")
+        self.scale_factor = scale_factor
+        self.min_neighbors = min_neighbors
+        self.min_size = min_size
+
+    def __call__(self, gray, upsample=0):
+        faces = self.cascade.detectMultiScale(gray, self.scale_factor, self.min_neighbors,
+                                              minSize=(self.min_size, self.min_size))
+        faces = sorted(faces, key=lambda f: -f[2] * f[3])
+        return [dlib.rectangle(int(x), int(y), int(x + w), int(y + h)) for x, y, w, h in faces]
+
+
+class DnnFaceDetector:
+    """OpenCV DNN (res10 300x300 SSD)；對光線與側臉較穩定，在 Pi 4 上約與縮小後的 HOG 相當"""
+    def __init__(self, prototxt=DNN_PROTOTXT_PATH, model=DNN_MODEL_PATH, confidence=0.6, input_size=300):
+        self.net = cv2.dnn.readNet(model, prototxt)
+        self.confidence = confidence
+        self.input_size = input_size
+
+    def __call__(self, gray, upsample=0):
+        h, w = gray.shape[:2]
+        image = cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR) if gray.ndim == 2 else gray
+        blob = cv2.dnn.blobFromImage(image, 1.0, (self.input_size, self.input_size), (104.0, 177.0, 123.0))
+        self.net.setInput(blob)
+        detections = self.net.forward()[0, 0]
+        faces = []
+        for det in detections[detections[:, 2] >= self.confidence]:
+            l, t, r, b = (det[3:7] * [w, h, w, h]).astype(int)
+            faces.append((det[2], dlib.rectangle(max(0, l), max(0, t), min(w - 1, r), min(h - 1, b))))
+        faces.sort(key=lambda f: -f[0])
+        return [rect for _, rect in faces]
+
+
+DETECTOR_BACKENDS = {
+    'dlib_hog': lambda: dlib.get_frontal_face_detector(),
+    'haar': HaarFaceDetector,
+    'opencv_dnn': DnnFaceDetector,
+}
+
+
+# --- 2. 地標預測後端 ---
+
+class Dlib68Landmarks:
+    """dlib 68 點模型"""
+    def __init__(self, model_path=DLIB_MODEL_PATH):
+        self.predictor = dlib.shape_predictor(model_path)
+
+    def landmarks(self, gray, rect):
+        return landmarks_to_np(self.predictor(gray, rect))
+
+
+class ReducedLandmarks:
+    """
+    只預測部分地標的 dlib 模型 (模型檔較小、預測較快)。
+    預測結果放回 68 點陣列的對應位置；未預測的點以已預測點的外接框中心填補，
+    讓追蹤用的外接框只由眼睛、嘴巴、鼻尖與下巴決定
+    """
+    def __init__(self, model_path=REDUCED_MODEL_PATH, indices=REDUCED_LANDMARKS):
+        self.predictor = dlib.shape_predictor(model_path)
+        self.indices = np.asarray(indices)
+        num_parts = getattr(self.predictor, 'num_parts', len(self.indices))
+        if num_parts != len(self.indices):
+            raise ValueError(f"地標模型 {model_path} 有 {num_parts} 點，與設定的 {len(self.indices)} 點不符")
+        self._missing = np.setdiff1d(np.arange(68), self.indices)
+
+    def landmarks(self, gray, rect):
+        shape = self.predictor(gray, rect)
+        points = landmarks_to_np(shape)
+        if len(points) != len(self.indices):
+            raise ValueError(f"地標模型輸出 {len(points)} 點，與設定的 {len(self.indices)} 點不符")
+        out = np.empty((68, 2), dtype=points.dtype)
+        out[self.indices] = points
+        out[self._missing] = (points.min(axis=0) + points.max(axis=0)) // 2
+        return out
+
+
+LANDMARK_BACKENDS = {
+    'dlib68': Dlib68Landmarks,
+    'dlib_reduced': ReducedLandmarks,
+}
+
+
+def create_detector(name, **kwargs):
+    if name not in DETECTOR_BACKENDS:
+        raise ValueError(f"未知的人臉偵測後端: {name} (可用: {', '.join(DETECTOR_BACKENDS)})")
+    return DETECTOR_BACKENDS[name](**kwargs)
+
+
+def create_landmarker(name, **kwargs):
+    if name not in LANDMARK_BACKENDS:
+        raise ValueError(f"未知的地標後端: {name} (可用: {', '.join(LANDMARK_BACKENDS)})")
+    return LANDMARK_BACKENDS[name](**kwargs)
+
+
+# --- 3. 訓練精簡地標模型 ---
+
+def reduce_training_xml(src_path, dst_path, indices=REDUCED_LANDMARKS):
+    """
+    將 dlib / iBUG 300-W 的 68 點標註 XML 轉為只含指定地標的 XML (點名稱重新編號為 00..N-1)
+    """
+    tree = ET.parse(src_path)
+    keep = {f"{i:02d}": f"{n:02d}" for n, i in enumerate(indices)}
+    for box in tree.iter('box'):
+        for part in list(box.findall('part')):
+            if part.get('name') in keep:
+                part.set('name', keep[part.get('name')])
+            else:
+                box.remove(part)
+    tree.write(dst_path)
+
+
+def train_reduced_model(train_xml, output_path=REDUCED_MODEL_PATH, tree_depth=4, cascade_depth=10,
+                        nu=0.1, oversampling_amount=10, threads=4):
+    """以精簡標註訓練 dlib 地標模型；tree_depth / cascade_depth 較預設小，模型約數 MB"""
+    options = dlib.shape_predictor_training_options()
+    options.tree_depth = tree_depth
+    options.cascade_depth = cascade_depth
+    options.nu = nu
+    options.oversampling_amount = oversampling_amount
+    options.num_threads = threads
+    options.be_verbose = True
+    dlib.train_shape_predictor(train_xml, output_path, options)
+    return output_path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="產生精簡地標模型 (眼睛 + 嘴巴 + 姿態點)")
+    sub = parser.add_subparsers(dest='command')
+    train_parser = sub.add_parser('train-reduced', help="以 68 點標註 XML (例如 iBUG 300-W) 訓練精簡模型")
+    train_parser.add_argument('train_xml')
+    train_parser.add_argument('--output', default=REDUCED_MODEL_PATH)
+    train_parser.add_argument('--tree-depth', type=int, default=4)
+    train_parser.add_argument('--cascade-depth', type=int, default=10)
+    train_parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+
+    if args.command == 'train-reduced':
+        reduced_xml = os.path.splitext(args.train_xml)[0] + '_reduced.xml'
+        reduce_training_xml(args.train_xml, reduced_xml)
+        print(f"[BACKEND] 精簡標註已寫入 {reduced_xml}，開始訓練...")
+        train_reduced_model(reduced_xml, args.output, args.tree_depth, args.cascade_depth, threads=args.threads)
+        print(f"[BACKEND] 模型已寫入 {args.output} ({os.path.getsize(args.output) / 1e6:.1f} MB)")
+    else:
+        parser.print_help()
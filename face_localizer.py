@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+face_localizer.py
+先偵測後追蹤的人臉定位：每 N 幀 (或追蹤信心不足時) 才執行完整 HOG 偵測，
+其餘幀由上一幀的 68 個地標推算人臉框，省去大部分偵測成本。
+偵測可在縮小的影像 (及固定 ROI) 上執行，框再放大回原解析度交給 predictor。
+"""
+import argparse
+import time
+
+import cv2
+import dlib
+import numpy as np
+
+
+def rect_iou(a, b):
+    """計算兩個 (left, top, right, bottom) 框的 IoU"""
+    ix = min(a[2], b[2]) - max(a[0], b[0])
+    iy = min(a[3], b[3]) - max(a[1], b[1])
+    if ix <= 0 or iy <= 0:
+        return 0.0
+    inter = ix * iy
+    area_a = (a[2] - a[0]) * (a[3] - a[1])
+    area_b = (b[2] - b[0]) * (b[3] - b[1])
+    return inter / float(area_a + area_b - inter)
+
+
+def landmarks_bbox(landmarks):
+    """68 點地標的外接框 (left, top, right, bottom)"""
+    xs = landmarks[:, 0]
+    ys = landmarks[:, 1]
+    return (int(xs.min()), int(ys.min()), int(xs.max()), int(ys.max()))
+
+
+class FaceLocalizer:
+    """
+    追蹤模式的人臉定位器。
+    detect_every: 最多連續追蹤幾幀就強制重新偵測一次
+    min_iou: 追蹤框與新地標外接框的 IoU 低於此值視為追蹤失敗
+    search_padding: 重新偵測時，先在上次人臉框外擴此比例的小視窗內搜尋
+    detect_scale: 偵測前將影像縮小的倍率 (例如 0.5)，1.0 表示原解析度
+    roi: 固定的偵測區域 (x, y, w, h)，依安全帽安裝位置設定一次；None 表示整張影像
+    tracking: False 時每幀都執行偵測 (仍套用縮小倍率與 ROI)
+    """
+    def __init__(self, detector, detect_every=10, min_iou=0.5, search_padding=0.3, min_face_size=40,
+                 detect_scale=1.0, roi=None, tracking=True):
+        self.detector = detector
+        self.detect_every = max(1, int(detect_every))
+        self.tracking = tracking
+        self.detect_scale = float(detect_scale)
+        self.roi = tuple(roi) if roi else None
+        self.min_iou = min_iou
+        self.search_padding = search_padding
+        self.min_face_size = min_face_size
+
+        self.track_rect = None # 下一幀要交給 predictor 的人臉框 (left, top, right, bottom)
+        self.last_face = None # 最近一次有效的人臉框，用於小視窗搜尋
+        self.frames_since_detect = 0
+        self._from_detection = False # 本幀的人臉框是否來自完整偵測
+        # 偵測框相對地標外接框的偏移 (以外接框寬高為單位)，讓追蹤框與偵測框的形狀一致
+        self.box_offsets = (0.0, 0.0, 0.0, 0.0)
+
+        # 統計
+        self.detections = 0
+        self.tracked_frames = 0
+        self.track_failures = 0
+
+    def reset(self):
+        self.track_rect = None
+        self.frames_since_detect = 0
+
+    def locate(self, gray):
+        """回傳本幀的 dlib.rectangle；找不到人臉時回傳 None"""
+        if self.tracking and self.track_rect is not None and self.frames_since_detect < self.detect_every:
+            self.frames_since_detect += 1
+            self.tracked_frames += 1
+            self._from_detection = False
+            return dlib.rectangle(*self.track_rect)
+
+        rect = self._detect(gray)
+        self.frames_since_detect = 0
+        self._from_detection = True
+        if rect is None:
+            self.track_rect = None
+            return None
+        self.detections += 1
+        self.track_rect = (rect.left(), rect.top(), rect.right(), rect.bottom())
+        return rect
+
+    def update(self, landmarks, frame_shape):
+        """以本幀預測出的地標更新下一幀的追蹤框，並判斷追蹤信心"""
+        bbox = landmarks_bbox(landmarks)
+        w = bbox[2] - bbox[0]
+        h = bbox[3] - bbox[1]
+        if w < self.min_face_size or h < self.min_face_size:
+            self._track_lost()
+            return
+
+        if self._from_detection:
+            # 記錄偵測框與地標外接框的相對關係
+            r = self.track_rect
+            self.box_offsets = ((r[0] - bbox[0]) / w, (r[1] - bbox[1]) / h,
+                                (r[2] - bbox[2]) / w, (r[3] - bbox[3]) / h)
+
+        ox0, oy0, ox1, oy1 = self.box_offsets
+        frame_h, frame_w = frame_shape[:2]
+        next_rect = (max(0, int(bbox[0] + ox0 * w)), max(0, int(bbox[1] + oy0 * h)),
+                     min(frame_w - 1, int(bbox[2] + ox1 * w)), min(frame_h - 1, int(bbox[3] + oy1 * h)))
+
+        # 追蹤信心：新框與本幀使用的框重疊度不足，代表地標已漂移
+        if not self._from_detection and rect_iou(next_rect, self.track_rect) < self.min_iou:
+            self._track_lost()
+            return
+
+        self.track_rect = next_rect
+        self.last_face = next_rect
+
+    def _track_lost(self):
+        self.track_failures += 1
+        self.track_rect = None
+        self.frames_since_detect = self.detect_every
+
+    def _roi_bounds(self, shape):
+        """固定 ROI 在影像內的邊界 (x0, y0, x1, y1)"""
+        frame_h, frame_w = shape[:2]
+        if self.roi is None:
+            return 0, 0, frame_w, frame_h
+        x, y, w, h = self.roi
+        return max(0, x), max(0, y), min(frame_w, x + w), min(frame_h, y + h)
+
+    def _detect(self, gray):
+        """先在上次人臉附近的小視窗搜尋，找不到才對整個 ROI 執行偵測"""
+        rx0, ry0, rx1, ry1 = self._roi_bounds(gray.shape)
+        if self.last_face is not None:
+            l, t, r, b = self.last_face
+            pad_x = int((r - l) * self.search_padding)
+            pad_y = int((b - t) * self.search_padding)
+            rect = self._detect_in(gray, max(rx0, l - pad_x), max(ry0, t - pad_y),
+                                   min(rx1, r + pad_x), min(ry1, b + pad_y))
+            if rect is not None:
+                return rect
+
+        rect = self._detect_in(gray, rx0, ry0, rx1, ry1)
+        if rect is None:
+            self.last_face = None
+        return rect
+
+    def _detect_in(self, gray, x0, y0, x1, y1):
+        """在 gray[y0:y1, x0:x1] (依 detect_scale 縮小後) 偵測人臉，回傳原解析度座標的框"""
+        if x1 - x0 <= 0 or y1 - y0 <= 0:
+            return None
+        window = gray[y0:y1, x0:x1]
+        scale = self.detect_scale
+        if scale != 1.0:
+            window = cv2.resize(window, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        else:
+            window = np.ascontiguousarray(window)
+
+        rects = self.detector(window, 0)
+        if len(rects) == 0:
+            return None
+        found = rects[0]
+        inv = 1.0 / scale
+        return dlib.rectangle(int(found.left() * inv) + x0, int(found.top() * inv) + y0,
+                              int(found.right() * inv) + x0, int(found.bottom() * inv) + y0)
+
+
+# --- 偵測縮小倍率基準測試 ---
+
+def benchmark_scales(images, scales, roi=None, repeat=5):
+    """對每個縮小倍率量測平均偵測耗時與偵測成功率，回傳 [{scale, mean_ms, hit_rate}]"""
+    detector = dlib.get_frontal_face_detector()
+    results = []
+    for scale in scales:
+        localizer = FaceLocalizer(detector, detect_scale=scale, roi=roi, tracking=False)
+        durations = []
+        hits = 0
+        for gray in images:
+            for _ in range(repeat):
+                localizer.last_face = None # 每次都量測完整 ROI 偵測
+                t0 = time.perf_counter()
+                rect = localizer.locate(gray)
+                durations.append(time.perf_counter() - t0)
+            hits += rect is not None
+        results.append({
+            'scale': scale,
+            'mean_ms': 1000.0 * sum(durations) / len(durations),
+            'hit_rate': hits / float(len(images)),
+        })
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="比較不同偵測縮小倍率 / ROI 的人臉偵測耗時")
+    parser.add_argument('images', nargs='+', help="測試用影像檔")
+    parser.add_argument('--scales', type=float, nargs='+', default=[1.0, 0.5, 0.35, 0.25])
+    parser.add_argument('--roi', type=int, nargs=4, metavar=('X', 'Y', 'W', 'H'), default=None)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    grays = []
+    for path in args.images:
+        image = cv2.imread(path)
+        if image is None:
+            print(f"[BENCH] 無法讀取影像: {path}")
+            continue
+        grays.append(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY))
+
+    if grays:
+        for row in benchmark_scales(grays, args.scales, args.roi, args.repeat):
+            print(f"[BENCH] scale={row['scale']:.2f}  detect={row['mean_ms']:.1f}ms  hit_rate={row['hit_rate']:.0%}")
@@ -7,10 +7,8 @@ import numpy as np
 import cv2
 import dlib
 import time
-import picamera
-import picamera.array
 import threading
-from gpiozero import Buzzer
+import argparse
 from imutils import face_utils
 import json
 import os
@@ -20,12 +18,25 @@ from datetime import datetime
 try:
     from fatigue_utils import (
         landmarks_to_np, 
-        extract_key_points, 
-        calculate_ear, 
-        calculate_mar,
-        FatigueState 
+        compute_face_metrics,
+        FatigueState,
+        SCORING_RESTART_ONLY
     )
-    from tts_service import speak_text # 引入語音播放服務
+    from config import register_config, start_config_watcher
+    from frame_pipeline import LatestFrameSlot, StageTimings
+    from face_localizer import FaceLocalizer
+    from face_backends import create_detector, create_landmarker
+    from head_pose import HeadPoseEstimator
+    from frame_sources import open_frame_source
+    from tts_service import speak_text, prerender_phrases # 引入語音播放服務
+    from firestore_logging import RIDER_ID, get_alert_queue
+    from risk_channel import RiskSubscriber
+    from calibration import ThresholdCalibrator
+    from parallel_inference import ParallelAnalyzer
+    from alert_scheduler import close_schedulers
+    from session_log import SessionWriter, session_path
+    from power_governor import FPS_LEVELS, FrameRateGovernor
+    from metrics import Counter, Gauge, Histogram, register_system_metrics, start_metrics_server
 except ImportError as e:
     print(f"錯誤: 無法匯入必要的模組。請確認 fatigue_utils.py/tts_service.py 存在。錯誤: {e}")
     exit()
@@ -35,14 +46,64 @@ RESOLUTION = (640, 480)
 FRAME_RATE = 30
 FONT = cv2.FONT_HERSHEY_SIMPLEX
 DLIB_MODEL_PATH = "shape_predictor_68_face_landmarks.dat" 
+DETECTOR_BACKEND = 'dlib_hog' # 人臉偵測後端: dlib_hog / haar / opencv_dnn (見 face_backends.py)
+LANDMARK_BACKEND = 'dlib68' # 地標後端: dlib68 / dlib_reduced (精簡模型需先以 face_backends.py train-reduced 產生)
 BUZZER_PIN = 26 
+SHOW_WINDOW = True # 是否開啟 CV2 顯示視窗 (關閉可節省繪圖與顯示耗時)
+TIMING_REPORT_INTERVAL = 10 # 每 10 秒輸出一次各階段耗時，0 表示關閉
+
+# --- 人臉追蹤設定 ---
+FACE_TRACKING = True # 先偵測後追蹤：非偵測幀由上一幀地標推算人臉框
+DETECT_EVERY_N_FRAMES = 10 # 最多連續追蹤 10 幀就重新執行完整偵測
+TRACKING_MIN_IOU = 0.5 # 追蹤框重疊度低於此值即視為追蹤失敗並重新偵測
+DETECT_SCALE = 0.5 # 人臉偵測在縮小影像上執行 (0.25~0.5)，地標預測仍使用原解析度
+DETECT_ROI = None # 固定偵測區域 (x, y, w, h)，依安全帽鏡頭位置設定一次；None 為整張影像
+
+# --- 騎乘紀錄 (見 session_log.py / session_analysis.py) ---
+SESSION_LOG = False # 每幀寫入二進位騎乘紀錄 (30 FPS 約 60 KB / 分鐘；含地標約 550 KB / 分鐘)
+SESSION_LOG_DIR = 'sessions'
+SESSION_LOG_LANDMARKS = False # 一併記錄 68 點地標 (int16)
+
+# --- 動態幀率 (見 power_governor.py) ---
+ADAPTIVE_FRAME_RATE = True # 明顯清醒時逐級降低分析幀率 (30 → 20 → 12)，接近閾值時立即回到 FRAME_RATE
+
+# --- 多程序推論 ---
+INFERENCE_WORKERS = 0 # 人臉偵測 / 地標預測的子程序數 (Pi 4 建議 3)；0 為單一推論線程
+
+# --- 頭部姿態 ---
+HEAD_POSE = True # 以 solvePnP 估計頭部角度並偵測點頭 (每幀約增加 0.1~0.3ms)
+
+# --- 閾值校準 ---
+ADAPTIVE_THRESHOLDS = True # 依騎士校準 EAR/MAR 閾值 (見 calibration.py)；False 時使用 FatigueState 的固定值
 
 # --- 語音提醒設定 ---
 RISK_ANALYSIS_FILE = 'risk_analysis.json' # Web Server 寫入的檔案
-REMINDER_CHECK_INTERVAL = 30 # 每 30 秒檢查一次是否有預測提醒
+REMINDER_RETRY_INTERVAL = 30 # 讀取或播放提醒失敗後的重試間隔 (秒)
 
-# 初始化 Buzzer
+# --- 執行期指標 (Prometheus 文字格式，METRICS_PORT = 0 表示不啟動 HTTP 輸出) ---
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9108
+
+# 以設定檔 / 環境變數的 detector 段落覆寫上方常數 (見 config.py)；間隔類設定可熱更新
+register_config('detector', globals(), hot=('TIMING_REPORT_INTERVAL', 'REMINDER_RETRY_INTERVAL'))
+
+STAGE_SECONDS = Histogram('fatigue_stage_seconds', "各管線階段耗時 (capture/gray/detect/predict/metrics/pose/score/latency/render)", ['stage'])
+FRAMES_TOTAL = Counter('fatigue_frames_total', "已分析的幀數")
+FACE_LOST_TOTAL = Counter('fatigue_face_lost_frames_total', "未偵測到人臉的幀數")
+DROPPED_FRAMES_TOTAL = Counter('fatigue_dropped_frames_total', "來不及分析而丟棄的幀數")
+FACE_DETECTIONS_TOTAL = Counter('fatigue_face_detections_total', "執行完整人臉偵測的次數 (其餘幀為追蹤)")
+ALERTS_TOTAL = Counter('fatigue_alerts_total', "送出的警報次數", ['type'])
+SCORE_GAUGE = Gauge('fatigue_safety_score', "目前的 Safety Score")
+FPS_GAUGE = Gauge('fatigue_analysis_fps', "實際分析速率 (平滑後)")
+PERCLOS_GAUGE = Gauge('fatigue_perclos_ratio', "最近 60 秒閉眼時間比例")
+BLINK_RATE_GAUGE = Gauge('fatigue_blinks_per_minute', "最近 60 秒眨眼頻率")
+BLINK_DURATION_GAUGE = Gauge('fatigue_blink_duration_seconds', "最近 60 秒平均眨眼時長")
+IN_FLIGHT_GAUGE = Gauge('fatigue_inference_in_flight_frames', "已派送給推論子程序、尚未計分的幀數")
+register_system_metrics()
+
+# 初始化 Buzzer (非 RPi 環境沒有 gpiozero 時使用 DummyBuzzer)
 try:
+    from gpiozero import Buzzer
     BUZZER = Buzzer(BUZZER_PIN)
 except Exception as e:
     class DummyBuzzer:
@@ -53,8 +114,14 @@ except Exception as e:
 
 
 # --- 2. 語音提醒線程 ---
-def start_reminder_thread():
-    """在背景執行，定期讀取 JSON 檔案並檢查是否有提醒文本"""
+def seconds_until_next_hour(now=None):
+    now = now or datetime.now()
+    return 3600 - (now.minute * 60 + now.second) + 1
+
+def start_reminder_thread(rider_id=None):
+    """在背景等待 Web Server 的提醒更新通知 (或整點)，有本騎士的提醒時播放語音"""
+    rider_id = rider_id or RIDER_ID
+    subscriber = RiskSubscriber(RISK_ANALYSIS_FILE)
     
     # 追蹤上次播放語音的內容和時間
     last_spoken_reminder = "" 
@@ -62,36 +129,34 @@ def start_reminder_thread():
     
     def check_and_speak_reminder():
         nonlocal last_spoken_reminder, last_reminded_hour
+        risk_data = {}
         
         while True:
-            current_time = time.time()
-            current_hour = datetime.now().hour # 獲取當前小時
-            
             try:
-                if not os.path.exists(RISK_ANALYSIS_FILE):
-                    time.sleep(REMINDER_CHECK_INTERVAL)
-                    continue
-
-                with open(RISK_ANALYSIS_FILE, 'r', encoding='utf-8') as f:
-                    risk_data = json.load(f)
+                # 啟動時先讀一次現有檔案，之後只在收到通知且檔案變動時重新讀取
+                if not risk_data:
+                    risk_data = subscriber.read_if_changed() or {}
+                current_hour = datetime.now().hour # 獲取當前小時
                 
-                reminder_text = risk_data.get('reminder')
+                # 多騎士：優先使用本騎士的提醒，舊格式只有單一 'reminder'
+                reminder_text = risk_data.get('reminders', {}).get(rider_id, risk_data.get('reminder'))
                 
-                # 3. 判斷是否達到提醒閾值，且不在冷卻期內
-                if reminder_text and current_hour != last_reminded_hour:
-                    
-                    # 只有在新的小時 AND 文本內容發生變化時才播放
-                        
-                    speak_text(f"預測提醒。{reminder_text}")
+                # 進入新的小時，或提醒內容改變時播放
+                pending = reminder_text and (current_hour != last_reminded_hour or reminder_text != last_spoken_reminder)
+                # 固定前綴與提醒內容分段快取，常見語句可立即播放 (正在播放其他語音時稍後重試)
+                if pending and speak_text(["預測提醒。", reminder_text]):
                     last_spoken_reminder = reminder_text 
                     last_reminded_hour = current_hour # 鎖定當前小時
+                    pending = False
                         
+                # 等待下一次通知；最晚在下一個整點醒來
+                changed = subscriber.wait_for_change(REMINDER_RETRY_INTERVAL if pending else seconds_until_next_hour())
+                if changed is not None:
+                    risk_data = changed
             except Exception as e:
-                # 如果 Web Server 尚未啟動或 JSON 格式錯誤，則跳過
+                # 如果 JSON 格式錯誤，則跳過
                 print(f"\n[TTS ERROR] 語音提醒線程錯誤: {e}")
-            
-            # 每隔 REMINDER_CHECK_INTERVAL 秒檢查一次
-            time.sleep(REMINDER_CHECK_INTERVAL)
+                time.sleep(REMINDER_RETRY_INTERVAL)
             
     thread = threading.Thread(target=check_and_speak_reminder, daemon=True)
     thread.start()
@@ -100,107 +165,388 @@ def start_reminder_thread():
 # --- 3. DLIB & OpenCV 初始化 ---
 
 def initialize_dlib():
-    """初始化 Dlib 偵測器和預測器"""
-    global detector, predictor
-    detector = dlib.get_frontal_face_detector()
+    """依 DETECTOR_BACKEND / LANDMARK_BACKEND 初始化人臉偵測器、地標預測器與人臉定位器"""
+    global detector, landmarker, localizer, pose_estimator
     try:
-        predictor = dlib.shape_predictor(DLIB_MODEL_PATH)
+        detector = create_detector(DETECTOR_BACKEND)
+        landmarker = create_landmarker(LANDMARK_BACKEND, **({'model_path': DLIB_MODEL_PATH} if LANDMARK_BACKEND == 'dlib68' else {}))
     except Exception as e:
-        print(f"錯誤: 無法載入 DLIB 權重檔案。請確認 {DLIB_MODEL_PATH} 位於專案根目錄。錯誤: {e}")
+        print(f"錯誤: 無法載入偵測後端 {DETECTOR_BACKEND} / {LANDMARK_BACKEND}。請確認模型檔案位於專案根目錄。錯誤: {e}")
         exit()
+    print(f"[BACKEND] 人臉偵測: {DETECTOR_BACKEND}，地標: {LANDMARK_BACKEND}")
+    pose_estimator = HeadPoseEstimator() if HEAD_POSE else None
+    localizer = FaceLocalizer(detector, DETECT_EVERY_N_FRAMES, TRACKING_MIN_IOU,
+                              detect_scale=DETECT_SCALE, roi=DETECT_ROI, tracking=FACE_TRACKING)
+
+# --- 4. 分段管線：擷取 → 最新幀槽位 → 推論 → 顯示 ---
+
+def capture_loop(source, frame_slot, stop_event, timings, governor=None):
+    """
+    擷取線程：持續從影像來源取幀放入最新幀槽位，來不及處理的舊幀直接丟棄
+    governor: 可選的 FrameRateGovernor，依目前目標幀率略過多餘的幀
+    """
+    try:
+        last_capture = time.perf_counter()
+        for capture_time, image in source.frames():
+            now = time.perf_counter()
+            timings.record('capture', now - last_capture)
+            last_capture = now
+
+            # 以幀的擷取時間調節 (與 record_frame() 中 observe() 的時鐘相同；非即時播放的影片也依影片時間計算)
+            if governor is not None and not governor.admit(capture_time):
+                if stop_event.is_set():
+                    break
+                continue
+            frame_slot.put((capture_time, now, image))
+            if stop_event.is_set():
+                break
+    except Exception as e:
+        print(f"擷取線程發生錯誤: {e}")
+    finally:
+        frame_slot.close()
+
+
+def measure_frame(image, timings):
+    """灰階 → 人臉偵測 → 地標預測 → EAR/MAR → 頭部姿態，不修改 FatigueState (可在推論子程序中執行)"""
+    t0 = time.perf_counter()
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    t1 = time.perf_counter()
+    rect = localizer.locate(gray)
+    t2 = time.perf_counter()
+    timings.record('gray', t1 - t0)
+    timings.record('detect', t2 - t1)
+
+    if rect is None:
+        if pose_estimator is not None:
+            pose_estimator.reset()
+        return {'ear': 0.0, 'mar': 0.0, 'landmarks': None, 'pose': None}
+
+    landmarks = landmarker.landmarks(gray, rect)
+    localizer.update(landmarks, gray.shape)
+    t3 = time.perf_counter()
+
+    # 5. 計算核心指標 (雙眼 EAR 與 MAR 一次向量化計算)
+    left_ear, right_ear, EAR_AVG, MAR = compute_face_metrics(landmarks)
+    t4 = time.perf_counter()
+
+    # 6. 頭部姿態 (pitch / yaw / roll)
+    pose = pose_estimator.estimate(landmarks, gray.shape) if pose_estimator is not None else None
+    t5 = time.perf_counter()
+
+    timings.record('predict', t3 - t2)
+    timings.record('metrics', t4 - t3)
+    if pose_estimator is not None:
+        timings.record('pose', t5 - t4)
+    return {'ear': EAR_AVG, 'mar': MAR, 'landmarks': landmarks, 'pose': pose}
+
+
+def score_frame(measurement, state, capture_time, fps, timings):
+    """依擷取順序將量測結果交給 FatigueState 計分，回傳結果 dict"""
+    result = {'ear': 0.0, 'mar': 0.0, 'score': state.current_score, 'landmarks': None, 'pose': None}
+    if measurement is None or measurement['landmarks'] is None:
+        return result
+
+    # 7. 決策與警報 - 以擷取時間計時，**傳遞實際 FPS**
+    t0 = time.perf_counter()
+    pose = measurement['pose']
+    score = state.update_score_and_alert(measurement['ear'], measurement['mar'], capture_time, fps, BUZZER,
+                                         pitch=pose[0] if pose is not None else None)
+    timings.record('score', time.perf_counter() - t0)
+    result.update(measurement, score=score)
+    return result
+
+
+def analyze_frame(image, state, capture_time, fps, timings):
+    """對單一幀執行 灰階 → 人臉偵測 → 地標預測 → EAR/MAR → 計分，回傳結果 dict"""
+    return score_frame(measure_frame(image, timings), state, capture_time, fps, timings)
+
+
+FPS_SMOOTHING_FACTOR = 0.8 # 分析速率的平滑係數
+
+
+def update_fps(global_fps, last_frame_time):
+    """以實際分析的幀更新滾動平均 FPS，回傳 (global_fps, now)"""
+    now = time.perf_counter()
+    frame_duration = max(now - last_frame_time, 1e-6)
+    return (global_fps * FPS_SMOOTHING_FACTOR) + ((1.0 / frame_duration) * (1 - FPS_SMOOTHING_FACTOR)), now
+
+
+session_log = None # 啟用時為 SessionWriter (由推論線程寫入)
+governor = None # 啟用時為 FrameRateGovernor (推論線程回報狀態，擷取線程依目標幀率取幀)
+
+
+def record_frame(result, state, capture_time, fps):
+    """更新每幀的執行期指標、寫入騎乘紀錄，並回報幀率調節器"""
+    FRAMES_TOTAL.inc()
+    if result['landmarks'] is None:
+        FACE_LOST_TOTAL.inc()
+    SCORE_GAUGE.set(result['score'])
+    FPS_GAUGE.set(fps)
+    PERCLOS_GAUGE.set(state.eye_stats.perclos())
+    BLINK_RATE_GAUGE.set(state.eye_stats.blink_rate())
+    BLINK_DURATION_GAUGE.set(state.eye_stats.mean_blink_duration())
+    if session_log is not None:
+        pose = result['pose']
+        session_log.append(capture_time, result['ear'], result['mar'], result['landmarks'] is not None, result['score'],
+                           pose[0] if pose is not None else None, result['landmarks'])
+    if governor is not None:
+        governor.observe(result, state, capture_time)
+
+
+def inference_loop(state, frame_slot, result_slot, stop_event, timings):
+    """推論線程：永遠只處理最新的一幀，結果放入顯示槽位"""
+    global_fps = 1.0 # 滾動平均 FPS (實際分析速率)
+    last_frame_time = time.perf_counter()
+
+    while not stop_event.is_set():
+        item = frame_slot.get(timeout=0.5)
+        if item is None:
+            if frame_slot.closed:
+                break
+            continue
+        seq, (capture_time, capture_perf, image) = item
+
+        # --- 動態 FPS 計算 (以實際分析的幀為準) ---
+        global_fps, last_frame_time = update_fps(global_fps, last_frame_time)
+
+        result = analyze_frame(image, state, capture_time, global_fps, timings)
+        # 端到端延遲：從擷取完成到 update_score_and_alert 看到該幀
+        timings.record('latency', time.perf_counter() - capture_perf)
+        record_frame(result, state, capture_time, global_fps)
+
+        result.update(seq=seq, image=image, fps=global_fps)
+        if result_slot is not None:
+            result_slot.put(result)
+
+    if result_slot is not None:
+        result_slot.close()
+
+
+def localizer_counters():
+    """推論子程序回報的 (完整偵測次數, 追蹤幀數)"""
+    return localizer.detections, localizer.tracked_frames
+
+
+def start_parallel_analyzer(workers):
+    """fork 推論子程序 (需在 initialize_dlib 之後、啟動其他線程之前呼叫)"""
+    frame_shape = (RESOLUTION[1], RESOLUTION[0], 3)
+    return ParallelAnalyzer(workers, frame_shape, measure_frame, localizer_counters).start()
+
+
+def dispatch_loop(frame_slot, analyzer, stop_event):
+    """派送線程：有空的共享槽位時才取最新幀，沒有空槽位時擷取端照常覆蓋舊幀"""
+    resized_warned = False
+    while not stop_event.is_set():
+        slot = analyzer.acquire_slot(timeout=0.5)
+        if slot is None:
+            continue
+        item = frame_slot.get(timeout=0.5)
+        if item is None:
+            analyzer.release_slot(slot)
+            if frame_slot.closed:
+                break
+            continue
+        seq, (capture_time, capture_perf, image) = item
+        if image.nbytes > analyzer.slot_bytes:
+            # 影片來源的解析度可能大於共享槽位，縮放為 RESOLUTION
+            if not resized_warned:
+                print(f"\n[PARALLEL] 影像 {image.shape[1]}x{image.shape[0]} 大於共享槽位，縮放為 {RESOLUTION[0]}x{RESOLUTION[1]}\n", end="")
+                resized_warned = True
+            image = cv2.resize(image, RESOLUTION)
+        analyzer.submit(slot, image, (seq, capture_time, capture_perf, image))
+
+
+def parallel_inference_loop(state, frame_slot, result_slot, stop_event, timings, analyzer):
+    """多程序推論：派送線程把最新幀交給子程序，本線程依派送順序取回量測結果並計分"""
+    dispatcher = threading.Thread(target=dispatch_loop, args=(frame_slot, analyzer, stop_event), name="dispatch", daemon=True)
+    dispatcher.start()
+    global_fps = 1.0
+    last_frame_time = time.perf_counter()
+
+    while True:
+        item = analyzer.get(timeout=0.5)
+        if item is None:
+            if not analyzer.healthy():
+                print("\n[PARALLEL ERROR] 推論子程序異常結束，停止分析。\n", end="")
+                stop_event.set()
+                break
+            if not dispatcher.is_alive() and analyzer.in_flight == 0:
+                break
+            continue
+        _, (seq, capture_time, capture_perf, image), measurement, stages = item
+        for stage, seconds in stages:
+            timings.record(stage, seconds)
+
+        global_fps, last_frame_time = update_fps(global_fps, last_frame_time)
+        result = score_frame(measurement, state, capture_time, global_fps, timings)
+        timings.record('latency', time.perf_counter() - capture_perf)
+        record_frame(result, state, capture_time, global_fps)
+
+        result.update(seq=seq, image=image, fps=global_fps)
+        if result_slot is not None:
+            result_slot.put(result)
+
+    dispatcher.join(timeout=1.0)
+    if result_slot is not None:
+        result_slot.close()
+
+
+def render_result(result):
+    """在影像上繪製地標點與狀態資訊"""
+    image = result['image']
+    score = result['score']
+
+    # 繪製所有 68 個地標點 (輔助驗證)
+    if result['landmarks'] is not None:
+        for (x, y) in result['landmarks']:
+            cv2.circle(image, (int(x), int(y)), 1, (0, 0, 255), -1)
+
+    # 8. 顯示狀態資訊 (CV2 視窗)
+    score_color = (0, 255, 0)
+    if score < 70: score_color = (0, 255, 255)
+    if score < 40: score_color = (0, 0, 255)
+
+    cv2.putText(image, f"FPS: {result['fps']:.1f}", (10, 30), FONT, 0.7, (255, 255, 255), 2)
+    cv2.putText(image, f"Score: {score:.0f}", (10, 210), FONT, 0.7, score_color, 2)
+    cv2.putText(image, f"EAR: {result['ear']:.3f}", (10, 240), FONT, 0.7, score_color, 2)
+    cv2.putText(image, f"MAR: {result['mar']:.3f}", (10, 270), FONT, 0.7, score_color, 2)
+    if result.get('pose') is not None:
+        cv2.putText(image, "Pitch: {:.0f} Yaw: {:.0f} Roll: {:.0f}".format(*result['pose']), (10, 300), FONT, 0.7, score_color, 2)
+    return image
+
+
+def counted_alert_logger(alert_logger):
+    """包裝 FatigueState.alert_logger，依警報類型計數"""
+    def log(alert_type, score, details="", rider_id=None):
+        ALERTS_TOTAL.labels(alert_type).inc()
+        return alert_logger(alert_type, score, details, rider_id=rider_id)
+    return log
+
+
+# --- 5. 系統主迴圈 ---
+def main_pipeline(source_spec='picamera', show_window=SHOW_WINDOW, rider_id=None, workers=INFERENCE_WORKERS,
+                  record=SESSION_LOG):
+    """
+    source_spec: 'picamera'、影片檔或圖片資料夾；show_window=False 為無視窗 (headless) 模式
+    rider_id: 本安全帽的騎士 ID，None 時使用 firestore_logging.RIDER_ID
+    workers: 推論子程序數，0 為單一推論線程
+    record: 是否寫入騎乘紀錄檔 (SESSION_LOG_DIR)
+    """
+    global session_log, governor
+    analyzer = None
+    if workers:
+        # 先載入模型再 fork 子程序 (共用模型記憶體)，且須在其他線程啟動之前
+        initialize_dlib()
+        analyzer = start_parallel_analyzer(workers)
+        prerender_phrases()
+    else:
+        # 預先產生固定語音 (背景執行，與載入 DLIB 模型同時進行)
+        prerender_phrases()
+        initialize_dlib()
 
-# --- 4. 系統主迴圈 ---
-def main_pipeline():
-    initialize_dlib()
-    
     # --- 啟動語音提醒線程 ---
-    start_reminder_thread()
+    start_reminder_thread(rider_id)
+    # --- 啟動警報紀錄線程 (立即補送上次結束前暫存、尚未送出的警報) ---
+    get_alert_queue()
 
-    state = FatigueState() # 狀態追蹤器
-    
-    global_fps = 1.0 # 滾動平均 FPS
-    last_frame_time = time.time()
-    FPS_SMOOTHING_FACTOR = 0.8 # 平滑係數
-    
-    # 初始化 PiCamera
+    calibrator = ThresholdCalibrator(rider_id or RIDER_ID) if ADAPTIVE_THRESHOLDS else None
+    state = FatigueState(rider_id, calibrator) # 狀態追蹤器
+    state.alert_logger = counted_alert_logger(state.alert_logger)
+    # 計分閾值熱更新 (已校準的 EAR/MAR 閾值由 calibrator 依騎士調整，不以設定檔覆寫)
+    restart_only = SCORING_RESTART_ONLY + (('CLOSED_EAR_THRESHOLD', 'YAWN_MAR_THRESHOLD') if calibrator is not None else ())
+    register_config('scoring', state, hot=[name for name in FatigueState.__slots__ if name.isupper() and name not in restart_only],
+                    apply=False)
+    start_config_watcher()
+    if record:
+        path = session_path(SESSION_LOG_DIR, rider_id or RIDER_ID)
+        session_log = SessionWriter(path, {'rider_id': rider_id or RIDER_ID, 'source': source_spec,
+                                           'ear_threshold': state.CLOSED_EAR_THRESHOLD, 'mar_threshold': state.YAWN_MAR_THRESHOLD},
+                                    landmarks=SESSION_LOG_LANDMARKS)
+        print(f"[SESSION] 騎乘紀錄寫入 {path}")
+    timings = StageTimings(histogram=STAGE_SECONDS)
+    frame_slot = LatestFrameSlot()
+    DROPPED_FRAMES_TOTAL.set_function(lambda: frame_slot.dropped)
+    if analyzer is None:
+        FACE_DETECTIONS_TOTAL.set_function(lambda: localizer.detections)
+        detect_counts = localizer_counters
+    else:
+        FACE_DETECTIONS_TOTAL.set_function(lambda: analyzer.counter_total(0))
+        IN_FLIGHT_GAUGE.set_function(lambda: analyzer.in_flight)
+        detect_counts = lambda: (analyzer.counter_total(0), analyzer.counter_total(1))
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT, METRICS_HOST)
+    result_slot = LatestFrameSlot() if show_window else None
+    stop_event = threading.Event()
+
+    # 初始化影像來源 (檔案來源依原始 FPS 節流，模擬即時相機)
     try:
-        with picamera.PiCamera() as camera:
-            camera.resolution = RESOLUTION
-            camera.rotation = 180 
-            camera.framerate = FRAME_RATE
-            
-            with picamera.array.PiRGBArray(camera, size=RESOLUTION) as output:
-                
-                print("\n--- EAR/MAR 疲勞監測系統啟動 ---")
-                
-                for frame_raw in camera.capture_continuous(output, format="bgr", use_video_port=True):
-                    
-                    current_time = time.time()
-                    
-                    # --- 動態 FPS 計算 ---
-                    frame_duration = current_time - last_frame_time
-                    last_frame_time = current_time
-                    current_fps = 1.0 / frame_duration
-                    global_fps = (global_fps * FPS_SMOOTHING_FACTOR) + (current_fps * (1 - FPS_SMOOTHING_FACTOR))
-                    
-                    image = frame_raw.array
-                    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-                    rects = detector(gray, 0)
-                    
-                    EAR_AVG = 0.0
-                    MAR = 0.0
-                    score = state.current_score
-                    
-                    if len(rects) > 0:
-                        rect = rects[0] 
-                        shape = predictor(gray, rect)
-                        landmarks = landmarks_to_np(shape)
-                        
-                        # 提取關鍵點
-                        left_eye, right_eye, mouth = extract_key_points(landmarks)
-                        
-                        # 5. 計算核心指標
-                        left_ear = calculate_ear(left_eye) 
-                        right_ear = calculate_ear(right_eye)
-                        EAR_AVG = (left_ear + right_ear) / 2.0
-                        MAR = calculate_mar(mouth)
-                        
-                        # 7. 決策與警報 - **傳遞實際 FPS**
-                        score = state.update_score_and_alert(EAR_AVG, MAR, current_time, global_fps, BUZZER)
-                        
-                        # 繪製所有 68 個地標點 (輔助驗證)
-                        for (x, y) in landmarks:
-                            cv2.circle(image, (x, y), 1, (0, 0, 255), -1)
+        with open_frame_source(source_spec, RESOLUTION, FRAME_RATE, realtime=True) as source:
+
+            if ADAPTIVE_FRAME_RATE:
+                levels = [fps for fps in FPS_LEVELS if fps < FRAME_RATE]
+                governor = FrameRateGovernor([FRAME_RATE] + levels, on_change=getattr(source, 'set_framerate', None))
 
+            print("\n--- EAR/MAR 疲勞監測系統啟動 ---")
 
-                    # 8. 顯示狀態資訊 (CV2 視窗)
-                    
-                    score_color = (0, 255, 0) 
-                    if score < 70: score_color = (0, 255, 255)
-                    if score < 40: score_color = (0, 0, 255)
-                    
-                    cv2.putText(image, f"FPS: {global_fps:.1f}", (10, 30), FONT, 0.7, (255, 255, 255), 2)
-                    cv2.putText(image, f"Score: {score:.0f}", (10, 210), FONT, 0.7, score_color, 2)
-                    cv2.putText(image, f"EAR: {EAR_AVG:.3f}", (10, 240), FONT, 0.7, score_color, 2)
-                    cv2.putText(image, f"MAR: {MAR:.3f}", (10, 270), FONT, 0.7, score_color, 2)
+            capture_thread = threading.Thread(target=capture_loop, args=(source, frame_slot, stop_event, timings, governor), daemon=True)
+            if analyzer is None:
+                inference_thread = threading.Thread(target=inference_loop, args=(state, frame_slot, result_slot, stop_event, timings), daemon=True)
+            else:
+                inference_thread = threading.Thread(target=parallel_inference_loop,
+                                                    args=(state, frame_slot, result_slot, stop_event, timings, analyzer), daemon=True)
+            capture_thread.start()
+            inference_thread.start()
 
-                    cv2.imshow("EAR/MAR Core Monitoring", image)
+            last_report = time.time()
+            try:
+                while inference_thread.is_alive():
+                    if result_slot is None:
+                        inference_thread.join(timeout=0.5)
+                    else:
+                        item = result_slot.get(timeout=0.5)
+                        if item is not None:
+                            t0 = time.perf_counter()
+                            cv2.imshow("EAR/MAR Core Monitoring", render_result(item[1]))
+                            timings.record('render', time.perf_counter() - t0)
+                        if cv2.waitKey(1) & 0xFF == ord('q'):
+                            break
 
-                    output.truncate(0)
-                    if cv2.waitKey(1) & 0xFF == ord('q'):
-                        break
+                    # 定期輸出各階段耗時與丟幀數
+                    if TIMING_REPORT_INTERVAL and time.time() - last_report >= TIMING_REPORT_INTERVAL:
+                        last_report = time.time()
+                        print(f"\n[PIPELINE] {timings.format_line()} | dropped: {frame_slot.dropped} | detect/track: {'/'.join(map(str, detect_counts()))}"
+                              + (f" | governor: {governor.target_fps:.0f} FPS, skipped {governor.skipped}" if governor is not None else ""))
+            finally:
+                stop_event.set()
+                frame_slot.close()
+                inference_thread.join(timeout=2.0)
+                capture_thread.join(timeout=2.0)
+                if analyzer is not None:
+                    analyzer.close()
+                if session_log is not None:
+                    session_log.close()
 
-        cv2.destroyAllWindows()
+        if show_window:
+            cv2.destroyAllWindows()
     except Exception as e:
         print(f"主程序發生致命錯誤: {e}")
-        
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="EAR/MAR 疲勞監測系統")
+    parser.add_argument('--source', default='picamera', help="影像來源：picamera、影片檔或圖片資料夾")
+    parser.add_argument('--headless', action='store_true', help="不開啟 CV2 顯示視窗")
+    parser.add_argument('--rider', default=None, help="騎士 / 裝置 ID (預設為環境變數 RIDER_ID)")
+    parser.add_argument('--workers', type=int, default=INFERENCE_WORKERS, help="推論子程序數 (0 為單一推論線程)")
+    parser.add_argument('--record', action='store_true', default=SESSION_LOG, help=f"寫入騎乘紀錄檔至 {SESSION_LOG_DIR}/")
+    args = parser.parse_args()
     try:
-        start_reminder_thread()
-        main_pipeline()
+        main_pipeline(args.source, show_window=SHOW_WINDOW and not args.headless, rider_id=args.rider, workers=args.workers,
+                      record=args.record)
     except KeyboardInterrupt:
         print("\n使用者中斷程式。")
     finally:
+        close_schedulers()
+        get_alert_queue().stop() # 等待佇列寫入暫存檔 / 送出，未送出的下次啟動補送
         if 'BUZZER' in globals() and BUZZER.is_active:
             BUZZER.off()
         print("資源已釋放。")
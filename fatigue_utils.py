@@ -4,10 +4,7 @@ fatigue_utils.py
 包含 EAR/MAR 幾何計算、地標點提取，以及 Safety Score 的 FatigueState 邏輯。
 """
 import numpy as np
-from scipy.spatial import distance as dist
-from imutils import face_utils
-import time
-import threading
+from collections import deque
 from math import degrees, atan2, sqrt
 
 # 引入 Firestore 紀錄模組
@@ -17,19 +14,36 @@ except ImportError:
     # 設置一個空的函式，如果檔案不存在，程式碼仍然可以運行，但不會紀錄
     def log_alert_to_firestore(*args, **kwargs):
         print("[LOGGING] 警告：firestore_logging 模組未載入，紀錄功能被跳過。")
+
+from alert_scheduler import get_scheduler, WARNING_PATTERN, CRITICAL_PATTERN
+from config import config_overrides
         
 # --- DLIB 68 點地標索引定義 ---
 LEFT_EYE_START, LEFT_EYE_END = 42, 48 # 左眼 6 點
 RIGHT_EYE_START, RIGHT_EYE_END = 36, 42 # 右眼 6 點
 MOUTH_START, MOUTH_END = 48, 68 # 嘴巴 20 點
 
+# --- 幾何計算用的地標索引對 (EAR/MAR 公式中的所有距離，一次向量化計算) ---
+# 左眼 (42-47)、右眼 (36-41)：兩段垂直距離 + 一段水平距離
+# 嘴巴 (48-67)：內唇三段垂直距離 (61-67, 62-66, 63-65) + 嘴角水平距離 (48-54)
+GEOMETRY_PAIRS = np.array([
+    (43, 47), (44, 46), (42, 45), # 左眼 A, B, C
+    (37, 41), (38, 40), (36, 39), # 右眼 A, B, C
+    (61, 67), (62, 66), (63, 65), (48, 54), # 嘴巴 A, B, C, D
+])
+_PAIR_A = GEOMETRY_PAIRS[:, 0]
+_PAIR_B = GEOMETRY_PAIRS[:, 1]
+
+DEBUG_METRICS = False # 開啟後 EAR/MAR 超過閾值時輸出 Debug 訊息
+
 # --- 1. 地標轉換與提取 ---
 
-def landmarks_to_np(shape):
-    """將 Dlib shape 結構轉換為 NumPy 數組"""
-    coords = np.zeros((68, 2), dtype="int")
-    for i in range(0, 68):
-        coords[i] = (shape.part(i).x, shape.part(i).y)
+def landmarks_to_np(shape, dtype="int", out=None):
+    """將 Dlib shape 結構轉換為 NumPy 數組 (一次取出所有點；可傳入 out 重複使用緩衝區)"""
+    coords = np.array([(p.x, p.y) for p in shape.parts()], dtype=dtype)
+    if out is not None:
+        out[:] = coords
+        return out
     return coords
 
 
@@ -44,166 +58,475 @@ def extract_key_points(landmarks):
 
 # --- 2. 核心幾何計算 ---
 
+def _pair_distances(landmarks):
+    """計算 GEOMETRY_PAIRS 中所有點對的距離，支援 (68, 2) 或 (N, 68, 2)"""
+    diff = landmarks[..., _PAIR_A, :].astype(np.float64) - landmarks[..., _PAIR_B, :]
+    return np.sqrt(np.einsum('...i,...i->...', diff, diff))
+
+
+def compute_face_metrics(landmarks):
+    """
+    以單次 NumPy 運算計算左右眼 EAR 與 MAR。
+    返回: (left_ear, right_ear, ear_avg, mar)
+    """
+    d = _pair_distances(landmarks).tolist()
+    left_ear = (d[0] + d[1]) / (2.0 * d[2]) if d[2] else 0.0
+    right_ear = (d[3] + d[4]) / (2.0 * d[5]) if d[5] else 0.0
+    mar = (d[6] + d[7] + d[8]) / (3.0 * d[9]) if d[9] else 0.0
+    ear_avg = (left_ear + right_ear) / 2.0
+
+    if DEBUG_METRICS:
+        if ear_avg <= 0.22:
+            print(f"\n[DEBUG EAR] EAR: {ear_avg:.4f}\n")
+        if mar >= 0.15:
+            print(f"\n[DEBUG MAR]  MAR: {mar:.4f}\n")
+    return left_ear, right_ear, ear_avg, mar
+
+
+def compute_face_metrics_batch(landmarks_seq):
+    """
+    離線重播用：一次計算多幀的指標。
+    landmarks_seq: (N, 68, 2) 陣列
+    返回: (left_ear, right_ear, ear_avg, mar) 四個長度 N 的陣列；水平距離為 0 的幀記為 0
+    """
+    d = _pair_distances(np.asarray(landmarks_seq))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        left_ear = np.where(d[:, 2] > 0, (d[:, 0] + d[:, 1]) / (2.0 * d[:, 2]), 0.0)
+        right_ear = np.where(d[:, 5] > 0, (d[:, 3] + d[:, 4]) / (2.0 * d[:, 5]), 0.0)
+        mar = np.where(d[:, 9] > 0, (d[:, 6] + d[:, 7] + d[:, 8]) / (3.0 * d[:, 9]), 0.0)
+    return left_ear, right_ear, (left_ear + right_ear) / 2.0, mar
+
+
 def calculate_ear(eye):
     """計算眼睛縱橫比 (EAR)"""
-    A = dist.euclidean(eye[1], eye[5])
-    B = dist.euclidean(eye[2], eye[4])
-    C = dist.euclidean(eye[0], eye[3])
+    eye = np.asarray(eye, dtype=np.float64)
+    A, B, C = np.hypot(*(eye[[1, 2, 0]] - eye[[5, 4, 3]]).T)
     ear = (A + B) / (2.0 * C)
     
     # Debug 輸出
-    if ear <= 0.22 :
+    if DEBUG_METRICS and ear <= 0.22 :
         print(f"\n[DEBUG EAR] EAR: {ear:.4f}\n")
     return ear
 
 
 def calculate_mar(mouth):
     """計算嘴巴縱橫比 (MAR)"""
-    A = dist.euclidean(mouth[13], mouth[19]) 
-    B = dist.euclidean(mouth[14], mouth[18])
-    C = dist.euclidean(mouth[15], mouth[17])
-    D = dist.euclidean(mouth[0], mouth[6]) # 水平距離
+    mouth = np.asarray(mouth, dtype=np.float64)
+    A, B, C, D = np.hypot(*(mouth[[13, 14, 15, 0]] - mouth[[19, 18, 17, 6]]).T) # D 為水平距離
 
     mar = (A + B + C) / (3.0 * D)
     
     # Debug 輸出
-    if mar >= 0.15 :
+    if DEBUG_METRICS and mar >= 0.15 :
         print(f"\n[DEBUG MAR]  MAR: {mar:.4f}\n")
     return mar
 
 
 # --- 3. Safety Score 邏輯核心 ---
 
+HISTORY_SIZE = 256 # EAR/MAR 歷史樣本數 (30 FPS 約 8.5 秒)
+MAX_SAMPLE_GAP_SEC = 1.0 # 兩幀間隔超過此值 (例如人臉遺失) 時，連續閉眼 / 張嘴的計時重新開始
+# 各懲罰旗標與扣分；分數 = 100 - 生效中懲罰的總和 (下限 0)，加回時不會超過 100
+PENALTY_POINTS = (
+    ('ear_penalty_applied', 50), ('perclos_penalty_applied', 20), ('slow_blink_penalty_applied', 10),
+    ('yawn_freq_penalty_applied', 15), ('nod_penalty_applied', 15),
+)
+SCORING_RESTART_ONLY = ('FRAME_RATE', 'PERCLOS_WINDOW_SEC') # 建立 FatigueState 時才生效的設定 (不可熱更新)
+
+
+class RingBuffer:
+    """固定容量的環形緩衝區 (預先配置的 NumPy 陣列)，每列為一筆樣本；寫入 O(1) 且不配置記憶體"""
+    __slots__ = ('data', 'capacity', 'count', '_index')
+
+    def __init__(self, capacity, width, dtype=np.float64):
+        self.data = np.zeros((capacity, width), dtype=dtype)
+        self.capacity = capacity
+        self.count = 0
+        self._index = 0
+
+    def append(self, row):
+        self.data[self._index] = row
+        self._index = (self._index + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+
+    def __len__(self):
+        return self.count
+
+    def latest(self, n=None):
+        """依時間順序回傳最近 n 筆 (複本)"""
+        n = self.count if n is None else min(n, self.count)
+        start = (self._index - n) % self.capacity
+        if start + n <= self.capacity:
+            return self.data[start:start + n].copy()
+        return np.concatenate((self.data[start:], self.data[:self._index]))
+
+
+class EyeClosureStats:
+    """
+    PERCLOS (閉眼時間比例)、眨眼頻率與眨眼時長的滑動窗口統計。
+    以 bucket_sec 為一格的環形時間桶累計，每幀更新 O(1)，記憶體固定 (window_sec / bucket_sec 格)
+    """
+    __slots__ = ('bucket_sec', 'size', 'closed', 'total', 'blinks', 'blink_time',
+                 'sum_closed', 'sum_total', 'sum_blinks', 'sum_blink_time',
+                 'current', 'last_time', 'closed_since', 'last_blink_duration')
+
+    def __init__(self, window_sec=60.0, bucket_sec=1.0):
+        self.bucket_sec = bucket_sec
+        self.size = max(1, int(round(window_sec / bucket_sec)))
+        self.closed = [0.0] * self.size # 每格的閉眼秒數
+        self.total = [0.0] * self.size # 每格的有效觀察秒數
+        self.blinks = [0] * self.size
+        self.blink_time = [0.0] * self.size
+        self.sum_closed = 0.0
+        self.sum_total = 0.0
+        self.sum_blinks = 0
+        self.sum_blink_time = 0.0
+        self.current = None # 目前時間桶的絕對編號
+        self.last_time = None
+        self.closed_since = None
+        self.last_blink_duration = 0.0
+
+    def _advance(self, t):
+        index = int(t // self.bucket_sec)
+        if self.current is None:
+            self.current = index
+            return
+        steps = index - self.current
+        if steps <= 0:
+            return
+        # 清空離開窗口的時間桶，並重新加總 (每秒一次，避免浮點誤差累積)
+        for k in range(1, min(steps, self.size) + 1):
+            slot = (self.current + k) % self.size
+            self.closed[slot] = 0.0
+            self.total[slot] = 0.0
+            self.blinks[slot] = 0
+            self.blink_time[slot] = 0.0
+        self.current = index
+        self.sum_closed = sum(self.closed)
+        self.sum_total = sum(self.total)
+        self.sum_blinks = sum(self.blinks)
+        self.sum_blink_time = sum(self.blink_time)
+
+    def update(self, t, is_closed, blink_max_sec=0.5):
+        """加入一幀；閉眼時長不超過 blink_max_sec 的閉眼在睜眼時記為一次眨眼"""
+        self._advance(t)
+        slot = self.current % self.size
+        if self.last_time is not None:
+            dt = t - self.last_time
+            if 0 < dt <= MAX_SAMPLE_GAP_SEC:
+                # 上一幀到這一幀之間的時間，依上一幀的狀態歸類
+                self.total[slot] += dt
+                self.sum_total += dt
+                if self.closed_since is not None:
+                    self.closed[slot] += dt
+                    self.sum_closed += dt
+            elif dt > MAX_SAMPLE_GAP_SEC:
+                self.closed_since = None # 中斷太久，這次閉眼無法判斷長度
+        self.last_time = t
+
+        if is_closed:
+            if self.closed_since is None:
+                self.closed_since = t
+        elif self.closed_since is not None:
+            duration = t - self.closed_since
+            self.closed_since = None
+            if duration <= blink_max_sec:
+                self.blinks[slot] += 1
+                self.blink_time[slot] += duration
+                self.sum_blinks += 1
+                self.sum_blink_time += duration
+                self.last_blink_duration = duration
+
+    def perclos(self):
+        """窗口內閉眼時間比例 (0~1)"""
+        return self.sum_closed / self.sum_total if self.sum_total > 0 else 0.0
+
+    def blink_rate(self):
+        """每分鐘眨眼次數 (以實際觀察時間計算)"""
+        return self.sum_blinks * 60.0 / self.sum_total if self.sum_total > 0 else 0.0
+
+    def mean_blink_duration(self):
+        """窗口內平均眨眼時長 (秒)"""
+        return self.sum_blink_time / self.sum_blinks if self.sum_blinks else 0.0
+
+
+# --- FatigueState 的閾值預設值 (可由設定檔的 scoring 段落覆寫，見 config.py) ---
+SCORING_DEFAULTS = {
+    # 實測校準閾值
+    'FRAME_RATE': 30.0,
+    'CLOSED_EAR_THRESHOLD': 0.22, # EAR 閉眼判斷實測閾值
+    'YAWN_MAR_THRESHOLD': 0.15, # 哈欠判斷實測閾值
+
+    # 時序參數
+    'MICRO_SLEEP_SEC': 1.5,
+    'PENALTY_RESET_SEC': 15.0, # 15 秒後分數加回
+    'YAWN_CONSEC_SEC': 1.0, # 哈欠持續 1 秒才算有效
+    'YAWN_WINDOW_SEC': 60.0, # 滾動窗口 60 秒
+    'YAWN_CRITICAL_COUNT': 2, # 1 分鐘內超過 2 次哈欠
+
+    # PERCLOS / 眨眼 (早期疲勞指標，微睡眠發生前即可提醒)
+    'PERCLOS_WINDOW_SEC': 60.0, # PERCLOS 與眨眼統計的滑動窗口
+    'PERCLOS_MIN_COVERAGE_SEC': 30.0, # 窗口內至少有 30 秒有效畫面才判斷
+    'PERCLOS_WARN': 0.15, # 閉眼時間比例超過 15% 扣分
+    'PERCLOS_RECOVER': 0.10, # 降到 10% 以下才加回 (避免在閾值附近反覆扣分)
+    'BLINK_MAX_SEC': 0.5, # 閉眼不超過 0.5 秒視為眨眼
+    'SLOW_BLINK_SEC': 0.3, # 平均眨眼時長超過 0.3 秒視為眨眼變慢
+    'SLOW_BLINK_MIN_COUNT': 3, # 窗口內至少 3 次眨眼才判斷平均時長
+
+    # 點頭 (頭部 pitch 相對於平時姿勢下降後又抬起)
+    'NOD_PITCH_DEG': 15.0, # 低於平時 pitch 15 度視為低頭
+    'NOD_MIN_SEC': 0.2, # 低頭至少 0.2 秒才算一次點頭 (排除估計雜訊)
+    'NOD_WINDOW_SEC': 60.0, # 點頭次數的滾動窗口
+    'NOD_CRITICAL_COUNT': 2, # 1 分鐘內超過 2 次點頭
+    'PITCH_BASELINE_HALF_LIFE_SEC': 20.0, # 平時 pitch (EWMA) 的半衰期
+}
+
+
+def scoring_params(overrides=None):
+    """
+    目前生效的閾值 {名稱: 值} (預設值 + scoring 段落的覆寫)；只需讀取閾值時使用，不必建立 FatigueState
+    overrides: 再覆寫的閾值 {名稱: 值} (例如離線重新計分的參數組合)；未知的名稱拋出 ValueError
+    """
+    params = dict(SCORING_DEFAULTS)
+    params.update(config_overrides('scoring', SCORING_DEFAULTS))
+    for name, value in (overrides or {}).items():
+        if name not in params:
+            raise ValueError(f"FatigueState 沒有閾值 {name}")
+        params[name] = value
+    return params
+
+
 class FatigueState:
-    """用於追蹤跨幀累積數據的狀態類別"""
-    def __init__(self):
-        # 實測校準閾值
-        self.FRAME_RATE = 30.0 
-        self.CLOSED_EAR_THRESHOLD = 0.22  # EAR 閉眼判斷實測閾值 
-        self.YAWN_MAR_THRESHOLD = 0.15    # 哈欠判斷實測閾值 
-        
-        # 時序參數 
-        self.MICRO_SLEEP_SEC = 1.5 
-        self.PENALTY_RESET_SEC = 15.0 # 15 秒後分數加回
-        self.YAWN_CONSEC_SEC = 1  # 哈欠持續 1 秒才算有效
-        self.YAWN_WINDOW_SEC = 60.0 # 滾動窗口 60 秒
-        self.YAWN_CRITICAL_COUNT = 2 # 1 分鐘內超過 2 次哈欠
-
-        # 實時計數器
-        self.closed_counter = 0
+    """
+    用於追蹤跨幀累積數據的狀態類別。
+    閉眼 / 哈欠的持續時間以每幀的擷取時間計算 (與 FPS 無關)，哈欠滾動窗口使用 deque，
+    每幀更新皆為 O(1)
+    """
+    __slots__ = (
+        'rider_id', 'FRAME_RATE', 'CLOSED_EAR_THRESHOLD', 'YAWN_MAR_THRESHOLD',
+        'MICRO_SLEEP_SEC', 'PENALTY_RESET_SEC', 'YAWN_CONSEC_SEC', 'YAWN_WINDOW_SEC', 'YAWN_CRITICAL_COUNT',
+        'eye_closed_since', 'closed_duration', 'current_score', 'last_alert_time',
+        'ear_penalty_applied', 'yawn_freq_penalty_applied', 'mouth_open_since', 'is_yawning',
+        'yawn_timestamps', 'last_yawn_output_count', 'last_sample_time',
+        'PERCLOS_WINDOW_SEC', 'PERCLOS_MIN_COVERAGE_SEC', 'PERCLOS_WARN', 'PERCLOS_RECOVER',
+        'BLINK_MAX_SEC', 'SLOW_BLINK_SEC', 'SLOW_BLINK_MIN_COUNT',
+        'perclos_penalty_applied', 'slow_blink_penalty_applied', 'eye_stats',
+        'NOD_PITCH_DEG', 'NOD_MIN_SEC', 'NOD_WINDOW_SEC', 'NOD_CRITICAL_COUNT', 'PITCH_BASELINE_HALF_LIFE_SEC',
+        'pitch_baseline', 'nod_started', 'nod_timestamps', 'nod_penalty_applied',
+        'history', 'calibrator', 'alert_logger',
+    )
+
+    def __init__(self, rider_id=None, calibrator=None, overrides=None):
+        self.rider_id = rider_id # None 表示使用 firestore_logging.RIDER_ID
+        self.calibrator = calibrator # 可選的 calibration.ThresholdCalibrator，會調整 EAR / MAR 兩個閾值
+        # 閾值 (SCORING_DEFAULTS + 設定檔 / 環境變數的 scoring 段落 + overrides，見 scoring_params())；
+        # 在建立 eye_stats 等依閾值配置的狀態之前套用，SCORING_RESTART_ONLY 的項目也能覆寫
+        for name, value in scoring_params(overrides).items():
+            setattr(self, name, value)
+
+        # 實時狀態 (以時間戳記計時，None 表示目前未閉眼 / 未張嘴)
+        self.eye_closed_since = None
+        self.closed_duration = 0.0 # 目前連續閉眼秒數
         self.current_score = 100
         self.last_alert_time = 0 
+        self.last_sample_time = None
         
         # 懲罰旗標，確保單一事件只扣分一次
         self.ear_penalty_applied = False
         self.yawn_freq_penalty_applied = False
+        self.perclos_penalty_applied = False
+        self.slow_blink_penalty_applied = False
+        self.nod_penalty_applied = False
+
+        # 頭部姿態追蹤
+        self.pitch_baseline = None
+        self.nod_started = None # 本次低頭開始的時間
+        self.nod_timestamps = deque()
         
         # MAR 相關追蹤
-        self.yawn_frame_counter = 0 # 單次哈欠持續幀數
-        self.is_yawning = False     # 哈欠正在發生中
+        self.mouth_open_since = None # 本次張嘴開始的時間
+        self.is_yawning = False     # 哈欠正在發生中 (已計數)
         
         # 滾動窗口追蹤 (用於 MAR 累積)
-        self.yawn_timestamps = [] # 儲存每次有效哈欠發生的時間戳記 (time.time())
-        self.last_alert_level = 0 
+        self.yawn_timestamps = deque() # 每次有效哈欠發生的時間戳記，依時間排序
         self.last_yawn_output_count = 0 # 追蹤上一次輸出的哈欠計數
 
+        # 最近的 (時間, EAR, MAR) 樣本，供平滑與 PERCLOS 等指標使用
+        self.history = RingBuffer(HISTORY_SIZE, 3)
+        self.eye_stats = EyeClosureStats(self.PERCLOS_WINDOW_SEC)
+
+        # 警報紀錄函式 (離線重播 / 基準測試時可替換，避免寫入雲端)
+        self.alert_logger = log_alert_to_firestore
+
+    def _update_nods(self, pitch, current_time, dt):
+        """以相對於平時 pitch 的下降偵測點頭，並判斷點頭頻率；返回是否發出警報"""
+        if self.pitch_baseline is None:
+            self.pitch_baseline = pitch
+        drop = self.pitch_baseline - pitch
+
+        if drop >= self.NOD_PITCH_DEG:
+            if self.nod_started is None:
+                self.nod_started = current_time
+        elif drop < self.NOD_PITCH_DEG / 2:
+            # 抬回平時姿勢：低頭夠久才算一次點頭
+            if self.nod_started is not None and current_time - self.nod_started >= self.NOD_MIN_SEC:
+                self.nod_timestamps.append(current_time)
+                print(f"\n[NOD]  偵測到一次點頭 (低頭 {current_time - self.nod_started:.1f} 秒)。\n", end="")
+            self.nod_started = None
+            # 只以平時姿勢的樣本緩慢更新基準
+            alpha = 1.0 - 0.5 ** (dt / self.PITCH_BASELINE_HALF_LIFE_SEC)
+            self.pitch_baseline += alpha * (pitch - self.pitch_baseline)
+
+        while self.nod_timestamps and current_time - self.nod_timestamps[0] >= self.NOD_WINDOW_SEC:
+            self.nod_timestamps.popleft()
+        nod_count = len(self.nod_timestamps)
+
+        if nod_count > self.NOD_CRITICAL_COUNT and not self.nod_penalty_applied:
+            self.nod_penalty_applied = True
+            self._update_score()
+            self.alert_logger("WARNING_HEAD_NOD", self.current_score, f"一分鐘內點頭 {nod_count} 次", rider_id=self.rider_id)
+            print(f"\n[ALERT-WARN]  點頭頻率過高 ({nod_count} 次/分鐘). 扣分: 15\n", end="")
+            return True
+        if nod_count <= self.NOD_CRITICAL_COUNT and self.nod_penalty_applied:
+            self.nod_penalty_applied = False
+            self._update_score()
+            print(f"\n[RESET-WARN]  點頭頻率恢復正常 ({nod_count} 次). 分數加回 15 點。\n", end="")
+        return False
+
+    def _update_score(self):
+        """依目前生效的懲罰重新計算分數 (懲罰總和可超過 100，分數下限為 0)"""
+        self.current_score = max(0, 100 - sum(points for flag, points in PENALTY_POINTS if getattr(self, flag)))
+
     def buzz_warning(self, BUZZER):
-        """模擬 Warning 警報模式 (輕微、慢速蜂鳴)"""
-        if self.last_alert_level < 1:
-            self.last_alert_level = 1
-            threading.Thread(target=lambda: (BUZZER.on(), time.sleep(0.3), BUZZER.off(), time.sleep(0.8), BUZZER.on(), time.sleep(0.3), BUZZER.off(), time.sleep(1.0), self.__reset_alert_level(1))).start()
+        """Warning 警報模式 (輕微、慢速蜂鳴)；交給 BUZZER 的常駐排程器，立即返回"""
+        get_scheduler(BUZZER).request(WARNING_PATTERN)
 
     def buzz_critical(self, BUZZER):
-        """模擬 Critical 警報模式 (快速、連續強烈蜂鳴)"""
-        if self.last_alert_level < 2:
-            self.last_alert_level = 2
-            threading.Thread(target=lambda: (
-                BUZZER.on(), time.sleep(0.1), BUZZER.off(), time.sleep(0.1),
-                BUZZER.on(), time.sleep(0.1), BUZZER.off(), time.sleep(0.1),
-                BUZZER.on(), time.sleep(0.1), BUZZER.off(), time.sleep(2.0), self.__reset_alert_level(2)
-            )).start()
-            
-    def __reset_alert_level(self, level_completed):
-        if self.last_alert_level == level_completed:
-            self.last_alert_level = 0
-            
-    def update_score_and_alert(self, ear, mar, current_time, current_fps, BUZZER):
-        micro_sleep_frames = int(self.MICRO_SLEEP_SEC * current_fps)
-        micro_sleep_frames = max(1, micro_sleep_frames) 
-        
+        """Critical 警報模式 (快速、連續強烈蜂鳴)；會中斷播放中的 Warning"""
+        get_scheduler(BUZZER).request(CRITICAL_PATTERN)
+
+    def update_score_and_alert(self, ear, mar, current_time, current_fps, BUZZER, pitch=None):
+        """
+        以單幀的 EAR/MAR 更新分數並觸發警報，返回目前分數。
+        current_time 為該幀的擷取時間；所有持續時間都以它計算
+        current_fps: 已棄用 (持續時間不再以幀數換算)，僅為相容既有呼叫保留位置，其值不會被使用
+        pitch: 可選的頭部俯仰角 (度，負值為低頭，見 head_pose.py)，用於點頭偵測
+        """
         is_alert = False
-        score_deduction = 0
-        old_yawn_count = len(self.yawn_timestamps)
+
+        # 兩幀間隔過長 (人臉遺失或嚴重掉幀) 時，不把中間的空白當作持續閉眼 / 張嘴
+        sample_dt = current_time - self.last_sample_time if self.last_sample_time is not None else 0.0
+        if sample_dt > MAX_SAMPLE_GAP_SEC:
+            self.eye_closed_since = None
+            self.mouth_open_since = None
+            self.is_yawning = False
+            self.nod_started = None
+        self.last_sample_time = current_time
+        self.history.append((current_time, ear, mar))
+        if self.calibrator is not None:
+            self.calibrator.observe(self, ear, mar, current_time)
 
         # --- 1. 分數加回邏輯 (15 秒後加回分數) ---
-        if self.current_score < 100 and (current_time - self.last_alert_time) >= self.PENALTY_RESET_SEC and self.ear_penalty_applied == True:
-            self.current_score += 50
+        if self.ear_penalty_applied and (current_time - self.last_alert_time) >= self.PENALTY_RESET_SEC:
             self.ear_penalty_applied = False
+            self._update_score()
             print("\n[RESET]  15秒已過，Safety Score 加回 50 。\n", end="")
         
         # --- A. EAR (眼睛) 判斷與扣分 ---
-        is_eye_closed = ear < self.CLOSED_EAR_THRESHOLD
-        
-        if is_eye_closed:
-            self.closed_counter += 1
+        if ear < self.CLOSED_EAR_THRESHOLD:
+            if self.eye_closed_since is None:
+                self.eye_closed_since = current_time
+            self.closed_duration = current_time - self.eye_closed_since
         else:
-            self.closed_counter = 0
+            self.eye_closed_since = None
+            self.closed_duration = 0.0
         
         # 臨界警報：微睡眠 (> 1.5s 持續閉眼)
-        if self.closed_counter >= micro_sleep_frames:
+        if self.eye_closed_since is not None and self.closed_duration >= self.MICRO_SLEEP_SEC:
             if not self.ear_penalty_applied:
-                self.current_score -= 50 # 扣除 50 點
                 self.last_alert_time = current_time 
                 self.ear_penalty_applied = True 
+                self._update_score() # 扣除 50 點
                 is_alert = True
                 # 數據記錄寫入 Sheets
-                log_alert_to_firestore("CRITICAL_SLEEP", self.current_score, f"EAR:{ear:.3f} 閉眼持續超過 {self.MICRO_SLEEP_SEC} 秒")
-                print(f"\n[ALERT-CRIT]  微睡眠確認 (持續 {self.closed_counter} 幀). 扣分: 50\n", end="")
+                self.alert_logger("CRITICAL_SLEEP", self.current_score, f"EAR:{ear:.3f} 閉眼持續超過 {self.MICRO_SLEEP_SEC} 秒", rider_id=self.rider_id)
+                print(f"\n[ALERT-CRIT]  微睡眠確認 (持續 {self.closed_duration:.2f} 秒). 扣分: 50\n", end="")
+
+        # --- PERCLOS 與眨眼時長 (增量更新) ---
+        stats = self.eye_stats
+        stats.update(current_time, ear < self.CLOSED_EAR_THRESHOLD, self.BLINK_MAX_SEC)
+        perclos = stats.perclos() if stats.sum_total >= self.PERCLOS_MIN_COVERAGE_SEC else 0.0
+        if perclos >= self.PERCLOS_WARN and not self.perclos_penalty_applied:
+            self.perclos_penalty_applied = True
+            self._update_score() # 扣除 20 點
+            is_alert = True
+            self.alert_logger("WARNING_PERCLOS", self.current_score, f"PERCLOS {perclos:.0%} (最近 {self.PERCLOS_WINDOW_SEC:.0f} 秒)", rider_id=self.rider_id)
+            print(f"\n[ALERT-WARN]  閉眼時間比例過高 (PERCLOS {perclos:.0%}). 扣分: 20\n", end="")
+        elif perclos < self.PERCLOS_RECOVER and self.perclos_penalty_applied:
+            self.perclos_penalty_applied = False
+            self._update_score()
+            print(f"\n[RESET-WARN]  PERCLOS 恢復正常 ({perclos:.0%}). 分數加回 20 點。\n", end="")
+
+        blink_duration = stats.mean_blink_duration()
+        slow_blinks = stats.sum_blinks >= self.SLOW_BLINK_MIN_COUNT and blink_duration >= self.SLOW_BLINK_SEC
+        if slow_blinks and not self.slow_blink_penalty_applied:
+            self.slow_blink_penalty_applied = True
+            self._update_score() # 扣除 10 點
+            is_alert = True
+            self.alert_logger("WARNING_SLOW_BLINK", self.current_score, f"平均眨眼 {blink_duration:.2f} 秒，{stats.blink_rate():.0f} 次/分鐘", rider_id=self.rider_id)
+            print(f"\n[ALERT-WARN]  眨眼變慢 (平均 {blink_duration:.2f} 秒). 扣分: 10\n", end="")
+        elif not slow_blinks and self.slow_blink_penalty_applied:
+            self.slow_blink_penalty_applied = False
+            self._update_score()
+            print(f"\n[RESET-WARN]  眨眼時長恢復正常. 分數加回 10 點。\n", end="")
 
         # --- B. MAR (哈欠) 判斷與累積 ---
-        is_yawning_frame = mar > self.YAWN_MAR_THRESHOLD
-        
-        if is_yawning_frame:
-            self.yawn_frame_counter += 1
+        if mar > self.YAWN_MAR_THRESHOLD:
+            if self.mouth_open_since is None:
+                self.mouth_open_since = current_time
             
-            # 判斷是否為一個"有效"的哈欠 (持續 0.7 秒)
-            if self.yawn_frame_counter >= int(self.YAWN_CONSEC_SEC * current_fps) and not self.is_yawning:
+            # 判斷是否為一個"有效"的哈欠 (持續 YAWN_CONSEC_SEC 秒)
+            if not self.is_yawning and current_time - self.mouth_open_since >= self.YAWN_CONSEC_SEC:
                 self.yawn_timestamps.append(current_time) # 記錄哈欠時間
                 self.is_yawning = True # 標記為正在哈欠中，避免重複計數
                 print(f"\n[YAWN-VALID]  偵測到一次有效哈欠。\n", end="")
-        elif not is_yawning_frame:
-            self.yawn_frame_counter = 0
+        else:
+            self.mouth_open_since = None
             self.is_yawning = False
 
-        # 滾動窗口管理 (移除過期的哈欠時間戳)
-        self.yawn_timestamps = [t for t in self.yawn_timestamps if current_time - t < self.YAWN_WINDOW_SEC]
+        # 滾動窗口管理 (時間戳依序加入，只需從左側移除過期的)
+        while self.yawn_timestamps and current_time - self.yawn_timestamps[0] >= self.YAWN_WINDOW_SEC:
+            self.yawn_timestamps.popleft()
         
         current_yawn_count = len(self.yawn_timestamps)
         
         # 2. 中度警報：哈欠頻率判斷 (> 2 次 / 60 秒)
         if current_yawn_count > self.YAWN_CRITICAL_COUNT:
             if not self.yawn_freq_penalty_applied:
-                self.current_score -= 15 # 扣除 15 點
                 self.yawn_freq_penalty_applied = True
+                self._update_score() # 扣除 15 點
                 is_alert = True
                 # 數據記錄寫入 Sheets
-                log_alert_to_firestore("WARNING_YAWN_FREQUENCY", self.current_score, f"一分鐘內哈欠 {current_yawn_count} 次")
+                self.alert_logger("WARNING_YAWN_FREQUENCY", self.current_score, f"一分鐘內哈欠 {current_yawn_count} 次", rider_id=self.rider_id)
                 print(f"\n[ALERT-WARN]  哈欠頻率過高 ({current_yawn_count} 次/分鐘). 扣分: 15\n", end="")
         elif current_yawn_count <= self.YAWN_CRITICAL_COUNT:
             if self.yawn_freq_penalty_applied:
-                self.current_score += 15 # 分數加回 15 點
                 self.yawn_freq_penalty_applied = False
+                self._update_score() # 分數加回 15 點
                 # 確保只在哈欠累積恢復正常時才輸出
                 print(f"\n[RESET-WARN]  哈欠頻率恢復正常 ({current_yawn_count} 次). 分數加回 15 點。\n", end="")
         
-        # --- C. 最終輸出 ---
-        self.current_score = max(0, self.current_score)
+        # --- C. 頭部姿態：點頭頻率 ---
+        if pitch is not None:
+            is_alert = self._update_nods(pitch, current_time, min(sample_dt, MAX_SAMPLE_GAP_SEC)) or is_alert
 
-        # 只有當 EAR Frame 正在累積 OR Yawn Count 發生變化 OR 發生警報/重置時才輸出
-        should_print_status = self.closed_counter > 0 or current_yawn_count != self.last_yawn_output_count
+        # --- D. 最終輸出 ---
+        # 只有當正在閉眼 OR Yawn Count 發生變化 OR 發生警報/重置時才輸出
+        should_print_status = self.eye_closed_since is not None or current_yawn_count != self.last_yawn_output_count
 
         if should_print_status:
-            print(f"\r[STATUS] EAR Frame: {self.closed_counter}/{micro_sleep_frames} | Yawn Count: {current_yawn_count} | Score: {self.current_score}                          ", end="")
+            print(f"\r[STATUS] EAR Closed: {self.closed_duration:.2f}/{self.MICRO_SLEEP_SEC}s | Yawn Count: {current_yawn_count} | PERCLOS: {stats.perclos():.0%} | Score: {self.current_score}                          ", end="")
             # 必須更新 last_yawn_output_count
             self.last_yawn_output_count = current_yawn_count
 
@@ -2,54 +2,239 @@
 """
 firestore_logging.py
 使用 Google Forms API 處理數據紀錄。
+警報先放入記憶體佇列並立即返回，由背景線程寫入本地 SQLite 暫存檔後再送出，
+網路中斷或重開機時警報不會遺失，恢復連線後依序補送。
 """
 import requests
+from requests.adapters import HTTPAdapter
 import json
-import time 
+import os
+import queue
+import random
+import sqlite3
+import threading
+import time
 from datetime import datetime
 
+from metrics import Counter, Gauge, Histogram
+from config import register_config
+
 # 1. Google 表單的提交 URL (Action URL from 'Embed HTML' share option)
-FORM_URL = "https://docs.google.com/forms/u/0/d/e/1FAIpQLSf_Ui1Ygi-YWXKlHteOS0PNWfLkK4lKGdWw9N-jR2yH1SpG_Q/formResponse" 
+FORM_URL = "https://docs.google.com/forms/u/0/d/e/1FAIpQLSf_Ui1Ygi-YWXKlHteOS0PNWfLkK4lKGdWw9N-jR2yH1SpG_Q/formResponse"
 
 # 2. 欄位名稱 (Google Forms 的內部 ID
 FIELD_IDS = {
     "ALERT_TYPE": "entry.372793363",
     "SAFETY_SCORE": "entry.63614352",
     "TIMESTAMP": "entry.924932555",
+    "RIDER_ID": "entry.9999999999", # 騎士 / 裝置 ID 欄位
 }
+
+# 本裝置的騎士 ID (每頂安全帽以環境變數 RIDER_ID 設定)
+RIDER_ID = os.environ.get("RIDER_ID", "Rider_A001")
+
+# 3. 非同步紀錄設定
+SPOOL_DB_PATH = "alert_spool.db" # 尚未送出的警報暫存 (SQLite)
+QUEUE_MAXSIZE = 256 # 記憶體佇列上限，滿了直接丟棄 (不阻塞偵測迴圈)
+REQUEST_TIMEOUT = (3.05, 10) # (連線, 讀取) 逾時秒數
+BATCH_SIZE = 20 # 每次喚醒最多連續送出的筆數 (共用同一條 keep-alive 連線)
+RETRY_BASE_SEC = 2.0 # 失敗後的重試間隔起點 (指數退避)
+RETRY_MAX_SEC = 300.0 # 重試間隔上限
+
+# 以設定檔 / 環境變數的 logging 段落覆寫上方常數 (見 config.py)；端點與重試參數可熱更新
+register_config('logging', globals(), hot=('FORM_URL', 'FIELD_IDS', 'REQUEST_TIMEOUT', 'BATCH_SIZE',
+                                           'RETRY_BASE_SEC', 'RETRY_MAX_SEC'))
+
+_firebase_ready = (None, False) # (檢查過的 FORM_URL, 是否已配置)
+
+
 def initialize_firebase():
-    # 虛擬初始化，檢查 URL 是否已配置
-    if "YOUR_GOOGLE_FORM_SUBMIT_URL" in FORM_URL:
+    # 虛擬初始化，檢查 URL 是否已配置 (FORM_URL 可熱更新，每次呼叫都比對；同一網址只輸出一次訊息)
+    global _firebase_ready
+    url = FORM_URL
+    if _firebase_ready[0] == url:
+        return _firebase_ready[1]
+    if "YOUR_GOOGLE_FORM_SUBMIT_URL" in url:
         print("[SHEETS ERROR] 請先在 firestore_logging.py 中填寫 FORM_URL 和 FIELD_IDS！")
-        return False
-    print("[SHEETS] Google Sheets API (Forms) 服務已準備就緒。")
-    return True
+        _firebase_ready = (url, False)
+    else:
+        print("[SHEETS] Google Sheets API (Forms) 服務已準備就緒。")
+        _firebase_ready = (url, True)
+    return _firebase_ready[1]
+
+
+class AlertLogQueue:
+    """有界佇列 + 背景送出線程 + SQLite 暫存檔的非同步警報紀錄器"""
+    def __init__(self, spool_path=SPOOL_DB_PATH, maxsize=QUEUE_MAXSIZE):
+        self.spool_path = spool_path
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._stop = threading.Event()
+        self._idle = threading.Event()
+        self._thread = None
+        self.dropped = 0 # 佇列已滿而丟棄的筆數
+        self.sent = 0
+        self.failed_attempts = 0
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="alert-log-sender", daemon=True)
+            self._thread.start()
+
+    def submit(self, form_data):
+        """O(1) 放入佇列；佇列滿時丟棄並計數，絕不阻塞呼叫端"""
+        try:
+            self._queue.put_nowait(form_data)
+            self._idle.clear()
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def flush(self, timeout=5.0):
+        """等待佇列與暫存檔清空 (用於程式結束前)，回傳是否完成"""
+        return self._idle.wait(timeout)
+
+    def stop(self, timeout=5.0):
+        self.flush(timeout)
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    # --- 背景線程 ---
+
+    def _run(self):
+        db = sqlite3.connect(self.spool_path)
+        db.execute("CREATE TABLE IF NOT EXISTS pending ("
+                   "id INTEGER PRIMARY KEY AUTOINCREMENT, payload TEXT NOT NULL, created REAL NOT NULL)")
+        db.commit()
+        session = requests.Session()
+        session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=2))
+
+        backoff = 0.0
+        next_attempt = 0.0
+        while not self._stop.is_set():
+            # 1. 先把佇列內容寫入暫存檔，確保離線 / 重開機時不遺失
+            # 退避期間最多等到下次重試時間，其餘時候每秒醒來一次
+            wait = max(0.01, next_attempt - time.time()) if backoff else 1.0
+            items = []
+            try:
+                items.append(self._queue.get(timeout=wait))
+                while True:
+                    items.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            self._spool(db, items)
+
+            if time.time() < next_attempt:
+                continue
+
+            # 2. 依序送出暫存中的警報
+            rows = db.execute("SELECT id, payload FROM pending ORDER BY id LIMIT ?", (BATCH_SIZE,)).fetchall()
+            if not rows:
+                if self._queue.empty():
+                    self._idle.set()
+                continue
+
+            for row_id, payload in rows:
+                ok = self._send(session, json.loads(payload))
+                if ok is None:
+                    # 網路或伺服器暫時性錯誤：指數退避後重試
+                    self.failed_attempts += 1
+                    backoff = min(RETRY_MAX_SEC, backoff * 2 if backoff else RETRY_BASE_SEC)
+                    next_attempt = time.time() + backoff * (0.5 + random.random() / 2)
+                    break
+                # 成功，或資料本身有誤 (4xx) 無法重送：都從暫存移除
+                db.execute("DELETE FROM pending WHERE id = ?", (row_id,))
+                db.commit()
+                backoff = 0.0
+                next_attempt = 0.0
+
+        # 結束前把佇列中剩餘的警報寫入暫存檔，下次啟動時補送
+        items = []
+        try:
+            while True:
+                items.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        self._spool(db, items)
+        session.close()
+        db.close()
+
+    def _spool(self, db, items):
+        if items:
+            db.executemany("INSERT INTO pending (payload, created) VALUES (?, ?)",
+                           [(json.dumps(i, ensure_ascii=False), time.time()) for i in items])
+            db.commit()
+
+    def _send(self, session, form_data):
+        """送出單筆；成功回傳 True，資料錯誤 (不重送) 回傳 False，暫時性錯誤回傳 None"""
+        start = time.perf_counter()
+        try:
+            response = session.post(FORM_URL, data=form_data, timeout=REQUEST_TIMEOUT)
+        except requests.exceptions.RequestException as e:
+            print(f"[SHEETS ERROR] 寫入 Google Sheets 失敗，稍後重試: {e}")
+            return None
+        finally:
+            SEND_SECONDS.observe(time.perf_counter() - start)
+
+        if response.status_code == 429 or response.status_code >= 500:
+            print(f"[SHEETS ERROR] 伺服器暫時無法處理 (HTTP {response.status_code})，稍後重試。")
+            return None
+        if response.status_code >= 400:
+            print(f"[SHEETS ERROR] 表單拒絕此筆紀錄 (HTTP {response.status_code})，請檢查 FORM_URL 或 FIELD_IDS。")
+            return False
+
+        self.sent += 1
+        print(f"[SHEETS] {form_data.get(FIELD_IDS['ALERT_TYPE'], '')} 警報已記錄 (HTTP Status: {response.status_code})。")
+        return True
+
+
+_alert_queue = None
+_alert_queue_lock = threading.Lock()
+
+# --- 執行期指標 (輸出時才讀取佇列狀態) ---
+SEND_SECONDS = Histogram('alert_log_send_seconds', "單筆警報送出 Google Forms 的耗時")
+Gauge('alert_log_queue_depth', "記憶體佇列中等待寫入暫存檔的警報數").set_function(
+    lambda: _alert_queue.depth() if _alert_queue else 0)
+Counter('alert_log_sent_total', "成功送出的警報數").set_function(
+    lambda: _alert_queue.sent if _alert_queue else 0)
+Counter('alert_log_dropped_total', "佇列已滿而丟棄的警報數").set_function(
+    lambda: _alert_queue.dropped if _alert_queue else 0)
+Counter('alert_log_failed_attempts_total', "暫時性錯誤而延後重試的次數").set_function(
+    lambda: _alert_queue.failed_attempts if _alert_queue else 0)
+
+
+def get_alert_queue():
+    """取得 (必要時建立並啟動) 全域警報紀錄佇列"""
+    global _alert_queue
+    with _alert_queue_lock:
+        if _alert_queue is None:
+            _alert_queue = AlertLogQueue()
+            _alert_queue.start()
+        return _alert_queue
+
+
+def log_alert_to_firestore(alert_type, score, details="", rider_id=None):
+    # 建立表單資料後放入非同步佇列，立即返回 (不在偵測迴圈中等待網路)
 
-def log_alert_to_firestore(alert_type, score, details=""):
-    # 使用 Google Forms POST 請求將資料寫入
-    
     if not initialize_firebase():
         return
 
-    try:
-        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        
-        # 建立 POST 數據
-        form_data = {
-            FIELD_IDS["ALERT_TYPE"]: f"{alert_type} ({details})",
-            FIELD_IDS["SAFETY_SCORE"]: str(score),
-            FIELD_IDS["TIMESTAMP"]: current_time,
-            "entry.9999999999": "Rider_A001" # 假設有一個額外欄位用於 rider ID
-        }
-        
-        # 發送 POST 請求
-        response = requests.post(FORM_URL, data=form_data)
-        response.raise_for_status() # 檢查是否有 HTTP 錯誤
-        
-        print(f"[SHEETS] {alert_type} 警報已記錄 (HTTP Status: {response.status_code})。")
-
-    except requests.exceptions.RequestException as e:
-        print(f"[SHEETS ERROR] 寫入 Google Sheets 失敗: {e}")
-        print("請檢查網路連線、FORM_URL 或 FIELD_IDS 是否正確。")
-        
+    current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    # 建立 POST 數據 (時間戳記為事件發生時間，而非實際送出時間)
+    form_data = {
+        FIELD_IDS["ALERT_TYPE"]: f"{alert_type} ({details})",
+        FIELD_IDS["SAFETY_SCORE"]: str(score),
+        FIELD_IDS["TIMESTAMP"]: current_time,
+        FIELD_IDS["RIDER_ID"]: rider_id or RIDER_ID,
+    }
+
+    if not get_alert_queue().submit(form_data):
+        print(f"[SHEETS ERROR] 紀錄佇列已滿，{alert_type} 警報被丟棄。")
+
     return
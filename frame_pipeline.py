@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+frame_pipeline.py
+擷取 / 推論 / 顯示 分段管線的共用元件：最新幀槽位 (丟棄過期幀) 與各階段耗時統計。
+"""
+import threading
+import time
+
+
+# --- 1. 最新幀槽位 ---
+
+class LatestFrameSlot:
+    """容量為 1 的槽位：新幀直接覆蓋尚未被取走的舊幀，不排隊，避免幀堆積在 Dlib 後面"""
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._item = None
+        self._seq = 0
+        self._closed = False
+        self.dropped = 0 # 被新幀覆蓋 (未處理就丟棄) 的幀數
+
+    def put(self, item):
+        """放入一幀；若舊幀還沒被取走則丟棄它。回傳此幀的序號"""
+        with self._cond:
+            if self._item is not None:
+                self.dropped += 1
+            self._seq += 1
+            self._item = (self._seq, item)
+            self._cond.notify()
+            return self._seq
+
+    def get(self, timeout=None):
+        """取出最新一幀 (seq, item)；逾時或槽位已關閉時回傳 None"""
+        with self._cond:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while self._item is None and not self._closed:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+            item, self._item = self._item, None
+            return item
+
+    def close(self):
+        """關閉槽位，喚醒所有等待中的消費者"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    @property
+    def closed(self):
+        return self._closed
+
+
+# --- 2. 各階段耗時統計 ---
+
+def percentile(sorted_values, q):
+    """以最近排名法取已排序序列的第 q 百分位數 (0~100)"""
+    if not sorted_values:
+        return 0.0
+    index = int(round(q / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[min(len(sorted_values) - 1, max(0, index))]
+
+
+class StageTimings:
+    """
+    記錄每個階段的最近耗時、平滑平均與最大值 (毫秒)，可跨線程讀取。
+    keep_samples=True 時保留所有樣本以計算百分位數 (基準測試用，即時運行請勿開啟)
+    histogram: 可選的 metrics.Histogram (標籤為 stage)，每次記錄時一併寫入
+    """
+    def __init__(self, smoothing=0.9, keep_samples=False, histogram=None):
+        self.smoothing = smoothing
+        self.keep_samples = keep_samples
+        self.histogram = histogram
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._samples = {}
+
+    def record(self, stage, seconds):
+        if self.histogram is not None:
+            self.histogram.labels(stage).observe(seconds)
+        ms = seconds * 1000.0
+        with self._lock:
+            if self.keep_samples:
+                self._samples.setdefault(stage, []).append(ms)
+            stat = self._stats.get(stage)
+            if stat is None:
+                self._stats[stage] = {'last_ms': ms, 'avg_ms': ms, 'max_ms': ms, 'count': 1}
+                return
+            stat['last_ms'] = ms
+            stat['avg_ms'] = stat['avg_ms'] * self.smoothing + ms * (1 - self.smoothing)
+            if ms > stat['max_ms']:
+                stat['max_ms'] = ms
+            stat['count'] += 1
+
+    def snapshot(self):
+        """回傳目前所有階段統計的複本 {stage: {...}}"""
+        with self._lock:
+            return {stage: dict(stat) for stage, stat in self._stats.items()}
+
+    def format_line(self, stages=None):
+        """產生單行摘要，例如 'detect 85.1ms | predict 6.2ms'"""
+        snap = self.snapshot()
+        names = stages if stages is not None else list(snap)
+        return " | ".join(f"{name} {snap[name]['avg_ms']:.1f}ms" for name in names if name in snap)
+
+    def percentiles(self, stage, qs=(50, 95, 99)):
+        """回傳 {q: ms}；需以 keep_samples=True 建立"""
+        with self._lock:
+            values = sorted(self._samples.get(stage, ()))
+        return {q: percentile(values, q) for q in qs}
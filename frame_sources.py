@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+frame_sources.py
+影像來源抽象：PiCamera、影片檔與圖片資料夾皆以相同介面提供 (擷取時間, BGR 影像)，
+讓偵測管線與基準測試可以在沒有 PiCamera 的一般 Linux 環境執行。
+"""
+import os
+import time
+
+import cv2
+
+# PiCamera 僅在 RPi 上可用，其他環境仍可使用影片 / 圖片來源
+try:
+    import picamera
+    import picamera.array
+except ImportError:
+    picamera = None
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+class PiCameraSource:
+    """PiCamera 即時影像來源 (use_video_port 連續擷取)"""
+    def __init__(self, resolution=(640, 480), framerate=30, rotation=180):
+        self.resolution = resolution
+        self.framerate = framerate
+        self.rotation = rotation
+        self.camera = None
+        self._output = None
+
+    def __enter__(self):
+        if picamera is None:
+            raise RuntimeError("picamera 模組未安裝，無法使用 PiCamera 來源")
+        self.camera = picamera.PiCamera()
+        self.camera.resolution = self.resolution
+        self.camera.rotation = self.rotation
+        self.camera.framerate = self.framerate
+        self._output = picamera.array.PiRGBArray(self.camera, size=self.resolution)
+        return self
+
+    def frames(self):
+        # PiRGBArray 每次擷取都會建立新的陣列，可直接交給其他線程
+        for frame_raw in self.camera.capture_continuous(self._output, format="bgr", use_video_port=True):
+            yield time.time(), frame_raw.array
+            self._output.truncate(0)
+
+    def set_framerate(self, fps):
+        """擷取中調整感光元件幀率 (framerate 擷取中不可修改，改以 framerate_delta 調整)"""
+        if self.camera is not None:
+            self.camera.framerate_delta = min(fps, self.framerate) - self.framerate
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._output is not None:
+            self._output.close()
+        if self.camera is not None:
+            self.camera.close()
+
+
+class VideoFileSource:
+    """
+    影片檔來源。擷取時間依影片時間軸推算 (開始時間 + 幀序 / FPS)，重播結果與執行速度無關；
+    realtime=True 時會依影片 FPS 節流，模擬即時相機。
+    """
+    def __init__(self, path, realtime=False, fps=None):
+        self.path = path
+        self.realtime = realtime
+        self.fps = fps
+        self._cap = None
+
+    def __enter__(self):
+        self._cap = cv2.VideoCapture(self.path)
+        if not self._cap.isOpened():
+            raise IOError(f"無法開啟影片檔: {self.path}")
+        if not self.fps:
+            self.fps = self._cap.get(cv2.CAP_PROP_FPS) or 30.0
+        return self
+
+    def frames(self):
+        start = time.time()
+        index = 0
+        while True:
+            ok, image = self._cap.read()
+            if not ok:
+                break
+            capture_time = start + index / self.fps
+            if self.realtime:
+                delay = capture_time - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            yield capture_time, image
+            index += 1
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._cap is not None:
+            self._cap.release()
+
+
+class ImageDirSource:
+    """圖片資料夾來源：依檔名排序，以固定 FPS 產生擷取時間"""
+    def __init__(self, path, fps=30.0, realtime=False):
+        self.path = path
+        self.fps = fps
+        self.realtime = realtime
+        self.files = []
+
+    def __enter__(self):
+        self.files = sorted(
+            os.path.join(self.path, name) for name in os.listdir(self.path)
+            if name.lower().endswith(IMAGE_EXTENSIONS)
+        )
+        if not self.files:
+            raise IOError(f"資料夾中沒有圖片: {self.path}")
+        return self
+
+    def frames(self):
+        start = time.time()
+        for index, filename in enumerate(self.files):
+            image = cv2.imread(filename)
+            if image is None:
+                print(f"[SOURCE] 無法讀取圖片，略過: {filename}")
+                continue
+            capture_time = start + index / self.fps
+            if self.realtime:
+                delay = capture_time - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            yield capture_time, image
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+
+def open_frame_source(spec, resolution=(640, 480), framerate=30, realtime=False):
+    """
+    依字串建立影像來源：
+    'picamera' → PiCameraSource；資料夾 → ImageDirSource；其他路徑 → VideoFileSource
+    """
+    if spec == 'picamera':
+        return PiCameraSource(resolution, framerate)
+    if os.path.isdir(spec):
+        return ImageDirSource(spec, fps=framerate, realtime=realtime)
+    return VideoFileSource(spec, realtime=realtime)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+head_pose.py
+以 68 點地標中的 6 個點 (鼻尖、下巴、眼角、嘴角) 與通用 3D 臉部模型執行 solvePnP，估計頭部的 pitch / yaw / roll。
+相機矩陣依影像大小快取，上一幀的旋轉 / 平移向量作為下一幀的初始值 (迭代次數少且結果穩定)，
+輸入點使用預先配置的緩衝區，每幀不重新配置記憶體。角度為相對於相機的角度。
+"""
+from math import degrees, atan2, sqrt
+
+import cv2
+import numpy as np
+
+# 通用 3D 臉部模型 (單位 mm，鼻尖為原點)，順序對應 POSE_LANDMARKS
+MODEL_POINTS = np.array([
+    (0.0, 0.0, 0.0),          # 鼻尖 (30)
+    (0.0, -330.0, -65.0),     # 下巴 (8)
+    (-225.0, 170.0, -135.0),  # 左眼外眼角 (36)
+    (225.0, 170.0, -135.0),   # 右眼外眼角 (45)
+    (-150.0, -150.0, -125.0), # 左嘴角 (48)
+    (150.0, -150.0, -125.0),  # 右嘴角 (54)
+], dtype=np.float64)
+POSE_LANDMARKS = np.array([30, 8, 36, 45, 48, 54])
+
+
+def rotation_to_euler(rvec):
+    """旋轉向量 → (pitch, yaw, roll) 角度；pitch 正值為抬頭、負值為低頭"""
+    R, _ = cv2.Rodrigues(rvec)
+    sy = sqrt(R[0, 0] * R[0, 0] + R[1, 0] * R[1, 0])
+    if sy > 1e-6:
+        pitch = degrees(atan2(R[2, 1], R[2, 2]))
+        yaw = degrees(atan2(-R[2, 0], sy))
+        roll = degrees(atan2(R[1, 0], R[0, 0]))
+    else:
+        pitch = degrees(atan2(-R[1, 2], R[1, 1]))
+        yaw = degrees(atan2(-R[2, 0], sy))
+        roll = 0.0
+    # 模型的 y 軸朝上、影像的 y 軸朝下，正面時 pitch 約為 ±180，換算成以正面為 0
+    pitch = pitch - 180.0 if pitch > 0 else pitch + 180.0
+    return -pitch, yaw, roll
+
+
+class HeadPoseEstimator:
+    """每個偵測線程一個實例 (內含可重複使用的緩衝區與上一幀的解)"""
+    def __init__(self, focal_scale=1.0):
+        self.focal_scale = focal_scale # 焦距 ≈ 影像寬度 x focal_scale (未校正相機的常用近似)
+        self._frame_size = None
+        self.camera_matrix = None
+        self.dist_coeffs = np.zeros((4, 1), dtype=np.float64)
+        self.image_points = np.zeros((len(POSE_LANDMARKS), 2), dtype=np.float64)
+        self.rvec = None
+        self.tvec = None
+
+    def _camera_for(self, frame_shape):
+        height, width = frame_shape[:2]
+        if self._frame_size != (width, height):
+            focal = width * self.focal_scale
+            self.camera_matrix = np.array([[focal, 0, width / 2.0],
+                                           [0, focal, height / 2.0],
+                                           [0, 0, 1]], dtype=np.float64)
+            self._frame_size = (width, height)
+            self.reset()
+        return self.camera_matrix
+
+    def reset(self):
+        """人臉遺失後呼叫，下次從頭求解"""
+        self.rvec = None
+        self.tvec = None
+
+    def estimate(self, landmarks, frame_shape):
+        """landmarks: (68, 2) 陣列；返回 (pitch, yaw, roll) 角度，求解失敗時返回 None"""
+        camera = self._camera_for(frame_shape)
+        self.image_points[:] = landmarks[POSE_LANDMARKS]
+        if self.rvec is None:
+            ok, rvec, tvec = cv2.solvePnP(MODEL_POINTS, self.image_points, camera, self.dist_coeffs,
+                                          flags=cv2.SOLVEPNP_ITERATIVE)
+        else:
+            ok, rvec, tvec = cv2.solvePnP(MODEL_POINTS, self.image_points, camera, self.dist_coeffs,
+                                          self.rvec, self.tvec, useExtrinsicGuess=True,
+                                          flags=cv2.SOLVEPNP_ITERATIVE)
+        if not ok:
+            self.reset()
+            return None
+        self.rvec, self.tvec = rvec, tvec
+        return rotation_to_euler(rvec)
+
+
+def synthetic_landmarks(pitch=0.0, yaw=0.0, roll=0.0, frame_shape=(480, 640), distance=1500.0):
+    """將 3D 模型依指定角度投影成 68 點陣列 (只有姿態用的 6 點有意義)，供基準測試與驗證使用"""
+    height, width = frame_shape[:2]
+    camera = np.array([[width, 0, width / 2.0], [0, width, height / 2.0], [0, 0, 1]], dtype=np.float64)
+    # 正面姿態：繞 x 軸 180 度 (模型 y 軸朝上 → 影像 y 軸朝下)
+    rx, ry, rz = np.radians([180.0 - pitch, yaw, roll])
+    Rx = np.array([[1, 0, 0], [0, np.cos(rx), -np.sin(rx)], [0, np.sin(rx), np.cos(rx)]])
+    Ry = np.array([[np.cos(ry), 0, np.sin(ry)], [0, 1, 0], [-np.sin(ry), 0, np.cos(ry)]])
+    Rz = np.array([[np.cos(rz), -np.sin(rz), 0], [np.sin(rz), np.cos(rz), 0], [0, 0, 1]])
+    rvec, _ = cv2.Rodrigues(Rz @ Ry @ Rx)
+    points, _ = cv2.projectPoints(MODEL_POINTS, rvec, np.array([0.0, 0.0, distance]), camera, np.zeros((4, 1)))
+    landmarks = np.tile(np.array([width / 2.0, height / 2.0]), (68, 1))
+    landmarks[POSE_LANDMARKS] = points.reshape(-1, 2)
+    return landmarks
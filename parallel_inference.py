@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+parallel_inference.py
+多程序推論：人臉偵測、地標預測與頭部姿態在數個子程序中平行執行，繞過 GIL 使用 Pi 4 的多個核心。
+
+  - 影像放在 multiprocessing.RawArray 共享記憶體的固定槽位中，佇列只傳遞槽位編號與序號，不 pickle 640x480 陣列
+  - 槽位數等於子程序數：沒有空槽位時擷取端照常以最新幀覆蓋舊幀，不會在子程序前排隊累積延遲
+  - 結果依派送序號重新排序後才交給 FatigueState，計分順序與單線程模式相同
+  - 以 fork 建立子程序 (Linux)，子程序直接共用父程序已載入的模型記憶體 (copy-on-write)，不需各自重新載入
+
+取捨：人臉追蹤 (FaceLocalizer) 與頭部姿態 (HeadPoseEstimator) 的跨幀狀態在每個子程序各有一份，
+幀由共用佇列派送給空閒的子程序，因此每個子程序大約只看到每 N 幀中的一幀 (N 為子程序數)：
+  - 追蹤框來自約 N 幀前 (30 FPS、N = 3 時約 0.1 秒)，通常仍在 search_padding 的搜尋範圍內；
+    頭部移動較快時 IOU 低於 min_iou 的機會變高，會較常退回完整偵測 (偵測次數見 localizer_counters)
+  - 姿態估計只把上一次的結果當作 solvePnP 的初始值，較舊的初始值主要影響收斂速度，幾乎不影響結果；
+    點頭判斷在父程序的 FatigueState 中依擷取時間計算，不受影響
+  - 未採用的做法：追蹤留在父程序只送出人臉裁切，會讓最耗時的偵測回到單一核心；
+    依固定鍵 (例如攝影機) 派送時只有一支攝影機，等於只使用一個子程序
+需要逐幀連續追蹤時 (例如偵測幀率很低的機型)，將 --workers 設為 0 (單一推論線程) 或 1
+"""
+import multiprocessing
+import queue
+import signal
+import threading
+import time
+
+import numpy as np
+
+
+class _StageLog(list):
+    """子程序內與 StageTimings 相同的 record() 介面，耗時隨結果送回父程序記錄"""
+    def record(self, stage, seconds):
+        self.append((stage, seconds))
+
+
+def _worker_main(worker_id, buffer, slot_bytes, tasks, results, measure, counters):
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # Ctrl-C 由父程序處理
+    pool = np.frombuffer(buffer, dtype=np.uint8)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        seq, slot, shape = task
+        start = slot * slot_bytes
+        image = pool[start:start + int(np.prod(shape))].reshape(shape)
+        stages = _StageLog()
+        try:
+            measurement, error = measure(image, stages), None
+        except Exception as e:
+            measurement, error = None, str(e)
+        results.put((seq, slot, worker_id, measurement, stages, error, counters() if counters else None))
+
+
+class ParallelAnalyzer:
+    """
+    workers: 子程序數 (建議 ≤ CPU 核心數 - 1，保留一個核心給擷取與計分)
+    frame_shape: 最大的影像尺寸 (h, w, c)，決定每個共享槽位的大小
+    measure: measure(image, timings) → 量測結果 (在子程序中執行，需可 pickle 回傳)
+    counters: 可選的 counters() → 子程序內的計數 (例如偵測 / 追蹤次數)，隨結果回傳
+    """
+    def __init__(self, workers, frame_shape, measure, counters=None):
+        self.workers = max(1, int(workers))
+        self.slot_bytes = int(np.prod(frame_shape))
+        context = multiprocessing.get_context('fork')
+        self._buffer = context.RawArray('B', self.slot_bytes * self.workers)
+        self._pool = np.frombuffer(self._buffer, dtype=np.uint8)
+        self._tasks = context.SimpleQueue()
+        self._results = context.Queue()
+        self._free_slots = queue.Queue()
+        for slot in range(self.workers):
+            self._free_slots.put(slot)
+
+        self._processes = [
+            context.Process(target=_worker_main, name=f"inference-{i}", daemon=True,
+                            args=(i, self._buffer, self.slot_bytes, self._tasks, self._results, measure, counters))
+            for i in range(self.workers)
+        ]
+        self._lock = threading.Lock()
+        self._next_submit = 0
+        self._next_emit = 0
+        self._pending = {} # 派送序號 → 父程序保留的附帶資料 (擷取時間、原始影像等)
+        self._done = {} # 已完成但還沒輪到的結果 (重新排序緩衝)
+        self.worker_counters = {}
+        self.errors = 0
+
+    def start(self):
+        for process in self._processes:
+            process.start()
+        print(f"[PARALLEL] 已啟動 {self.workers} 個推論子程序")
+        return self
+
+    def acquire_slot(self, timeout=None):
+        """等待空的共享槽位，逾時回傳 None；取得後須以 submit() 或 release_slot() 歸還"""
+        try:
+            return self._free_slots.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def release_slot(self, slot):
+        self._free_slots.put(slot)
+
+    def submit(self, slot, image, meta=None):
+        """將影像複製到共享槽位並派送給子程序；meta 留在父程序，於 get() 時一併返回"""
+        if image.nbytes > self.slot_bytes:
+            self.release_slot(slot)
+            raise ValueError(f"影像 {image.shape} 超過共享槽位大小 ({self.slot_bytes} bytes)")
+        start = slot * self.slot_bytes
+        self._pool[start:start + image.nbytes].reshape(image.shape)[:] = image
+        with self._lock:
+            seq = self._next_submit
+            self._next_submit += 1
+            self._pending[seq] = meta
+        self._tasks.put((seq, slot, image.shape))
+        return seq
+
+    def get(self, timeout=None):
+        """
+        依派送順序取出下一個結果 (seq, meta, measurement, stages)；逾時回傳 None。
+        子程序執行失敗的幀 measurement 為 None
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                if self._next_emit in self._done:
+                    seq = self._next_emit
+                    self._next_emit += 1
+                    measurement, stages = self._done.pop(seq)
+                    return seq, self._pending.pop(seq), measurement, stages
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return None
+            try:
+                seq, slot, worker_id, measurement, stages, error, counters = self._results.get(timeout=remaining)
+            except queue.Empty:
+                return None
+            self.release_slot(slot)
+            if counters is not None:
+                self.worker_counters[worker_id] = counters
+            if error is not None:
+                self.errors += 1
+                print(f"\n[PARALLEL ERROR] 子程序 {worker_id} 處理第 {seq} 幀失敗: {error}\n", end="")
+            with self._lock:
+                self._done[seq] = (measurement, stages)
+
+    @property
+    def in_flight(self):
+        """已派送但尚未依序取出的幀數"""
+        with self._lock:
+            return self._next_submit - self._next_emit
+
+    def healthy(self):
+        return all(process.is_alive() for process in self._processes)
+
+    def counter_total(self, index):
+        """各子程序回報計數的總和 (counters() 回傳 tuple 時的第 index 項)"""
+        return sum(values[index] for values in list(self.worker_counters.values()))
+
+    def close(self, timeout=2.0):
+        for _ in self._processes:
+            self._tasks.put(None)
+        deadline = time.monotonic() + timeout
+        for process in self._processes:
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.terminate()
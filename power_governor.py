@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+power_governor.py
+擷取速率調節器：騎士明顯清醒時降低分析幀率 (省 CPU、降溫、省電)，
+EAR/MAR 接近閾值、有扣分或人臉遺失時立即回到最高幀率。
+
+  - 升速立即生效；降速需連續清醒 DOWNSHIFT_HOLD_SEC 秒，且一次只降一級 (避免來回切換)
+  - 擷取線程以 admit() 依目前目標幀率丟棄多餘的幀；PiCamera 另以 framerate_delta 降低感光元件幀率
+  - FatigueState 以擷取時間計算所有持續時間，幀率改變不影響計分 (最低幀率需高於 1 / MAX_SAMPLE_GAP_SEC)
+"""
+import time
+
+from metrics import Counter, Gauge
+
+GOVERNOR_FPS = Gauge('governor_target_fps', "調節器目前的目標幀率")
+GOVERNOR_LEVEL = Gauge('governor_level', "調節器等級 (0 為最高幀率)")
+GOVERNOR_TRANSITIONS = Counter('governor_transitions_total', "調節器切換次數", ['direction'])
+GOVERNOR_SKIPPED = Counter('governor_skipped_frames_total', "因降低幀率而未分析的擷取幀數")
+
+FPS_LEVELS = (30, 20, 12) # 由高到低；最低一級仍足以量測 100ms 以上的眨眼
+DOWNSHIFT_HOLD_SEC = 10.0 # 連續清醒多久才降一級
+EAR_MARGIN = 1.25 # EAR 持續低於閉眼閾值 x 1.25 (超過 BLINK_MAX_SEC，排除正常眨眼) 視為接近閾值
+MAR_MARGIN = 0.7 # MAR 高於哈欠閾值 x 0.7 視為接近閾值
+
+
+class FrameRateGovernor:
+    """
+    observe() 由推論線程在每次計分後呼叫；admit() 由擷取線程在每幀呼叫。
+    兩者的時間都是幀的擷取時間 (影像來源給的 time.time() 時鐘)，不可混用 perf_counter
+    on_change: 可選的 on_change(fps)，目標幀率改變時呼叫 (例如調整相機幀率)
+    """
+    def __init__(self, levels=FPS_LEVELS, hold_sec=DOWNSHIFT_HOLD_SEC, on_change=None):
+        self.levels = tuple(sorted(levels, reverse=True))
+        self.hold_sec = hold_sec
+        self.on_change = on_change
+        self.level = 0
+        self.target_fps = float(self.levels[0])
+        self.calm_since = None
+        self.low_ear_since = None # EAR 開始低於閾值 x EAR_MARGIN 的時間
+        self.reason = 'start'
+        self._next_admit = 0.0
+        self.skipped = 0
+        self._publish()
+
+    def _publish(self):
+        GOVERNOR_FPS.set(self.target_fps)
+        GOVERNOR_LEVEL.set(self.level)
+
+    def _set_level(self, level, reason):
+        if level == self.level:
+            return
+        direction = 'up' if level < self.level else 'down'
+        self.level = level
+        self.target_fps = float(self.levels[level])
+        self.reason = reason
+        self._publish()
+        GOVERNOR_TRANSITIONS.labels(direction).inc()
+        print(f"\n[GOVERNOR] 幀率 {'提高' if direction == 'up' else '降低'}至 {self.target_fps:.0f} FPS ({reason})\n", end="")
+        if self.on_change is not None:
+            try:
+                self.on_change(self.target_fps)
+            except Exception as e:
+                print(f"\n[GOVERNOR] 無法調整相機幀率: {e}\n", end="")
+
+    def alert_reason(self, result, state, current_time):
+        """需要最高幀率的原因；明顯清醒時回傳 None (短於 BLINK_MAX_SEC 的閉眼視為正常眨眼)"""
+        if result['landmarks'] is None:
+            self.low_ear_since = None
+            return '人臉遺失'
+        if result['ear'] < state.CLOSED_EAR_THRESHOLD * EAR_MARGIN:
+            if self.low_ear_since is None:
+                self.low_ear_since = current_time
+        else:
+            self.low_ear_since = None
+        if state.current_score < 100:
+            return '扣分中'
+        if self.low_ear_since is not None and current_time - self.low_ear_since > state.BLINK_MAX_SEC:
+            return 'EAR 持續接近閾值'
+        if state.mouth_open_since is not None or result['mar'] > state.YAWN_MAR_THRESHOLD * MAR_MARGIN:
+            return 'MAR 接近閾值'
+        if state.eye_stats.perclos() >= state.PERCLOS_RECOVER:
+            return 'PERCLOS 偏高'
+        return None
+
+    def observe(self, result, state, current_time):
+        reason = self.alert_reason(result, state, current_time)
+        if reason is not None:
+            self.calm_since = None
+            self._set_level(0, reason)
+            return
+        if self.calm_since is None:
+            self.calm_since = current_time
+        elif current_time - self.calm_since >= self.hold_sec and self.level < len(self.levels) - 1:
+            self._set_level(self.level + 1, f"持續清醒 {current_time - self.calm_since:.0f} 秒")
+            self.calm_since = current_time
+
+    def admit(self, now=None):
+        """擷取線程：依目標幀率決定這一幀 (擷取時間 now，預設為目前時間) 是否送去分析"""
+        now = time.time() if now is None else now
+        interval = 1.0 / self.target_fps
+        if now + 0.1 * interval < self._next_admit:
+            self.skipped += 1
+            GOVERNOR_SKIPPED.inc()
+            return False
+        # 以固定間隔推進 (而非以本幀時間重新起算)，避免相機幀率與目標幀率不整除時實際幀率偏低；
+        # 落後太多時 (例如剛升速) 從本幀重新起算
+        self._next_admit = max(self._next_admit, now - 0.5 * interval) + interval
+        return True
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+risk_channel.py
+Web Server 與偵測端之間的風險提醒通道：
+risk_analysis.json 以原子方式寫入 (暫存檔 + os.replace)，內容變動時再透過本機 UDP 通知訂閱端，
+偵測端收到通知才讀檔，不需要定期輪詢，也不會讀到寫到一半的 JSON。
+"""
+import json
+import os
+import socket
+import tempfile
+import time
+
+RISK_CHANNEL_HOST = '127.0.0.1'
+RISK_CHANNEL_PORT = 50555 # 偵測端監聽的本機 UDP 埠
+FALLBACK_POLL_SEC = 30 # 無法綁定 UDP 埠時，改以檔案 mtime 檢查的間隔
+
+
+def write_json_atomic(path, data):
+    """先寫入同一資料夾的暫存檔再 os.replace，讀取端只會看到完整的舊檔或新檔"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.risk_', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def publish_change(path, host=RISK_CHANNEL_HOST, port=RISK_CHANNEL_PORT):
+    """送出一個 UDP 變更通知 (沒有訂閱端時直接忽略)"""
+    message = json.dumps({'path': os.path.abspath(path), 'time': time.time()}).encode('utf-8')
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.sendto(message, (host, port))
+    except OSError:
+        pass
+    finally:
+        sock.close()
+
+
+class RiskPublisher:
+    """Web Server 端：只有提醒內容真的改變時才寫檔並通知"""
+    def __init__(self, path, host=RISK_CHANNEL_HOST, port=RISK_CHANNEL_PORT):
+        self.path = path
+        self.host = host
+        self.port = port
+        self._last_content = None
+
+    def publish(self, data, content_keys=('reminder', 'reminders')):
+        """data 中 content_keys 的內容有變化才寫入，回傳是否有寫入"""
+        content = json.dumps({key: data.get(key) for key in content_keys}, ensure_ascii=False, sort_keys=True)
+        if content == self._last_content and os.path.exists(self.path):
+            return False
+        write_json_atomic(self.path, data)
+        self._last_content = content
+        publish_change(self.path, self.host, self.port)
+        return True
+
+
+class RiskSubscriber:
+    """偵測端：阻塞等待 UDP 通知 (或逾時)，檔案 mtime / 大小改變才重新讀取"""
+    def __init__(self, path, host=RISK_CHANNEL_HOST, port=RISK_CHANNEL_PORT):
+        self.path = path
+        self._signature = None
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            self._sock.bind((host, port))
+        except OSError as e:
+            print(f"[RISK] 無法監聽 UDP {host}:{port} ({e})，改以每 {FALLBACK_POLL_SEC} 秒檢查檔案。")
+            self._sock.close()
+            self._sock = None
+
+    def read_if_changed(self):
+        """檔案有變動時回傳新內容，否則回傳 None"""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if signature == self._signature:
+            return None
+        with open(self.path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        self._signature = signature
+        return data
+
+    def wait_for_change(self, timeout):
+        """最多等待 timeout 秒；收到通知或逾時後檢查檔案，有變動回傳新內容，否則回傳 None"""
+        if self._sock is None:
+            time.sleep(min(timeout, FALLBACK_POLL_SEC))
+        else:
+            self._sock.settimeout(max(0.1, timeout))
+            try:
+                self._sock.recv(4096)
+                # 合併短時間內的多個通知
+                self._sock.setblocking(False)
+                while True:
+                    self._sock.recv(4096)
+            except (socket.timeout, BlockingIOError):
+                pass
+        return self.read_if_changed()
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+session_analysis.py
+騎乘紀錄檔 (.fsl，見 session_log.py) 的批次分析：一次載入多段騎乘，
+以不同閾值組合重新執行 FatigueState 計分並彙總，不需要戴著安全帽重新騎一次就能調整閾值。
+
+  python session_analysis.py info sessions/
+  python session_analysis.py rescore sessions/ --set CLOSED_EAR_THRESHOLD=0.20,0.22,0.25 --set MICRO_SLEEP_SEC=1.0,1.5 [--jobs 4 | --fast]
+  python session_analysis.py export sessions/rider_20250101_080000.fsl trace.npz   # 供 benchmark.py replay / pose 使用
+"""
+import argparse
+import contextlib
+import glob
+import io
+import itertools
+import json
+import os
+import sys
+
+import numpy as np
+
+from benchmark import AlertRecorder, NullBuzzer
+from fatigue_utils import FatigueState, SCORING_DEFAULTS
+from session_log import FLAG_FACE, FLAG_POSE, open_session
+
+_BUZZER = NullBuzzer() # 所有重播共用 (每個 buzzer 各有一個警報排程線程)
+
+
+def find_sessions(paths):
+    """展開檔案與資料夾 (資料夾內所有 .fsl)，依檔名排序"""
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            found.extend(glob.glob(os.path.join(path, '*.fsl')))
+        else:
+            found.append(path)
+    return sorted(found)
+
+
+def session_info(path):
+    meta, records = open_session(path)
+    face = (records['flags'] & FLAG_FACE) != 0
+    duration = float(records['t'][-1] - records['t'][0]) if len(records) > 1 else 0.0
+    return {
+        'path': path,
+        'rider_id': meta.get('rider_id'),
+        'created': meta.get('created'),
+        'frames': len(records),
+        'duration_s': duration,
+        'face_rate': float(face.mean()) if len(records) else 0.0,
+        'min_score': int(records['score'].min()) if len(records) else None,
+        'landmarks': meta.get('landmarks', False),
+    }
+
+
+def rescore(records, overrides=None):
+    """以 overrides ({閾值: 值}，建立 FatigueState 時套用，含 PERCLOS_WINDOW_SEC 等) 依序重播有人臉的幀；不輸出狀態列"""
+    state = FatigueState(overrides=overrides)
+    recorder = AlertRecorder()
+    state.alert_logger = recorder
+
+    face = (records['flags'] & FLAG_FACE) != 0
+    has_pose = (records['flags'] & FLAG_POSE) != 0
+    t = records['t'][face].tolist()
+    ear = records['ear'][face].astype(np.float64).tolist()
+    mar = records['mar'][face].astype(np.float64).tolist()
+    pitch = np.where(has_pose[face], records['pitch'][face], np.nan).tolist()
+
+    scores = np.empty(len(t), dtype=np.int16)
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(len(t)):
+            p = pitch[i]
+            scores[i] = state.update_score_and_alert(ear[i], mar[i], t[i], 30.0, _BUZZER, pitch=None if p != p else p)
+
+    return dict(_score_summary(np.asarray(t), scores, recorder.counts()), perclos_final=state.eye_stats.perclos())
+
+
+def _score_summary(t, scores, alerts):
+    # 各分數區間的停留時間 (以相鄰幀的時間差計，超過 1 秒的空白不列入)
+    dt = np.minimum(np.diff(t, append=t[-1]), 1.0) if len(t) else np.zeros(0)
+    return {
+        'frames': len(t),
+        'duration_s': float(dt.sum()),
+        'alerts': alerts,
+        'min_score': int(scores.min()) if len(scores) else 100,
+        'warning_s': float(dt[scores < 70].sum()),
+        'critical_s': float(dt[scores < 40].sum()),
+    }
+
+
+def rescore_vectorised(paths, overrides=None):
+    """以 vector_scoring 一次計分所有紀錄檔 (不含點頭判斷)，回傳與 rescore() 相同格式的 list"""
+    from vector_scoring import score_streams
+    ts, ears, mars, ids = [], [], [], []
+    for index, path in enumerate(paths):
+        _, records = open_session(path)
+        face = (records['flags'] & FLAG_FACE) != 0
+        ts.append(np.asarray(records['t'][face]))
+        ears.append(np.asarray(records['ear'][face]))
+        mars.append(np.asarray(records['mar'][face]))
+        ids.append(np.full(len(ts[-1]), index))
+    t, rider = np.concatenate(ts), np.concatenate(ids)
+    result = score_streams(t, np.concatenate(ears), np.concatenate(mars), rider, **(overrides or {}))
+    alert_rider = rider[[i for i, _, _ in result['alerts']]]
+    runs = []
+    for index in range(len(paths)):
+        mask = rider == index
+        alerts = {}
+        for (_, name, _), owner in zip(result['alerts'], alert_rider):
+            if owner == index:
+                alerts[name] = alerts.get(name, 0) + 1
+        runs.append(_score_summary(t[mask], result['score'][mask], alerts))
+    return runs
+
+
+def _rescore_path(args):
+    path, overrides = args
+    _, records = open_session(path)
+    return rescore(records, overrides)
+
+
+def parse_grid(settings):
+    """['NAME=a,b', ...] → [{NAME: a, ...}, ...] (笛卡兒積)；未指定時只有預設值一組"""
+    names, values = [], []
+    for setting in settings or ():
+        name, _, raw = setting.partition('=')
+        if name not in SCORING_DEFAULTS:
+            raise ValueError(f"FatigueState 沒有閾值 {name}")
+        names.append(name)
+        values.append([float(v) for v in raw.split(',') if v])
+    return [dict(zip(names, combo)) for combo in itertools.product(*values)]
+
+
+def rescore_sessions(paths, grid, jobs=1, vectorised=False):
+    """
+    每組閾值 × 每段騎乘重新計分，回傳 [{'overrides', 'sessions', 'alerts', ...}]
+    vectorised=True 時以 vector_scoring 一次計算所有紀錄 (快很多，但不含點頭判斷)
+    """
+    tasks = [(path, overrides) for overrides in grid for path in paths]
+    if vectorised:
+        results = [run for overrides in grid for run in rescore_vectorised(paths, overrides)]
+    elif jobs > 1:
+        import multiprocessing
+        with multiprocessing.Pool(jobs) as pool:
+            results = pool.map(_rescore_path, tasks)
+    else:
+        results = [_rescore_path(task) for task in tasks]
+
+    summary = []
+    for i, overrides in enumerate(grid):
+        runs = results[i * len(paths):(i + 1) * len(paths)]
+        alerts = {}
+        for run in runs:
+            for alert_type, count in run['alerts'].items():
+                alerts[alert_type] = alerts.get(alert_type, 0) + count
+        hours = sum(run['duration_s'] for run in runs) / 3600.0
+        summary.append({
+            'overrides': overrides,
+            'sessions': len(runs),
+            'frames': sum(run['frames'] for run in runs),
+            'alerts': alerts,
+            'alerts_per_hour': sum(alerts.values()) / hours if hours else 0.0,
+            'min_score': min((run['min_score'] for run in runs), default=100),
+            'warning_s': sum(run['warning_s'] for run in runs),
+            'critical_s': sum(run['critical_s'] for run in runs),
+        })
+    return summary
+
+
+def export_trace(path, output):
+    """轉成 benchmark.py 可讀的 NPZ 軌跡 (timestamps / ear / mar / face，有記錄時含 landmarks)"""
+    meta, records = open_session(path)
+    arrays = {
+        'timestamps': np.asarray(records['t']),
+        'ear': np.asarray(records['ear'], dtype=np.float64),
+        'mar': np.asarray(records['mar'], dtype=np.float64),
+        'face': (records['flags'] & FLAG_FACE) != 0,
+    }
+    if meta.get('landmarks'):
+        arrays['landmarks'] = np.asarray(records['landmarks'])
+    np.savez_compressed(output, **arrays)
+    return len(records)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="騎乘紀錄檔的批次分析與閾值調整")
+    parser.add_argument('--json', help="將結果寫入 JSON 檔")
+    sub = parser.add_subparsers(dest='command')
+    info_parser = sub.add_parser('info', help="列出紀錄檔摘要")
+    info_parser.add_argument('paths', nargs='+')
+    rescore_parser = sub.add_parser('rescore', help="以不同閾值重新計分")
+    rescore_parser.add_argument('paths', nargs='+')
+    rescore_parser.add_argument('--set', action='append', dest='settings', metavar='NAME=V1,V2',
+                                help="FatigueState 屬性與候選值，可重複指定 (取笛卡兒積)")
+    rescore_parser.add_argument('--jobs', type=int, default=1, help="平行處理的程序數")
+    rescore_parser.add_argument('--fast', action='store_true', help="使用向量化計分 (vector_scoring.py，不含點頭判斷)")
+    export_parser = sub.add_parser('export', help="轉成 benchmark.py 的 NPZ 軌跡")
+    export_parser.add_argument('path')
+    export_parser.add_argument('output')
+    args = parser.parse_args()
+
+    if args.command == 'info':
+        report = [session_info(path) for path in find_sessions(args.paths)]
+        for info in report:
+            print(f"[SESSION] {info['path']}: {info['rider_id']} {info['created']} | {info['frames']} 幀, "
+                  f"{info['duration_s'] / 60:.1f} 分鐘, 人臉 {info['face_rate']:.0%}, 最低分 {info['min_score']}")
+    elif args.command == 'rescore':
+        paths = find_sessions(args.paths)
+        if not paths:
+            parser.error("找不到紀錄檔")
+        report = rescore_sessions(paths, parse_grid(args.settings), args.jobs, args.fast)
+        for row in sorted(report, key=lambda r: r['alerts_per_hour']):
+            setting = ', '.join(f"{k}={v:g}" for k, v in row['overrides'].items()) or '(預設閾值)'
+            print(f"[RESCORE] {setting:<50} 警報 {sum(row['alerts'].values()):4d} ({row['alerts_per_hour']:.1f}/小時) "
+                  f"最低分 {row['min_score']:3d}  <70: {row['warning_s']:.0f}s  <40: {row['critical_s']:.0f}s  {row['alerts']}")
+    elif args.command == 'export':
+        report = {'records': export_trace(args.path, args.output)}
+        print(f"[SESSION] 已輸出 {report['records']} 幀至 {args.output}")
+    else:
+        parser.print_help()
+        sys.exit(2)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=4)
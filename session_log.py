@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+session_log.py
+騎乘紀錄檔 (.fsl)：每幀一筆固定長度的二進位紀錄，只會附加寫入，可直接以 numpy.memmap 讀取。
+
+  檔頭: MAGIC (8 bytes) + uint32 JSON 長度 + JSON 描述 (騎士、開始時間、欄位格式、閾值)，補齊至 64 bytes 的倍數
+  紀錄: RECORD_DTYPE (32 bytes)；記錄地標時再加上 68 x 2 的 int16 (272 bytes)
+
+程式中斷時最後一筆可能不完整，讀取時自動忽略。
+"""
+import json
+import os
+import struct
+import time
+
+import numpy as np
+
+MAGIC = b'FSLOG\x00\x01\x00'
+HEADER_ALIGN = 64
+
+FLAG_FACE = 1 # 有偵測到人臉
+FLAG_POSE = 2 # pitch 有效
+
+RECORD_FIELDS = [
+    ('t', '<f8'), # 擷取時間 (time.time())
+    ('ear', '<f4'),
+    ('mar', '<f4'),
+    ('pitch', '<f4'), # 頭部俯仰角 (度)，無姿態時為 NaN
+    ('score', '<i2'),
+    ('flags', 'u1'),
+    ('_pad', 'V9'),
+]
+LANDMARK_FIELD = ('landmarks', '<i2', (68, 2))
+
+
+def record_dtype(landmarks=False):
+    return np.dtype(RECORD_FIELDS + ([LANDMARK_FIELD] if landmarks else []))
+
+
+def _encode_header(meta):
+    body = json.dumps(meta, ensure_ascii=False).encode('utf-8')
+    size = len(MAGIC) + 4 + len(body)
+    padding = (-size) % HEADER_ALIGN
+    return MAGIC + struct.pack('<I', len(body) + padding) + body + b' ' * padding
+
+
+def read_header(f):
+    """讀取檔頭，回傳 (meta, 紀錄起始位置)"""
+    magic = f.read(len(MAGIC))
+    if magic != MAGIC:
+        raise ValueError("不是騎乘紀錄檔 (.fsl) 或版本不符")
+    length, = struct.unpack('<I', f.read(4))
+    meta = json.loads(f.read(length).decode('utf-8'))
+    return meta, len(MAGIC) + 4 + length
+
+
+class SessionWriter:
+    """
+    偵測端的紀錄器：append() 只寫入預先配置的緩衝陣列 (O(1))，
+    緩衝滿或超過 flush_sec 時才一次寫入檔案
+    """
+    def __init__(self, path, meta=None, landmarks=False, buffer_records=256, flush_sec=1.0):
+        self.path = path
+        self.landmarks = landmarks
+        self.dtype = record_dtype(landmarks)
+        self.flush_sec = flush_sec
+        self._buffer = np.zeros(buffer_records, dtype=self.dtype)
+        self._count = 0
+        self._last_flush = time.monotonic()
+        self.records = 0
+
+        header = dict(meta or {}, version=1, landmarks=landmarks, record_size=self.dtype.itemsize,
+                      created=time.strftime('%Y-%m-%d %H:%M:%S'))
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._file = open(path, 'wb')
+        self._file.write(_encode_header(header))
+
+    def append(self, t, ear, mar, face, score, pitch=None, landmarks=None):
+        row = self._buffer[self._count]
+        row['t'] = t
+        row['ear'] = ear
+        row['mar'] = mar
+        row['pitch'] = np.nan if pitch is None else pitch
+        row['score'] = score
+        row['flags'] = (FLAG_FACE if face else 0) | (FLAG_POSE if pitch is not None else 0)
+        if self.landmarks:
+            if landmarks is not None:
+                row['landmarks'] = landmarks
+            else:
+                row['landmarks'] = 0
+        self._count += 1
+        if self._count == len(self._buffer) or time.monotonic() - self._last_flush >= self.flush_sec:
+            self.flush()
+
+    def flush(self):
+        if self._count:
+            self._file.write(self._buffer[:self._count].tobytes())
+            self._file.flush()
+            self.records += self._count
+            self._count = 0
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        if self._file.closed:
+            return
+        self.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+
+
+def open_session(path):
+    """以唯讀 memmap 開啟紀錄檔，回傳 (meta, records)；records 為結構化陣列 (不會整個讀入記憶體)"""
+    with open(path, 'rb') as f:
+        meta, offset = read_header(f)
+    dtype = record_dtype(meta.get('landmarks', False))
+    if dtype.itemsize != meta.get('record_size', dtype.itemsize):
+        raise ValueError(f"{path} 的紀錄長度 ({meta.get('record_size')}) 與目前格式 ({dtype.itemsize}) 不符")
+    count = (os.path.getsize(path) - offset) // dtype.itemsize
+    if count <= 0:
+        return meta, np.zeros(0, dtype=dtype)
+    return meta, np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(count,))
+
+
+def session_path(directory, rider_id):
+    """sessions/<騎士 ID>_<開始時間>.fsl"""
+    return os.path.join(directory, f"{rider_id}_{time.strftime('%Y%m%d_%H%M%S')}.fsl")
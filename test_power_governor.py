@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""以模擬騎乘重播 FatigueState + FrameRateGovernor：清醒時幀率確實降低，微睡眠時立即回到最高幀率"""
+import contextlib
+import io
+
+import numpy as np
+
+from benchmark import NullBuzzer
+from fatigue_utils import FatigueState
+from power_governor import FPS_LEVELS, FrameRateGovernor
+
+CAMERA_FPS = 30.0
+
+
+def replay_ride(seconds=300.0, blinks_per_min=16, blink_sec=0.15, micro_sleep_at=None, seed=0):
+    """依相機幀率產生 EAR 串流 (眨眼 + 可選的 2 秒微睡眠)，只分析 governor.admit() 放行的幀；回傳每幀 (時間, 目標幀率)"""
+    rng = np.random.default_rng(seed)
+    t = np.arange(0.0, seconds, 1.0 / CAMERA_FPS)
+    ear = rng.normal(0.30, 0.01, len(t))
+    for start in np.sort(rng.uniform(0, seconds, int(seconds / 60.0 * blinks_per_min))):
+        ear[(t >= start) & (t < start + blink_sec)] = 0.10
+    if micro_sleep_at is not None:
+        ear[(t >= micro_sleep_at) & (t < micro_sleep_at + 2.0)] = 0.10
+
+    state = FatigueState()
+    state.alert_logger = lambda *args, **kwargs: None
+    governor = FrameRateGovernor()
+    buzzer = NullBuzzer()
+    trace = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for ti, e in zip(t.tolist(), ear.tolist()):
+            if not governor.admit(ti):
+                continue
+            score = state.update_score_and_alert(e, 0.08, ti, governor.target_fps, buzzer)
+            governor.observe({'ear': e, 'mar': 0.08, 'score': score, 'landmarks': True}, state, ti)
+            trace.append((ti, governor.target_fps))
+    return np.array(trace)
+
+
+def test_calm_ride_with_normal_blinks_downshifts():
+    trace = replay_ride()
+    downshifted = trace[:, 1] < FPS_LEVELS[0]
+    assert downshifted.mean() > 0.5
+    assert trace[-1, 1] == FPS_LEVELS[-1]
+    # 實際分析的幀數約為相機幀數的一半以下
+    assert len(trace) < 0.6 * 300.0 * CAMERA_FPS
+
+
+def test_micro_sleep_restores_full_rate():
+    trace = replay_ride(micro_sleep_at=200.0)
+    before = trace[(trace[:, 0] > 150.0) & (trace[:, 0] < 200.0)]
+    during = trace[(trace[:, 0] > 201.0) & (trace[:, 0] < 202.0)]
+    assert before[:, 1].max() < FPS_LEVELS[0]
+    assert (during[:, 1] == FPS_LEVELS[0]).all()
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+"""向量化計分 (vector_scoring.score_streams) 必須與 FatigueState 逐幀計分的分數與警報完全一致"""
+import pytest
+
+from vector_scoring import check_consistency, synthetic_fleet
+
+
+@pytest.mark.parametrize('seed, overrides', [
+    (0, {}),
+    (1, {}),
+    (2, {'CLOSED_EAR_THRESHOLD': 0.2, 'MICRO_SLEEP_SEC': 1.0, 'YAWN_CRITICAL_COUNT': 1}),
+    (3, {'PERCLOS_WARN': 0.08, 'PERCLOS_RECOVER': 0.05, 'SLOW_BLINK_SEC': 0.2}),
+    (4, {'PERCLOS_WINDOW_SEC': 30.0, 'PERCLOS_MIN_COVERAGE_SEC': 15.0, 'PERCLOS_WARN': 0.08, 'PERCLOS_RECOVER': 0.05}),
+])
+def test_score_streams_matches_fatigue_state(seed, overrides):
+    t, ear, mar, rider = synthetic_fleet(riders=4, minutes=3, seed=seed)
+    report = check_consistency(t, ear, mar, rider, **overrides)
+    assert report['alerts'] > 0
+    assert report['mismatched_frames'] == 0
+    assert report['mismatched_riders'] == []
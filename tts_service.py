@@ -1,37 +1,259 @@
 # -*- coding: utf-8 -*-
 """
 tts_service.py
-處理語音提醒的生成與播放 (gTTS 和 mpg321)。
+處理語音提醒的生成與播放 (gTTS / 離線 espeak-ng，mpg321 / aplay)。
+語音檔以 (語言, 文本) 的雜湊值快取在本地並以 LRU 控制大小，固定提醒語句在啟動時預先產生，
+離線時也能立即播放。
 """
-from gtts import gTTS
+from collections import OrderedDict
+import hashlib
 import os
+import shutil
 import subprocess
 import threading
 import time
 
-tts_lock = threading.Lock() 
+from metrics import Counter, Histogram
+from config import register_config
 
-def speak_text(text):
-    # 將文本轉換為語音並透過 RPi 的音頻輸出播放。
-    if tts_lock.acquire(blocking=False): 
-        mp3_filename = "temp_alert.mp3"
+try:
+    from gtts import gTTS
+except ImportError:
+    gTTS = None
+
+# --- 語音設定 ---
+DEFAULT_LANG = 'zh-tw'
+TTS_CACHE_DIR = 'tts_cache' # 語音快取資料夾
+TTS_CACHE_MAX_BYTES = 20 * 1024 * 1024 # 快取上限 20 MB，超過時刪除最久未使用的檔案
+TTS_BACKEND_ORDER = ['gtts', 'espeak'] # 依序嘗試的語音合成後端 (gTTS 需網路，espeak-ng 可離線)
+
+# 啟動時預先產生的固定語句
+PRERENDER_PHRASES = [
+    "預測提醒。",
+    "狀態良好，繼續保持。",
+    "警告，根據歷史紀錄，你當前時段為高風險時段。",
+]
+
+# 以設定檔 / 環境變數的 tts 段落覆寫上方常數 (見 config.py)；後端順序可熱更新
+register_config('tts', globals(), hot=('TTS_BACKEND_ORDER',))
+
+# 依副檔名選擇播放器
+PLAYERS = {
+    '.mp3': ["mpg321", "-q"],
+    '.wav': ["aplay", "-q"],
+}
+
+tts_lock = threading.Lock()
+
+# --- 執行期指標 ---
+TTS_SYNTH_SECONDS = Histogram('tts_synthesis_seconds', "快取未命中時合成語音的耗時", ['backend'],
+                              buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0))
+TTS_PLAY_DELAY_SECONDS = Histogram('tts_play_delay_seconds', "呼叫 speak_text 到開始播放的延遲",
+                                   buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0))
+TTS_CACHE_LOOKUPS = Counter('tts_cache_lookups_total', "語音快取查詢次數", ['result'])
+TTS_SKIPPED = Counter('tts_skipped_total', "正在播放而略過的提醒次數")
+
+
+# --- 1. 語音合成後端 ---
+
+class GTTSBackend:
+    """Google TTS (需網路)"""
+    name = 'gtts'
+    ext = '.mp3'
+
+    def available(self):
+        return gTTS is not None
+
+    def synthesize(self, text, lang, path):
+        gTTS(text=text, lang=lang).save(path)
+
+
+class EspeakBackend:
+    """espeak-ng 離線合成 (音質較差，但不需網路)"""
+    name = 'espeak'
+    ext = '.wav'
+    VOICES = {'zh-tw': 'cmn', 'zh': 'cmn', 'en': 'en'}
+
+    def available(self):
+        return shutil.which("espeak-ng") is not None
+
+    def synthesize(self, text, lang, path):
+        voice = self.VOICES.get(lang, lang)
+        subprocess.run(["espeak-ng", "-v", voice, "-w", path, text], check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+BACKENDS = {backend.name: backend for backend in (GTTSBackend(), EspeakBackend())}
+
+
+def register_backend(backend):
+    """加入自訂後端 (需有 name、ext、available()、synthesize(text, lang, path))"""
+    BACKENDS[backend.name] = backend
+
+
+# --- 2. 內容定址的 LRU 語音快取 ---
+
+class AudioCache:
+    """以 sha1(語言 + 文本) 命名的語音檔快取；命中時更新使用順序，超過上限時淘汰最舊的檔案"""
+    def __init__(self, cache_dir=TTS_CACHE_DIR, max_bytes=TTS_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # key → (path, size)，最近使用的在最後
+        self._total = 0
+        self._load_index()
+
+    def _load_index(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        files = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            key, ext = os.path.splitext(name)
+            if ext in PLAYERS and os.path.isfile(path):
+                stat = os.stat(path)
+                files.append((stat.st_mtime, key, path, stat.st_size))
+        for _, key, path, size in sorted(files):
+            self._entries[key] = (path, size)
+            self._total += size
+
+    @staticmethod
+    def key(text, lang):
+        return hashlib.sha1(f"{lang}\n{text}".encode('utf-8')).hexdigest()
+
+    def get(self, text, lang):
+        """命中時回傳檔案路徑並標記為最近使用；未命中回傳 None"""
+        key = self.key(text, lang)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if not os.path.exists(entry[0]):
+                del self._entries[key]
+                self._total -= entry[1]
+                return None
+            self._entries.move_to_end(key)
+        os.utime(entry[0], None) # 重新啟動後仍能以 mtime 還原使用順序
+        return entry[0]
+
+    def put(self, text, lang, backend):
+        """以指定後端合成並存入快取，回傳檔案路徑"""
+        key = self.key(text, lang)
+        path = os.path.join(self.cache_dir, key + backend.ext)
+        tmp_path = path + ".tmp"
+        try:
+            backend.synthesize(text, lang, tmp_path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        os.replace(tmp_path, path) # 合成完成才放入快取，避免播放到不完整的檔案
+        size = os.path.getsize(path)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._total -= old[1]
+            self._entries[key] = (path, size)
+            self._total += size
+            self._evict()
+        return path
+
+    def _evict(self):
+        while self._total > self.max_bytes and len(self._entries) > 1:
+            _, (path, size) = self._entries.popitem(last=False)
+            self._total -= size
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+_audio_cache = None
+_audio_cache_lock = threading.Lock()
+
+
+def get_audio_cache():
+    """取得 (第一次使用時建立) 語音快取；匯入模組時不建立快取資料夾"""
+    global _audio_cache
+    with _audio_cache_lock:
+        if _audio_cache is None:
+            _audio_cache = AudioCache()
+        return _audio_cache
+
+
+def get_audio(text, lang=DEFAULT_LANG):
+    """取得語音檔路徑：先查快取，未命中時依 TTS_BACKEND_ORDER 嘗試合成"""
+    audio_cache = get_audio_cache()
+    path = audio_cache.get(text, lang)
+    TTS_CACHE_LOOKUPS.labels('hit' if path is not None else 'miss').inc()
+    if path is not None:
+        return path
+
+    last_error = None
+    for name in TTS_BACKEND_ORDER:
+        backend = BACKENDS.get(name)
+        if backend is None or not backend.available():
+            continue
+        try:
+            start = time.perf_counter()
+            path = audio_cache.put(text, lang, backend)
+            TTS_SYNTH_SECONDS.labels(name).observe(time.perf_counter() - start)
+            return path
+        except Exception as e:
+            last_error = e # 例如離線時 gTTS 失敗，改用下一個後端
+    raise RuntimeError(f"沒有可用的語音合成後端: {last_error}")
+
+
+def prerender_phrases(phrases=PRERENDER_PHRASES, lang=DEFAULT_LANG):
+    """預先產生固定語句 (背景執行)，之後播放不需等待合成"""
+    def render():
+        for phrase in phrases:
+            try:
+                get_audio(phrase, lang)
+            except Exception as e:
+                print(f"[TTS ERROR] 預先產生語音失敗：{phrase} ({e})")
+    thread = threading.Thread(target=render, daemon=True)
+    thread.start()
+    return thread
+
+
+def split_prerendered(segment, phrases=PRERENDER_PHRASES):
+    """以預先產生語句開頭的片段拆成 [固定語句, 其餘內容]，固定語句直接命中快取，只需合成其餘內容"""
+    for phrase in phrases:
+        if segment.startswith(phrase) and segment != phrase:
+            return [phrase, segment[len(phrase):]]
+    return [segment]
+
+
+# --- 3. 播放 ---
+
+def speak_text(text, lang=DEFAULT_LANG):
+    # 將文本轉換為語音並透過 RPi 的音頻輸出播放 (背景執行，不阻塞呼叫端)。
+    # text 可為字串或多個片段 (例如 ["預測提醒。", 提醒內容])，片段各自快取後依序播放；
+    # 以 PRERENDER_PHRASES 開頭的片段 (例如「警告，根據歷史紀錄…」) 會拆出固定語句，直接使用預先產生的語音
+    if not tts_lock.acquire(blocking=False):
+        # 正在播放中，跳過此次提醒
+        TTS_SKIPPED.inc()
+        return False
+
+    segments = [part for segment in ([text] if isinstance(text, str) else text) if segment
+                for part in split_prerendered(segment)]
+    requested = time.perf_counter()
+
+    def play():
         try:
-            # 1. gTTS: 生成 MP3 檔案
-            tts = gTTS(text=text, lang='zh-tw')
-            tts.save(mp3_filename)
-            
-            print(f"\n[TTS] 正在播放語音提醒: {text}")
-            
-            # 2. mpg321: 播放 MP3
-            # -q: 安靜模式
-            subprocess.Popen(["mpg321", "-q", mp3_filename])
-            
+            paths = [get_audio(segment, lang) for segment in segments]
+            TTS_PLAY_DELAY_SECONDS.observe(time.perf_counter() - requested)
+            print(f"\n[TTS] 正在播放語音提醒: {''.join(segments)}")
+            for path in paths:
+                player = PLAYERS[os.path.splitext(path)[1]]
+                # 等到播放程式結束才釋放鎖
+                subprocess.run(player + [path], check=True)
         except subprocess.CalledProcessError:
-            print(f"[TTS ERROR] 語音播放失敗：mpg321 指令執行錯誤。")
+            print(f"[TTS ERROR] 語音播放失敗：播放指令執行錯誤。")
         except Exception as e:
             print(f"[TTS ERROR] 語音播放失敗：{e}")
         finally:
-            threading.Thread(target=lambda: (time.sleep(5), os.remove(mp3_filename), tts_lock.release()), daemon=True).start()
-    else:
-        # 正在播放中，跳過此次提醒
-        pass
+            tts_lock.release()
+
+    threading.Thread(target=play, daemon=True).start()
+    return True
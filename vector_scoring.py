@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+"""
+vector_scoring.py
+以 NumPy 陣列一次計算多位騎士整段 EAR/MAR 串流的 Safety Score，規則與 FatigueState.update_score_and_alert 相同：
+微睡眠 (連續閉眼長度與 15 秒後加回)、哈欠 (連續張嘴長度、60 秒滾動窗口)、PERCLOS (遲滯) 與眨眼變慢。
+
+  - 逐幀的判斷 (連續區段、間隔重設、眨眼、時間桶累計) 對所有騎士一次向量化計算
+  - 只有稀疏的事件 (微睡眠扣分 / 加回、哈欠窗口) 依騎士逐一處理，成本與事件數成正比
+  - 分數為 100 - 生效中懲罰的總和 (下限 0)，與逐幀版本一致
+
+未包含點頭 (pitch 基準為非線性遞迴) 與閾值自動校準；時間戳必須依騎士分組且遞增。
+
+  python vector_scoring.py check [--riders 20] [--minutes 10] [--seed 0]   # 與 FatigueState 逐幀比對並比較速度
+  python vector_scoring.py score sessions/ [--set CLOSED_EAR_THRESHOLD=0.2]   # 對騎乘紀錄檔計分
+"""
+import argparse
+import contextlib
+import io
+import sys
+import time
+
+import numpy as np
+
+from fatigue_utils import FatigueState, MAX_SAMPLE_GAP_SEC, scoring_params
+
+PARAM_NAMES = (
+    'CLOSED_EAR_THRESHOLD', 'YAWN_MAR_THRESHOLD', 'MICRO_SLEEP_SEC', 'PENALTY_RESET_SEC',
+    'YAWN_CONSEC_SEC', 'YAWN_WINDOW_SEC', 'YAWN_CRITICAL_COUNT',
+    'PERCLOS_WINDOW_SEC', 'PERCLOS_MIN_COVERAGE_SEC', 'PERCLOS_WARN', 'PERCLOS_RECOVER',
+    'BLINK_MAX_SEC', 'SLOW_BLINK_SEC', 'SLOW_BLINK_MIN_COUNT',
+)
+PERCLOS_BUCKET_SEC = 1.0 # 與 EyeClosureStats 的預設時間桶相同
+
+# 同一幀內的警報順序與 update_score_and_alert 相同
+ALERT_TYPES = ('CRITICAL_SLEEP', 'WARNING_PERCLOS', 'WARNING_SLOW_BLINK', 'WARNING_YAWN_FREQUENCY')
+PENALTIES = {'CRITICAL_SLEEP': 50, 'WARNING_PERCLOS': 20, 'WARNING_SLOW_BLINK': 10, 'WARNING_YAWN_FREQUENCY': 15}
+
+
+def default_params(**overrides):
+    """FatigueState 目前生效的閾值 (可覆寫)"""
+    current = scoring_params()
+    params = {name: current[name] for name in PARAM_NAMES}
+    for name, value in overrides.items():
+        if name not in params:
+            raise ValueError(f"未知的計分參數: {name}")
+        params[name] = value
+    return params
+
+
+def _run_since(cond, t, reset):
+    """cond 為 True 的連續區段 (遇到 reset 重新開始) 的起始時間；cond 為 False 的幀無意義"""
+    n = len(cond)
+    prev = np.concatenate(([False], cond[:-1]))
+    begin = cond & (~prev | reset)
+    index = np.where(begin, np.arange(n), 0)
+    np.maximum.accumulate(index, out=index)
+    return t[index], np.cumsum(begin)
+
+
+def _segment_bounds(rider):
+    starts = np.flatnonzero(np.concatenate(([True], rider[1:] != rider[:-1])))
+    return starts, np.append(starts[1:], len(rider))
+
+
+def _window_sum(values, key, size):
+    """每幀加總同一騎士、時間桶編號在 (key - size, key] 內且不晚於本幀的 values"""
+    cumulative = np.concatenate(([0.0], np.cumsum(values)))
+    lo = np.searchsorted(key, key - size + 1, side='left')
+    return cumulative[1:] - cumulative[lo]
+
+
+def _expired_count(y, t, window):
+    """每個 t 之前已滿 window 秒 (t - y >= window) 的事件數；y 遞增"""
+    index = np.searchsorted(y, t - window, side='right')
+    # searchsorted 以 t - window 比較，這裡修正浮點誤差，使結果與逐幀版本的 t - y >= window 一致
+    over = (index < len(y)) & (t - y[np.minimum(index, len(y) - 1)] >= window)
+    index = index + over
+    under = (index > 0) & (t - y[np.maximum(index - 1, 0)] < window)
+    return index - under
+
+
+def score_streams(t, ear, mar, rider=None, **overrides):
+    """
+    t / ear / mar: 1-D 陣列 (有人臉的幀)；rider: 每幀的騎士編號 (相同騎士須相鄰，None 表示單一騎士)
+    回傳 dict：score (每幀分數)、sleep / perclos / slow_blink / yawn (各懲罰是否生效)、
+    perclos_ratio、yawn_count、alerts [(幀索引, 警報類型, 扣分後分數)]
+    """
+    p = default_params(**overrides)
+    t = np.asarray(t, dtype=np.float64)
+    ear = np.asarray(ear, dtype=np.float64)
+    mar = np.asarray(mar, dtype=np.float64)
+    n = len(t)
+    rider = np.zeros(n, dtype=np.int64) if rider is None else np.asarray(rider)
+    starts, ends = _segment_bounds(rider) if n else (np.zeros(0, int), np.zeros(0, int))
+    first = np.zeros(n, dtype=bool)
+    first[starts] = True
+
+    dt = np.diff(t, prepend=t[:1])
+    dt[first] = 0.0
+    if np.any(dt < 0):
+        raise ValueError("同一騎士的時間戳必須遞增")
+    gap = (dt > MAX_SAMPLE_GAP_SEC) | first
+
+    # --- 微睡眠：連續閉眼長度 ---
+    closed = ear < p['CLOSED_EAR_THRESHOLD']
+    closed_since, _ = _run_since(closed, t, gap)
+    sleeping = closed & (t - closed_since >= p['MICRO_SLEEP_SEC'])
+
+    # --- 哈欠：連續張嘴達 YAWN_CONSEC_SEC 的第一幀計為一次 ---
+    mouth_open = mar > p['YAWN_MAR_THRESHOLD']
+    open_since, run_id = _run_since(mouth_open, t, gap)
+    candidate = np.flatnonzero(mouth_open & (t - open_since >= p['YAWN_CONSEC_SEC']))
+    yawn_index = candidate[np.concatenate(([True], run_id[candidate][1:] != run_id[candidate][:-1]))] if len(candidate) else candidate
+
+    # --- PERCLOS / 眨眼：與 EyeClosureStats 相同的時間桶累計 ---
+    valid = (dt > 0) & (dt <= MAX_SAMPLE_GAP_SEC)
+    prev_closed = np.concatenate(([False], closed[:-1])) & ~first
+    observed = np.where(valid, dt, 0.0)
+    closed_time = np.where(prev_closed, observed, 0.0)
+    blink_duration = t - np.concatenate((t[:1], closed_since[:-1]))
+    blink = ~closed & prev_closed & ~(dt > MAX_SAMPLE_GAP_SEC) & (blink_duration <= p['BLINK_MAX_SEC'])
+
+    size = max(1, int(round(p['PERCLOS_WINDOW_SEC'] / PERCLOS_BUCKET_SEC)))
+    bucket = (t // PERCLOS_BUCKET_SEC).astype(np.int64)
+    key = np.zeros(n, dtype=np.int64)
+    offset = 0
+    for start, end in zip(starts, ends):
+        key[start:end] = bucket[start:end] - bucket[start] + offset
+        offset = key[end - 1] + size + 1
+    total = _window_sum(observed, key, size)
+    closed_sum = _window_sum(closed_time, key, size)
+    blinks = np.rint(_window_sum(blink.astype(np.float64), key, size)).astype(np.int64)
+    blink_time = _window_sum(np.where(blink, blink_duration, 0.0), key, size)
+
+    ratio = np.where(total > 0, closed_sum / np.where(total > 0, total, 1.0), 0.0)
+    perclos = np.where(total >= p['PERCLOS_MIN_COVERAGE_SEC'], ratio, 0.0)
+    # 遲滯：>= WARN 啟動、< RECOVER 解除，其餘沿用上一幀 (每位騎士從未啟動開始)
+    event = np.where(perclos >= p['PERCLOS_WARN'], 1, np.where(perclos < p['PERCLOS_RECOVER'], -1, 0))
+    event[first & (event == 0)] = -1
+    last = np.where(event != 0, np.arange(n), 0)
+    np.maximum.accumulate(last, out=last)
+    perclos_flag = event[last] == 1
+
+    mean_blink = np.where(blinks > 0, blink_time / np.maximum(blinks, 1), 0.0)
+    slow_flag = (blinks >= p['SLOW_BLINK_MIN_COUNT']) & (mean_blink >= p['SLOW_BLINK_SEC'])
+
+    # --- 稀疏事件：依騎士處理 ---
+    sleep_flag = np.zeros(n, dtype=bool)
+    yawn_count = np.zeros(n, dtype=np.int64)
+    is_yawn = np.zeros(n, dtype=np.int64)
+    is_yawn[yawn_index] = 1
+    sleep_alerts = []
+    sleeping_index = np.flatnonzero(sleeping)
+    for start, end in zip(starts, ends):
+        # 微睡眠：扣分後滿 PENALTY_RESET_SEC 的第一幀加回；若當時仍在微睡眠則同一幀再次扣分
+        k = np.searchsorted(sleeping_index, start)
+        while k < len(sleeping_index) and sleeping_index[k] < end:
+            i = sleeping_index[k]
+            sleep_alerts.append(i)
+            r = i + int(np.searchsorted(t[i:end], t[i] + p['PENALTY_RESET_SEC'], side='left'))
+            while r > i + 1 and t[r - 1] - t[i] >= p['PENALTY_RESET_SEC']:
+                r -= 1
+            while r < end and t[r] - t[i] < p['PENALTY_RESET_SEC']:
+                r += 1
+            sleep_flag[i:r] = True
+            if r >= end:
+                break
+            k = np.searchsorted(sleeping_index, r)
+
+        # 哈欠滾動窗口
+        counted = np.cumsum(is_yawn[start:end])
+        y = t[start:end][is_yawn[start:end] == 1]
+        yawn_count[start:end] = counted - _expired_count(y, t[start:end], p['YAWN_WINDOW_SEC']) if len(y) else 0
+    yawn_flag = yawn_count > p['YAWN_CRITICAL_COUNT']
+
+    # --- 分數：100 - 生效中懲罰的總和 (下限 0，與 FatigueState._update_score 相同) ---
+    penalty = (PENALTIES['CRITICAL_SLEEP'] * sleep_flag + PENALTIES['WARNING_PERCLOS'] * perclos_flag
+               + PENALTIES['WARNING_SLOW_BLINK'] * slow_flag + PENALTIES['WARNING_YAWN_FREQUENCY'] * yawn_flag)
+    score = np.maximum(0, 100 - penalty).astype(np.int64)
+
+    # 微睡眠加回後同一幀再次扣分時 penalty 沒有變化，但仍是一次新的警報，因此直接使用事件列表
+    alerts = [(int(i), 'CRITICAL_SLEEP') for i in sleep_alerts]
+    for name, flag in (('WARNING_PERCLOS', perclos_flag), ('WARNING_SLOW_BLINK', slow_flag), ('WARNING_YAWN_FREQUENCY', yawn_flag)):
+        rising = flag & ~(np.concatenate(([False], flag[:-1])) & ~first)
+        alerts.extend((i, name) for i in np.flatnonzero(rising).tolist())
+    alerts.sort(key=lambda a: (a[0], ALERT_TYPES.index(a[1])))
+
+    return {
+        'score': score, 'sleep': sleep_flag, 'perclos': perclos_flag, 'slow_blink': slow_flag, 'yawn': yawn_flag,
+        'perclos_ratio': perclos, 'yawn_count': yawn_count,
+        'alerts': [(i, name, int(score[i])) for i, name in alerts],
+    }
+
+
+# --- 與逐幀版本比對 ---
+
+def stream_scores(t, ear, mar, **overrides):
+    """以 FatigueState 逐幀計分 (不輸出狀態列)，回傳 (分數陣列, [(幀索引, 警報類型)])"""
+    from benchmark import NullBuzzer
+    state = FatigueState(overrides=overrides) # 建立時套用，PERCLOS_WINDOW_SEC 等才會影響 eye_stats
+    alerts = []
+    frame = [0]
+    state.alert_logger = lambda alert_type, score, details="", rider_id=None: alerts.append((frame[0], alert_type))
+    buzzer = NullBuzzer()
+    scores = np.empty(len(t), dtype=np.int64)
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i, (ti, e, m) in enumerate(zip(t.tolist(), ear.tolist(), mar.tolist())):
+            frame[0] = i
+            scores[i] = state.update_score_and_alert(e, m, ti, 30.0, buzzer)
+    return scores, alerts
+
+
+def synthetic_fleet(riders=20, minutes=10, fps=15.0, seed=0):
+    """產生含眨眼、慢眨眼、微睡眠、哈欠與人臉遺失空白的多騎士 EAR/MAR 串流"""
+    rng = np.random.default_rng(seed)
+    ts, ears, mars, ids = [], [], [], []
+    for r in range(riders):
+        n = int(minutes * 60 * fps)
+        t = 1.7e9 + r * 3600.0 + np.cumsum(rng.uniform(0.5, 1.5, n) / fps)
+        drowsy = rng.uniform(0, 1)
+        ear = rng.normal(0.30, 0.02, n)
+        for _ in range(int(n / fps / 4 * (0.5 + drowsy))): # 眨眼 (越疲勞越長)
+            i = rng.integers(0, n)
+            ear[i:i + int(rng.uniform(1, 4 + 6 * drowsy))] = rng.normal(0.12, 0.02)
+        for _ in range(rng.poisson(1 + 6 * drowsy)): # 微睡眠
+            i = rng.integers(0, n)
+            ear[i:i + int(fps * rng.uniform(1.0, 3.0))] = rng.normal(0.10, 0.02)
+        mar = rng.normal(0.08, 0.02, n)
+        for _ in range(rng.poisson(2 + 12 * drowsy)): # 哈欠
+            i = rng.integers(0, n)
+            mar[i:i + int(fps * rng.uniform(0.5, 4.0))] = rng.normal(0.4, 0.05)
+        keep = rng.uniform(0, 1, n) > 0.02 # 偶爾遺失人臉
+        for _ in range(rng.poisson(3)): # 較長的空白
+            i = rng.integers(0, n)
+            keep[i:i + int(fps * rng.uniform(1.5, 5))] = False
+        ts.append(t[keep]); ears.append(ear[keep]); mars.append(mar[keep]); ids.append(np.full(keep.sum(), r))
+    return np.concatenate(ts), np.concatenate(ears), np.concatenate(mars), np.concatenate(ids)
+
+
+def check_consistency(t, ear, mar, rider, **overrides):
+    """逐位騎士比較向量化與逐幀版本的分數與警報，回傳比對結果與耗時"""
+    t0 = time.perf_counter()
+    result = score_streams(t, ear, mar, rider, **overrides)
+    vector_sec = time.perf_counter() - t0
+
+    starts, ends = _segment_bounds(rider)
+    mismatched_frames = 0
+    mismatched_riders = []
+    stream_sec = 0.0
+    vector_alerts = {}
+    for i, name, _ in result['alerts']:
+        vector_alerts.setdefault(int(rider[i]), []).append((i, name))
+    for start, end in zip(starts, ends):
+        t1 = time.perf_counter()
+        scores, alerts = stream_scores(t[start:end], ear[start:end], mar[start:end], **overrides)
+        stream_sec += time.perf_counter() - t1
+        diff = int(np.count_nonzero(scores != result['score'][start:end]))
+        alerts = [(start + i, name) for i, name in alerts]
+        if diff or alerts != vector_alerts.get(int(rider[start]), []):
+            mismatched_frames += diff
+            mismatched_riders.append(int(rider[start]))
+    return {
+        'frames': len(t),
+        'riders': len(starts),
+        'alerts': len(result['alerts']),
+        'mismatched_frames': mismatched_frames,
+        'mismatched_riders': mismatched_riders,
+        'vector_sec': vector_sec,
+        'stream_sec': stream_sec,
+        'speedup': stream_sec / vector_sec if vector_sec else 0.0,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="向量化多騎士計分")
+    sub = parser.add_subparsers(dest='command')
+    check_parser = sub.add_parser('check', help="以合成資料與 FatigueState 逐幀比對")
+    check_parser.add_argument('--riders', type=int, default=20)
+    check_parser.add_argument('--minutes', type=float, default=10)
+    check_parser.add_argument('--seed', type=int, default=0)
+    check_parser.add_argument('--set', action='append', dest='settings', metavar='NAME=VALUE')
+    score_parser = sub.add_parser('score', help="對騎乘紀錄檔 (.fsl) 計分")
+    score_parser.add_argument('paths', nargs='+')
+    score_parser.add_argument('--set', action='append', dest='settings', metavar='NAME=VALUE')
+    args = parser.parse_args()
+    overrides = {name: float(value) for name, _, value in (s.partition('=') for s in (getattr(args, 'settings', None) or []))}
+
+    if args.command == 'check':
+        report = check_consistency(*synthetic_fleet(args.riders, args.minutes, seed=args.seed), **overrides)
+        print(f"[VECTOR] {report['riders']} 位騎士、{report['frames']} 幀、{report['alerts']} 次警報 | "
+              f"向量化 {report['vector_sec'] * 1000:.0f}ms，逐幀 {report['stream_sec'] * 1000:.0f}ms ({report['speedup']:.0f}x)")
+        if report['mismatched_riders']:
+            print(f"[VECTOR] 不一致：騎士 {report['mismatched_riders']}，{report['mismatched_frames']} 幀分數不同")
+            sys.exit(1)
+        print("[VECTOR] 分數與警報與 FatigueState 完全一致")
+    elif args.command == 'score':
+        from session_analysis import find_sessions
+        from session_log import FLAG_FACE, open_session
+        paths = find_sessions(args.paths)
+        ts, ears, mars, ids = [], [], [], []
+        for index, path in enumerate(paths):
+            _, records = open_session(path)
+            face = (records['flags'] & FLAG_FACE) != 0
+            ts.append(records['t'][face]); ears.append(records['ear'][face]); mars.append(records['mar'][face])
+            ids.append(np.full(int(face.sum()), index))
+        rider = np.concatenate(ids) if ids else np.zeros(0, dtype=np.int64)
+        t0 = time.perf_counter()
+        result = score_streams(np.concatenate(ts), np.concatenate(ears), np.concatenate(mars), rider, **overrides)
+        elapsed = time.perf_counter() - t0
+        starts, ends = _segment_bounds(rider)
+        for start, end in zip(starts, ends):
+            counts = {}
+            for i, name, _ in result['alerts']:
+                if start <= i < end:
+                    counts[name] = counts.get(name, 0) + 1
+            print(f"[VECTOR] {paths[rider[start]]}: {end - start} 幀, 最低分 {result['score'][start:end].min()}, 警報 {counts}")
+        print(f"[VECTOR] 共 {len(rider)} 幀，計分耗時 {elapsed * 1000:.0f}ms")
+    else:
+        parser.print_help()
@@ -3,7 +3,7 @@
 web_server.py
 運行 Flask 網站，從 Google Sheets CSV 鏈接讀取疲勞數據並計算。
 """
-from flask import Flask, render_template, jsonify
+from flask import Flask, render_template, jsonify, request, Response
 import requests
 import threading
 import time
@@ -12,9 +12,15 @@ import csv
 from io import StringIO
 import re 
 import locale 
-from collections import defaultdict 
+from collections import defaultdict, deque, OrderedDict
 import json
 import os
+import gzip
+import hashlib
+from event_store import EventStore, EVENT_DB_PATH
+from risk_channel import RiskPublisher
+from metrics import REGISTRY, CONTENT_TYPE, Counter, Gauge, Histogram, register_system_metrics
+from config import register_config, start_config_watcher
 
 # 設置中文環境
 try:
@@ -33,165 +39,448 @@ app.config['SECRET_KEY'] = 'your_super_secret_key'
 # --- Google Sheets CSV 連結 ---
 SHEETS_CSV_URL = 'https://docs.google.com/spreadsheets/d/e/2PACX-1vQyh4KJgf5pxwQ2yTO_AujdmnZVARozHXUjYZ5xVXtWn4xmhh9DyK4VNUmOz0JiEQNlPnOliaMYTzwu/pub?gid=2066603959&single=true&output=csv' # <<<<< 必須替換！
 DATA_CACHE_FILENAME = 'risk_analysis.json' # 本地 JSON 檔案名
+REFRESH_INTERVAL_SEC = 10 # 試算表刷新間隔
+DEFAULT_RIDER_ID = 'Rider_A380'
+RISK_HISTORY_DAYS = 7 # 分析過去 7 天同一小時的紀錄
+RISK_PATTERN_MIN_DAYS = 2 # 過去 7 天中至少 2 天同時段有警報即視為慣性高風險
+RISK_WEEKDAY_WEEKS = 4 # 分析過去 4 週同一星期幾、同一小時的紀錄
+
+# 以設定檔 / 環境變數的 web 段落覆寫上方常數 (見 config.py)；端點、間隔與風險判斷參數可熱更新
+register_config('web', globals(), hot=('SHEETS_CSV_URL', 'REFRESH_INTERVAL_SEC', 'RISK_HISTORY_DAYS',
+                                       'RISK_PATTERN_MIN_DAYS', 'RISK_WEEKDAY_WEEKS'))
+
+risk_publisher = RiskPublisher(DATA_CACHE_FILENAME) # 提醒內容改變時原子寫檔並通知偵測端
 
 # 數據快取與鎖定 (用於多線程安全)
 data_cache = {}
 data_lock = threading.Lock()
 
+# 本地事件庫 (原始事件 + 每小時 / 每日彙總)；第一次使用時才開啟，匯入本模組不會建立資料庫檔案
+_event_store = None
+_event_store_lock = threading.Lock()
+WEEKDAY_NAMES = ['星期一', '星期二', '星期三', '星期四', '星期五', '星期六', '星期日']
+
 # --- 數據分析函式 ---
-def analyze_fatigue_risk(records):
+def analyze_fatigue_risk(store, rider_id=DEFAULT_RIDER_ID, now=None):
     """
-    分析前一天的數據，判斷當前小時是否有疲勞慣性。
+    以每小時彙總判斷當前小時是否有疲勞慣性：
+    前一天同一小時、過去 7 天同一小時、過去數週同一星期幾的同一小時。
     返回: 語音提醒文本 (str)
     """
     
-    now = datetime.now()
+    now = now or datetime.now()
     yesterday = now - timedelta(days=1)
     
-    # 專注於前一天同一小時的紀錄
+    # 專注於前一天同一小時的紀錄 (O(1) 讀取彙總桶)
     target_hour = now.hour
-    
-    alert_count_yesterday = 0
-    total_yawn_count = 0
-    total_sleep_count = 0
-    
-    for rec in records:
-        if rec['Alert Type'] != 'SAFE':
-            timestamp_str = rec['Timestamp']
-            
-            try:
-                # 必須解析為 datetime 物件
-                dt_object = datetime.strptime(timestamp_str, '%Y-%m-%d %H:%M:%S')
-                
-                # 檢查是否是昨天的數據 且 小時數匹配
-                if dt_object.date() == yesterday.date() and dt_object.hour == target_hour:
-                    alert_count_yesterday += 1
-                    
-                    if 'YAWN' in rec['Alert Type']:
-                         total_yawn_count += 1
-                    if 'SLEEP' in rec['Alert Type']:
-                         total_sleep_count += 1
-            except ValueError:
-                continue
-
-    if alert_count_yesterday > 0:
-        details = f"在昨天的 {target_hour}:00 時段，偵測到 {total_sleep_count} 次閉眼和 {total_yawn_count} 次哈欠。"
+    bucket = store.hour_bucket(rider_id, yesterday.strftime('%Y-%m-%d'), target_hour)
+
+    if bucket['alerts'] > 0:
+        details = f"在昨天的 {target_hour}:00 時段，偵測到 {bucket['sleep']} 次閉眼和 {bucket['yawn']} 次哈欠。"
         return f"警告，根據歷史紀錄，你當前時段為高風險時段。{details}"
+
+    # 過去 7 天同一小時
+    week_start = (now - timedelta(days=RISK_HISTORY_DAYS)).strftime('%Y-%m-%d')
+    history = store.same_hour_history(rider_id, target_hour, week_start, yesterday.strftime('%Y-%m-%d'))
+    days_with_alerts = sum(1 for row in history if row['alerts'] > 0)
+    if days_with_alerts >= RISK_PATTERN_MIN_DAYS:
+        return f"警告，過去 {RISK_HISTORY_DAYS} 天中有 {days_with_alerts} 天在 {target_hour}:00 時段出現疲勞警報，請留意休息。"
+
+    # 過去數週同一星期幾的同一小時
+    weeks_start = (now - timedelta(weeks=RISK_WEEKDAY_WEEKS)).strftime('%Y-%m-%d')
+    same_weekday = store.same_hour_history(rider_id, target_hour, weeks_start, yesterday.strftime('%Y-%m-%d'),
+                                           weekday=now.weekday())
+    weeks_with_alerts = sum(1 for row in same_weekday if row['alerts'] > 0)
+    if weeks_with_alerts >= RISK_PATTERN_MIN_DAYS:
+        return f"警告，過去幾週的{WEEKDAY_NAMES[now.weekday()]} {target_hour}:00 時段經常出現疲勞警報，請留意休息。"
+
+    return "狀態良好，繼續保持。"
+
+
+# --- 增量讀取 Google Sheets ---
+# 已發佈的 CSV 每次都會回傳完整內容，但表單回應只會往後新增：
+# 記住已處理到的文字位置，只解析之後新增的列，並以 ETag / Last-Modified 條件式請求略過未變動的內容；
+# 讀取位置與事件存放在同一個事件庫，重新啟動後可從上次位置接續
+RECENT_LOG_HOURS = 48 # 儀表板顯示最近 48 小時的紀錄
+http_session = requests.Session()
+ingest_state = { # 開啟事件庫時以保存的讀取位置取代
+    'etag': None,
+    'last_modified': None,
+    'offset': 0, # 已處理的文字長度 (位於換行之後)
+    'anchor': '', # offset 前最後一行的原始內容，用來確認試算表沒有被改寫
+    'carry': 0, # offset 之後已處理過、但尚未以換行結尾的列數
+    'rider_col': None, # 騎士 ID 所在欄位
+}
+
+
+def get_event_store():
+    """取得 (必要時開啟) 本地事件庫，並載入上次保存的讀取位置"""
+    global _event_store
+    with _event_store_lock:
+        if _event_store is None:
+            _event_store = EventStore(EVENT_DB_PATH)
+            ingest_state.update(_event_store.get_meta('ingest_state') or {})
+        return _event_store
+
+# 執行期指標 (/metrics)
+REFRESH_STAGE_SECONDS = Histogram('web_refresh_stage_seconds', "每次刷新各階段耗時 (fetch/parse/store/total)", ['stage'])
+SHEET_FETCHES = Counter('web_sheet_fetches_total', "讀取試算表的結果次數 (modified/not_modified/rebuild/error)", ['result'])
+ROWS_INGESTED = Counter('web_rows_ingested_total', "寫入事件庫的紀錄數")
+LAST_REFRESH = Gauge('web_last_refresh_timestamp_seconds', "最近一次成功刷新的時間 (Unix 秒)")
+STREAM_CLIENTS = Gauge('web_stream_clients', "目前連線中的 SSE 儀表板數")
+register_system_metrics()
+
+reminder_cache = {} # rider_id → (小時桶, 提醒文本)；只有新事件或跨小時才重新分析
+RECENT_LOG_LIMIT = 500 # 儀表板最多顯示的近期紀錄筆數 (全車隊)
+
+
+# --- 即時推播 (Server-Sent Events) ---
+STREAM_HISTORY = 200 # 保留最近的推播訊息，讓短暫斷線的瀏覽器重新連線後補齊
+STREAM_KEEPALIVE_SEC = 15 # 沒有新資料時送出註解行，避免連線被代理伺服器關閉
+
+class LiveBroadcaster:
+    """SSE 廣播：每則訊息只序列化一次，所有連線的瀏覽器共用同一份文字"""
+    def __init__(self, history=STREAM_HISTORY):
+        self._cond = threading.Condition()
+        self._messages = deque(maxlen=history) # (序號, SSE 文字)
+        self.seq = 0
+
+    def publish(self, event, data):
+        payload = json.dumps(data, ensure_ascii=False)
+        with self._cond:
+            self.seq += 1
+            self._messages.append((self.seq, f"id: {self.seq}\nevent: {event}\ndata: {payload}\n\n"))
+            self._cond.notify_all()
+
+    def stream(self, since):
+        """依序產生序號 since 之後的訊息；訊息已被覆蓋 (或伺服器重啟) 時送出 reset，讓瀏覽器重新載入"""
+        last = since
+        while True:
+            with self._cond:
+                if self.seq == last:
+                    self._cond.wait(STREAM_KEEPALIVE_SEC)
+                oldest = self._messages[0][0] if self._messages else self.seq + 1
+                if last > self.seq or last < oldest - 1:
+                    chunks = [f"id: {self.seq}\nevent: reset\ndata: {{}}\n\n"]
+                else:
+                    chunks = [text for seq, text in self._messages if seq > last]
+                last = self.seq
+            yield ''.join(chunks) if chunks else ": keepalive\n\n"
+
+
+broadcaster = LiveBroadcaster()
+last_pushed_riders = {} # Rider_ID → 上次推播的騎士狀態，只推播有變化的騎士
+
+
+# --- API 回應快取 ---
+# 每次刷新時預先序列化 (並壓縮) 回應內容，整份快照以一次指派替換；
+# 請求端只讀取快照，不需加鎖，也不會阻塞刷新線程
+API_GZIP = True # 用戶端支援時回傳 gzip 壓縮內容
+API_GZIP_MIN_BYTES = 1024 # 小於此大小不壓縮
+LOG_PAGE_SIZE = 50 # /api/logs 預設每頁筆數
+LOG_PAGE_MAX = 500 # 每頁最多筆數
+LOG_PAGE_CACHE = 64 # 每份快照最多快取的查詢結果數
+
+class CachedJSON:
+    """預先序列化的 JSON 回應 (原始 + gzip) 與其 ETag"""
+    def __init__(self, data):
+        self.body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.etag = hashlib.sha1(self.body).hexdigest()[:20]
+        self.gzipped = None
+        if API_GZIP and len(self.body) >= API_GZIP_MIN_BYTES:
+            self.gzipped = gzip.compress(self.body, 6)
+
+    def response(self):
+        """依 If-None-Match / Accept-Encoding 回傳 304、gzip 或原始內容"""
+        if request.if_none_match.contains_weak(self.etag):
+            resp = Response(status=304)
+        elif self.gzipped is not None and 'gzip' in request.accept_encodings:
+            resp = Response(self.gzipped, mimetype='application/json')
+            resp.headers['Content-Encoding'] = 'gzip'
+        else:
+            resp = Response(self.body, mimetype='application/json')
+        # 同一內容的原始 / 壓縮版本共用弱 ETag
+        resp.set_etag(self.etag, weak=True)
+        resp.headers['Vary'] = 'Accept-Encoding'
+        resp.headers['Cache-Control'] = 'no-cache'
+        return resp
+
+
+class ApiSnapshot:
+    """
+    某次刷新的 API 內容：摘要 + 近期紀錄 (由新到舊) + 事件庫中的紀錄總數。
+    未篩選的第一頁直接取自近期紀錄，其餘篩選 / 分頁查詢事件庫 (保留期限內的所有紀錄)；
+    查詢結果在快照內快取，下一次刷新產生新快照時失效
+    """
+    def __init__(self, summary, logs, total=None):
+        self.summary = CachedJSON(summary)
+        self.logs = logs
+        self.total = len(logs) if total is None else total
+        self._pages = OrderedDict()
+        self._pages_lock = threading.Lock()
+
+    def log_page(self, rider=None, since=None, until=None, page=1, per_page=LOG_PAGE_SIZE):
+        key = (rider, since, until, page, per_page)
+        with self._pages_lock:
+            cached = self._pages.get(key)
+            if cached is not None:
+                self._pages.move_to_end(key)
+                return cached
+
+        start = (page - 1) * per_page
+        if not (rider or since or until) and page == 1 and (per_page <= len(self.logs) or self.total == len(self.logs)):
+            total, logs = self.total, self.logs[:per_page]
+        else:
+            store = get_event_store()
+            total = store.count_events(since, rider, until)
+            logs = store.recent_events(since, rider, limit=per_page, until=until, offset=start)[::-1] if start < total else []
+        cached = CachedJSON({
+            'total': total,
+            'page': page,
+            'per_page': per_page,
+            'pages': (total + per_page - 1) // per_page,
+            'logs': logs,
+        })
+
+        with self._pages_lock:
+            self._pages[key] = cached
+            while len(self._pages) > LOG_PAGE_CACHE:
+                self._pages.popitem(last=False)
+        return cached
+
+
+api_snapshot = ApiSnapshot({'rider_stats': [], 'leaderboard': [], 'last_update': None, 'reminder': None, 'log_count': 0}, [])
+
+
+def find_rider_column(header_line):
+    """從標題列找出騎士 ID 欄位 (標題含 'rider')；沒有此欄位時回傳 None"""
+    header = next(csv.reader(StringIO(header_line)), [])
+    for index, name in enumerate(header):
+        if 'rider' in name.lower():
+            return index
+    return None
+
+
+def parse_sheet_row(row, rider_col=None):
+    """將 CSV 的一列轉為紀錄；無效列回傳 None。返回: (datetime, record)"""
+    if len(row) < 4 or not row[3].strip():
+        return None
+
+    timestamp_str = row[3].strip()
+    alert_full = row[1].strip()
+    score_raw = row[2].strip()
+
+    try:
+        record_time = datetime.strptime(timestamp_str, '%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        return None # 無法判斷時間的紀錄無法放入時間窗口
+
+    alert_type_main = alert_full.split('(')[0].strip()
+
+    try:
+        score = int(score_raw)
+    except ValueError:
+        score = 100
+
+    rider_id = ''
+    if rider_col is not None and rider_col < len(row):
+        rider_id = row[rider_col].strip()
+
+    return record_time, {
+        'Timestamp': record_time.strftime('%Y-%m-%d %H:%M:%S'),
+        'Alert Type': str(alert_type_main or 'SAFE'),
+        'Safety Score': score,
+        'Rider_ID': rider_id or DEFAULT_RIDER_ID
+    }
+
+
+def fetch_new_rows():
+    """
+    以條件式請求下載 CSV，只解析上次讀取後新增的列。
+    返回: (新增的 CSV 列, 是否需要整份重建, 新的讀取位置)；內容未變動時為 ([], False, None)
+    新的讀取位置不直接寫回 ingest_state，由呼叫端在事件寫入成功後再合併 (寫入失敗時下次從原位置重讀)
+    """
+    headers = {}
+    if ingest_state['etag']:
+        headers['If-None-Match'] = ingest_state['etag']
+    if ingest_state['last_modified']:
+        headers['If-Modified-Since'] = ingest_state['last_modified']
+
+    start = time.perf_counter()
+    response = http_session.get(SHEETS_CSV_URL, headers=headers, timeout=15)
+    REFRESH_STAGE_SECONDS.labels('fetch').observe(time.perf_counter() - start)
+    if response.status_code == 304:
+        SHEET_FETCHES.labels('not_modified').inc()
+        return [], False, None
+    response.raise_for_status()
+    start = time.perf_counter()
+    state = {
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'rider_col': ingest_state['rider_col'],
+    }
+
+    text = response.text
+    offset = ingest_state['offset']
+    anchor = ingest_state['anchor']
+    if offset and offset <= len(text) and text[offset - len(anchor):offset] == anchor:
+        tail = text[offset:]
+        skip = ingest_state['carry']
+        rebuild = False
     else:
-        return "狀態良好，繼續保持。"
+        # 第一次讀取，或試算表內容被修改 / 刪減：整份重建
+        rebuild = True
+        offset = text.find('\n') + 1 # 跳過標題列
+        anchor = text[:offset]
+        state['rider_col'] = find_rider_column(anchor)
+        tail = text[offset:] if offset else ''
+        skip = 0
+
+    rows = list(csv.reader(StringIO(tail)))[skip:]
+
+    # 只把位置推進到最後一個換行之後；最後一列若尚未以換行結尾，下次會再出現一次
+    cut = tail.rfind('\n') + 1
+    if cut:
+        state['anchor'] = tail[tail.rfind('\n', 0, cut - 1) + 1:cut]
+        state['offset'] = offset + cut
+    else:
+        state['anchor'] = anchor
+        state['offset'] = offset
+    state['carry'] = 1 if tail[cut:].strip() else 0
+    REFRESH_STAGE_SECONDS.labels('parse').observe(time.perf_counter() - start)
+    SHEET_FETCHES.labels('rebuild' if rebuild else 'modified').inc()
+    return rows, rebuild, state
 
 
 def fetch_and_process_data():
-    """從 Google Sheets CSV 讀取數據並計算安全分數和排行榜"""
-    global data_cache
+    """從 Google Sheets CSV 增量讀取數據並計算安全分數和排行榜"""
+    global data_cache, api_snapshot
     
+    refresh_start = time.perf_counter()
     try:
-        response = requests.get(SHEETS_CSV_URL)
-        response.raise_for_status() 
-        
-        csv_data = StringIO(response.text)
-        reader = csv.reader(csv_data)
-        
-        headers = next(reader)
-        records = list(reader)
-        
-        if not records:
-            print("【數據錯誤】CSV 數據為空。")
-            return
+        event_store = get_event_store()
+        new_rows, rebuild, new_state = fetch_new_rows()
 
-        # --- 數據清洗與篩選 (讀取過去 48 小時數據以覆蓋前一天) ---
-        processed_records = []
-        latest_score = 100
-        total_alerts = 0
-        
-        time_48_hours_ago = datetime.now() - timedelta(hours=48)
-        
-        for row in records:
-            if len(row) < 4 or not row[3].strip(): continue 
-            
-            timestamp_str = row[3].strip() 
-            alert_full = row[1].strip()
-            score_raw = row[2].strip()
-            
-            # --- 時間解析修正 ---
-            record_time_str = timestamp_str
-            
-            try:
-                record_time = datetime.strptime(timestamp_str, '%Y-%m-%d %H:%M:%S')
-                record_time_str = record_time.strftime('%Y-%m-%d %H:%M:%S')
-            except ValueError:
-                record_time_str = timestamp_str 
-            
-            # 篩選掉超過 48 小時的數據 (只分析最近兩天)
-            if record_time < time_48_hours_ago:
-                 continue
-            
-            alert_type_main = alert_full.split('(')[0].strip()
-            
-            try:
-                score = int(score_raw)
-            except ValueError:
-                score = 100 
-                
-            processed_records.append({
-                'Timestamp': record_time_str,
-                'Alert Type': str(alert_type_main or 'SAFE'),
-                'Safety Score': score,
-                'Rider_ID': 'Rider_A380' 
-            })
-            
-            latest_score = score
-            if alert_type_main != 'SAFE':
-                 total_alerts += 1
-        
-        if not processed_records:
+        # --- 數據清洗：只處理新增的列，與讀取位置在同一交易寫入事件庫；交易成功後才更新記憶體中的讀取位置 ---
+        store_start = time.perf_counter()
+        state = dict(ingest_state, **(new_state or {}))
+        new_events = [parsed for parsed in (parse_sheet_row(row, state['rider_col']) for row in new_rows) if parsed is not None]
+        event_store.add_events(new_events, meta={'ingest_state': state}, reset=rebuild)
+        ingest_state.update(state)
+        REFRESH_STAGE_SECONDS.labels('store').observe(time.perf_counter() - store_start)
+        ROWS_INGESTED.inc(len(new_events))
+
+        # 每天清理一次超過保留期限的原始事件
+        now = datetime.now()
+        if ingest_state.get('pruned_day') != now.strftime('%Y-%m-%d'):
+            event_store.prune(now)
+            ingest_state['pruned_day'] = now.strftime('%Y-%m-%d')
+
+        # 每位騎士的最新分數與 48 小時警報數 (由彙總表取得，不掃描原始紀錄)
+        summary = event_store.rider_summary(now - timedelta(hours=RECENT_LOG_HOURS))
+        if not summary:
             print("【數據錯誤】無有效紀錄。")
             return
-            
-        # --- 4. 風險分析與 JSON 寫入 ---
-        
-        reminder_text = analyze_fatigue_risk(processed_records)
+
+        # --- 4. 風險分析 (只重新分析有新事件的騎士，或進入新的小時) 與 JSON 寫入 ---
+        hour_key = now.strftime('%Y-%m-%d %H')
+        touched = set(rec['Rider_ID'] for _, rec in new_events)
+        if rebuild:
+            reminder_cache.clear()
+        for rider in summary:
+            rider_id = rider['rider_id']
+            cached = reminder_cache.get(rider_id)
+            if cached is None or cached[0] != hour_key or rider_id in touched:
+                reminder_cache[rider_id] = (hour_key, analyze_fatigue_risk(event_store, rider_id, now))
+        reminders = {rider['rider_id']: reminder_cache[rider['rider_id']][1] for rider in summary}
+        reminder_text = reminders.get(DEFAULT_RIDER_ID, reminders[summary[0]['rider_id']])
         
         risk_data_to_save = {
             'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            'reminder': reminder_text,
+            'reminder': reminder_text, # 單騎士 (舊版偵測端) 使用
+            'reminders': reminders,
         }
+
+        # 儀表板只顯示最近 48 小時 (以索引做範圍查詢，最多 RECENT_LOG_LIMIT 筆)
+        processed_records = event_store.recent_events(now - timedelta(hours=RECENT_LOG_HOURS), limit=RECENT_LOG_LIMIT)
         
-        # 確保 JSON 檔案寫入成功
+        # 提醒內容有變化才寫入 JSON (原子替換) 並通知偵測端
         try:
-            with open(DATA_CACHE_FILENAME, 'w', encoding='utf-8') as f:
-                json.dump(risk_data_to_save, f, ensure_ascii=False, indent=4)
-            print(f"【數據更新】成功讀取 {len(processed_records)} 筆紀錄，並寫入 {DATA_CACHE_FILENAME}。")
+            if risk_publisher.publish(risk_data_to_save):
+                print(f"【數據更新】新增 {len(new_events)} 筆，{len(summary)} 位騎士，提醒已更新並寫入 {DATA_CACHE_FILENAME}。")
+            elif new_events:
+                print(f"【數據更新】新增 {len(new_events)} 筆，{len(summary)} 位騎士，提醒內容未變。")
         except Exception as e:
             print(f"【致命錯誤】JSON 檔案寫入失敗: {e}")
         
-        # --- 6. 更新網站快取 ---
-        safety_level = 'critical' if latest_score < 40 else ('warning' if latest_score < 70 else 'safe')
-        rider_stats = [{
-            'Rider_ID': 'Rider_A380',
-            'latest_score': latest_score,
-            'total_alerts': total_alerts,
-            'safety_level': safety_level
-        }]
+        # --- 6. 更新網站快取 (需要關注的騎士排在前面) ---
+        rider_stats = []
+        for rider in summary:
+            latest_score = rider['latest_score']
+            safety_level = 'critical' if latest_score < 40 else ('warning' if latest_score < 70 else 'safe')
+            rider_stats.append({
+                'Rider_ID': rider['rider_id'],
+                'latest_score': latest_score,
+                'total_alerts': rider['window_alerts'],
+                'safety_level': safety_level,
+                'reminder': reminders[rider['rider_id']],
+            })
+        rider_stats.sort(key=lambda r: (r['latest_score'], -r['total_alerts']))
+
+        # 排行榜：分數高、警報少者排名在前
+        leaderboard = sorted(rider_stats, key=lambda r: (-r['latest_score'], r['total_alerts']))
+        leaderboard = [{'rank': i + 1, 'Rider_ID': r['Rider_ID'], 'latest_score': r['latest_score'],
+                        'total_alerts': r['total_alerts']} for i, r in enumerate(leaderboard)]
         recent_data = processed_records
+
+        # 推播給已連線的儀表板：只送新事件與分數有變化的騎士
+        if rebuild:
+            last_pushed_riders.clear()
+        changed_riders = [r for r in rider_stats if last_pushed_riders.get(r['Rider_ID']) != r]
+        last_pushed_riders.update((r['Rider_ID'], r) for r in changed_riders)
+        last_update = datetime.now().strftime("%H:%M:%S")
             
         with data_lock:
             data_cache['rider_stats'] = rider_stats
+            data_cache['leaderboard'] = leaderboard
             data_cache['recent_logs'] = recent_data
-            data_cache['last_update'] = datetime.now().strftime("%H:%M:%S")
+            data_cache['last_update'] = last_update
             data_cache['reminder'] = reminder_text 
 
+            # 與快取在同一個鎖內發佈，頁面取得的快照與推播序號一致
+            if rebuild:
+                broadcaster.publish('reset', {})
+            elif new_events or changed_riders:
+                broadcaster.publish('update', {
+                    'last_update': last_update,
+                    'events': [rec for _, rec in sorted(new_events, key=lambda e: e[0])],
+                    'riders': changed_riders,
+                })
+
+        # API 快照 (序列化與壓縮在鎖外完成，最後一次替換)
+        api_snapshot = ApiSnapshot({
+            'rider_stats': rider_stats,
+            'leaderboard': leaderboard,
+            'last_update': last_update,
+            'reminder': reminder_text,
+            'log_count': len(recent_data),
+        }, recent_data[::-1], event_store.count_events())
+
+        REFRESH_STAGE_SECONDS.labels('total').observe(time.perf_counter() - refresh_start)
+        LAST_REFRESH.set(time.time())
+
     except Exception as e:
+        SHEET_FETCHES.labels('error').inc()
         print(f"【數據錯誤】處理試算表時發生錯誤: {e}")
 
 
 # --- 定期更新數據的背景線程 ---
 def start_data_refresh_thread():
-    """每 10 秒刷新一次數據"""
+    """每 REFRESH_INTERVAL_SEC 秒刷新一次數據"""
     fetch_and_process_data() # 立即執行第一次
     def refresh_data():
         while True:
-            time.sleep(10) # 每 10 秒刷新一次
+            time.sleep(REFRESH_INTERVAL_SEC) # 每次重新讀取，設定熱更新後下一輪即生效
             fetch_and_process_data()
             
     thread = threading.Thread(target=refresh_data)
@@ -203,23 +492,84 @@ def start_data_refresh_thread():
 
 @app.route('/')
 def index():
-    if not data_cache or not data_cache.get('rider_stats'):
+    with data_lock:
+        snapshot = dict(data_cache)
+        stream_seq = broadcaster.seq
+    if not snapshot or not snapshot.get('rider_stats'):
         return render_template('loading.html') 
         
     return render_template('index.html', 
-                           rider_stats=data_cache['rider_stats'],
-                           recent_logs=data_cache['recent_logs'],
-                           last_update=data_cache.get('last_update', '--'),
-                           reminder=data_cache.get('reminder', '正在分析歷史數據...')
+                           rider_stats=snapshot['rider_stats'],
+                           recent_logs=snapshot['recent_logs'],
+                           last_update=snapshot.get('last_update', '--'),
+                           reminder=snapshot.get('reminder', '正在分析歷史數據...'),
+                           stream_seq=stream_seq,
+                           log_limit=RECENT_LOG_LIMIT
                            )
 
+@app.route('/stream')
+def stream():
+    """SSE 端點：瀏覽器重新連線時以 Last-Event-ID 接續，第一次連線以 ?since= 指定頁面快照的序號"""
+    since = request.headers.get('Last-Event-ID', type=int)
+    if since is None:
+        since = request.args.get('since', default=broadcaster.seq, type=int)
+
+    def counted_stream():
+        STREAM_CLIENTS.inc()
+        try:
+            yield from broadcaster.stream(since)
+        finally:
+            STREAM_CLIENTS.dec()
+
+    return Response(counted_stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def parse_time_arg(name):
+    """讀取時間參數 (YYYY-mm-dd HH:MM:SS，可只給日期或使用 ISO 的 T 分隔)；格式錯誤時拋出 ValueError"""
+    value = request.args.get(name)
+    if not value:
+        return None
+    value = value.replace('T', ' ')
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            datetime.strptime(value, fmt)
+            return value
+        except ValueError:
+            pass
+    raise ValueError(f"{name} 時間格式錯誤: {value}")
+
 @app.route('/api/status', methods=['GET'])
 def api_status():
-    with data_lock:
-        return jsonify(data_cache)
+    """摘要：各騎士狀態、排行榜與提醒 (不含紀錄明細，請改用 /api/logs)"""
+    return api_snapshot.summary.response()
+
+@app.route('/api/logs', methods=['GET'])
+def api_logs():
+    """紀錄 (由新到舊)，可依 rider、since、until 篩選並以 page / per_page 分頁 (範圍為事件庫的保留期限)"""
+    try:
+        since = parse_time_arg('since')
+        until = parse_time_arg('until')
+        # 只給日期 (或到分鐘) 時包含整天 (整分鐘)
+        if until:
+            until += ' 23:59:59'[len(until) - 10:]
+        page = request.args.get('page', default=1, type=int)
+        per_page = request.args.get('per_page', default=LOG_PAGE_SIZE, type=int)
+        if page < 1 or not 1 <= per_page <= LOG_PAGE_MAX:
+            raise ValueError(f"page 需 >= 1，per_page 需介於 1 到 {LOG_PAGE_MAX}")
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    return api_snapshot.log_page(request.args.get('rider') or None, since, until, page, per_page).response()
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus 文字格式的執行期指標 (刷新各階段耗時、讀取結果、SSE 連線數)"""
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
 
 
 # --- 啟動 Flask ---
 if __name__ == '__main__':
+    start_config_watcher()
     start_data_refresh_thread()
     app.run(host='0.0.0.0', port=5000, debug=False, threaded=True)